@@ -1,16 +1,29 @@
 import logging
 import requests
+import requests.adapters
 import pyodbc
 import os
 import io
 import azure.functions as func
-from datetime import datetime, date, timedelta
+from datetime import datetime, date, timedelta, timezone
 import time
 import json
 import gzip
+import hashlib
+import shutil
+import sqlite3
+import re
+import threading
+import contextvars
+import uuid
+import queue
+from collections import deque
+from urllib.parse import urlparse, parse_qs, urlencode
 import pandas as pd
 import traceback
+from contextlib import contextmanager
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 idag = datetime.now()
 igår = idag - timedelta(days=1)
@@ -28,25 +41,551 @@ CD2_client_secret = os.environ['CD2_client_secret']
 conn_str = os.environ["Connection_SQL"]
 
 
+# Målingar for kvar køyring: éin post per steg og delsteg, skrivne til akv_målingar_fil
+# og dbo.akv_målingar når køyringa er ferdig
+akv_målingar = []
+akv_målingar_lås = threading.Lock()
+akv_målingar_fil = 'akv_målingar.jsonl'
+akv_måling_no = contextvars.ContextVar('akv_måling_no', default=None)
+akv_måling_teljarar = ['rader', 'byte', 'http_kall', 'nye_forsøk']
+
+
+@contextmanager
+def akv_måling(namn):
+    """
+    Mål tid, rader, byte, HTTP-kall og nye forsøk for eit steg (t.d. ein timer) eller
+    eit delsteg (t.d. 'sql:stg.Canvas_Users'). Målingar inni kvarandre blir knytte saman
+    via stien, og teljarane blir lagde til alle målingane som er opne (sjå akv_tel).
+    """
+    forelder = akv_måling_no.get()
+    måling = {
+        'køyring': forelder['køyring'] if forelder else uuid.uuid4().hex,
+        'steg': f"{forelder['steg']}/{namn}" if forelder else namn,
+        'start': datetime.now(timezone.utc).isoformat(),
+        'sekund': None,
+        **{teljar: 0 for teljar in akv_måling_teljarar},
+        'feil': None,
+        'forelder': forelder,
+    }
+    token = akv_måling_no.set(måling)
+    start = time.perf_counter()
+    try:
+        yield måling
+    except BaseException as feil:
+        måling['feil'] = repr(feil)
+        raise
+    finally:
+        måling['sekund'] = time.perf_counter() - start
+        akv_måling_no.reset(token)
+        with akv_målingar_lås:
+            akv_målingar.append(måling)
+
+
+def akv_tel(teljar, n=1):
+    """
+    Legg n til teljar i gjeldande måling og alle målingane utanfor henne. 'rader' blir
+    berre lagt til gjeldande måling, så radene ikkje blir talde både ved nedlasting og opplasting.
+    """
+    måling = akv_måling_no.get()
+    with akv_målingar_lås:
+        while måling is not None:
+            måling[teljar] += n
+            if teljar == 'rader':
+                break
+            måling = måling['forelder']
+
+
+def akv_registrer_måling(namn, sekund, **teljarar):
+    """
+    Legg til ei ferdig måling under gjeldande måling, for delsteg som ikkje kan målast
+    med akv_måling (t.d. inni generatorar, der ei open måling ville lekke ut over yield).
+    """
+    forelder = akv_måling_no.get()
+    with akv_målingar_lås:
+        akv_målingar.append({
+            'køyring': forelder['køyring'] if forelder else uuid.uuid4().hex,
+            'steg': f"{forelder['steg']}/{namn}" if forelder else namn,
+            'start': (datetime.now(timezone.utc) - timedelta(seconds=sekund)).isoformat(),
+            'sekund': sekund,
+            **{teljar: teljarar.get(teljar, 0) for teljar in akv_måling_teljarar},
+            'feil': None,
+            'forelder': forelder,
+        })
+
+
+def akv_med_kontekst(funksjon):
+    """
+    Pakk inn funksjon slik at han køyrer med målingane til den som pakka han inn,
+    også i andre trådar (ThreadPoolExecutor tek ikkje med contextvars av seg sjølv).
+    """
+    kontekst = contextvars.copy_context()
+
+    def køyr(*args, **kwargs):
+        return kontekst.copy().run(funksjon, *args, **kwargs)
+    return køyr
+
+
+def akv_lagre_målingar():
+    """
+    Skriv målingane frå køyringa til akv_målingar_fil (éi JSON-linje per måling) og til
+    dbo.akv_målingar, og tøm lista. Feil i lagringa blir berre logga.
+    """
+    with akv_målingar_lås:
+        målingar = [{k: v for k, v in m.items() if k != 'forelder'} for m in akv_målingar]
+        akv_målingar.clear()
+    if not målingar:
+        return
+    with open(akv_målingar_fil, 'a', encoding='utf-8') as f_out:
+        for måling in målingar:
+            f_out.write(json.dumps(måling, ensure_ascii=False) + "\n")
+    try:
+        with akv_sql_tilkopling() as cnxn:
+            with cnxn.cursor() as cursor:
+                cursor.execute("""
+                    IF OBJECT_ID(N'dbo.akv_målingar', N'U') IS NULL
+                    CREATE TABLE [dbo].[akv_målingar] (
+                        [køyring] CHAR(32) NOT NULL,
+                        [steg] NVARCHAR(400) NOT NULL,
+                        [start] DATETIMEOFFSET NOT NULL,
+                        [sekund] FLOAT NOT NULL,
+                        [rader] BIGINT NOT NULL,
+                        [byte] BIGINT NOT NULL,
+                        [http_kall] INT NOT NULL,
+                        [nye_forsøk] INT NOT NULL,
+                        [feil] NVARCHAR(MAX) NULL
+                    )
+                """)
+                kolonnar = akv_tabellar["dbo.akv_målingar"]['kolonnar']
+                cursor.fast_executemany = True
+                cursor.executemany(f"INSERT INTO [dbo].[akv_målingar] ({', '.join(f'[{k}]' for k in kolonnar)}) VALUES ({', '.join('?' for _ in kolonnar)})",
+                                   [tuple(m[k] for k in kolonnar) for m in målingar])
+    except akv_sql_feil:
+        logging.exception("Klarte ikkje å lagre målingane i databasen")
+
+
+# Alle utgåande HTTP-kall går gjennom akv_http, som måler kvart kall og sender ein
+# post om det til kvar krok i akv_http_krokar
+akv_http_krokar = []
+# Funksjon (metode, url, sesjon=None, **kwargs) -> requests.Response som blir brukt i
+# staden for nettverket når han er sett, t.d. til opptak og avspeling i benchmark_timerar.py
+akv_http_transport = None
+akv_http_kall = {}
+akv_http_flamme = {}
+akv_http_lås = threading.Lock()
+akv_flammegraf_fil = 'akv_flammegraf.txt'
+
+
+def akv_http_endepunkt(metode, url):
+    """
+    Gjer om ein URL til eit endepunkt som kall kan grupperast etter, t.d.
+    'GET hvl.instructure.com/api/v1/courses/{id}/users'. Delar av stien som er tal eller
+    inneheld lange id-ar (t.d. CD2-filnamn), blir bytte ut med {id}, og spørjestrengen blir fjerna.
+    """
+    url = urlparse(url)
+    delar = ['{id}' if re.fullmatch(r'[0-9]+', del_) or re.search(r'[0-9a-fA-F-]{16,}', del_) else del_
+             for del_ in url.path.split('/')]
+    return f"{metode.upper()} {url.netloc}{'/'.join(delar)}"
+
+
+def akv_måling_stabel(måling):
+    """
+    Returner namna på måling og alle målingane utanfor henne, ytst først.
+    """
+    stabel = []
+    while måling is not None:
+        forelder = måling['forelder']
+        stabel.append(måling['steg'][len(forelder['steg']) + 1:] if forelder else måling['steg'])
+        måling = forelder
+    return stabel[::-1]
+
+
+def akv_http(metode, url, sesjon=None, forsøk=0, **kwargs):
+    """
+    Send eit HTTP-kall med sesjon (eller requests) og mål det. Kallet blir talt i
+    gjeldande måling (sjå akv_tel), og alle krokane i akv_http_krokar får ein post med
+    endepunkt, status, sekund, byte og forsøk. forsøk er 0 for første forsøk.
+    Med stream=True er innhaldet ikkje lese enno; då blir byte henta frå Content-Length
+    og ikkje talde, så den som les straumen må telje byte sjølv.
+    """
+    akv_tel('http_kall')
+    if forsøk:
+        akv_tel('nye_forsøk')
+    start = time.perf_counter()
+    respons = None
+    try:
+        if akv_http_transport is not None:
+            respons = akv_http_transport(metode, url, sesjon=sesjon, **kwargs)
+        else:
+            respons = (sesjon or requests).request(metode, url, **kwargs)
+        return respons
+    finally:
+        sekund = time.perf_counter() - start
+        if respons is None:
+            byte = 0
+        elif kwargs.get('stream'):
+            byte = int(respons.headers.get('Content-Length', 0))
+        else:
+            byte = len(respons.content)
+            akv_tel('byte', byte)
+        post = {
+            'metode': metode.upper(),
+            'url': url,
+            'endepunkt': akv_http_endepunkt(metode, url),
+            'status': respons.status_code if respons is not None else None,
+            'sekund': sekund,
+            'byte': byte,
+            'forsøk': forsøk,
+            'måling': akv_måling_no.get(),
+        }
+        for krok in list(akv_http_krokar):
+            try:
+                krok(post)
+            except Exception:
+                logging.exception(f"Feil i HTTP-kroken {krok.__name__}")
+
+
+def akv_http_statistikk(post):
+    """
+    HTTP-krok som samlar tid, statuskodar, byte og nye forsøk per endepunkt i
+    akv_http_kall, og tid per endepunkt og måling i akv_http_flamme.
+    """
+    with akv_http_lås:
+        endepunkt = akv_http_kall.setdefault(post['endepunkt'], {'sekund': [], 'statusar': {}, 'byte': 0, 'nye_forsøk': 0})
+        endepunkt['sekund'].append(post['sekund'])
+        status = post['status'] or 'feil'
+        endepunkt['statusar'][status] = endepunkt['statusar'].get(status, 0) + 1
+        endepunkt['byte'] += post['byte']
+        endepunkt['nye_forsøk'] += 1 if post['forsøk'] else 0
+        stabel = tuple(akv_måling_stabel(post['måling']) + [f"http:{post['endepunkt']}"])
+        akv_http_flamme[stabel] = akv_http_flamme.get(stabel, 0.0) + post['sekund']
+
+
+akv_http_krokar.append(akv_http_statistikk)
+
+
+def akv_persentil(sorterte, p):
+    """
+    Returner p-persentilen (0-100) av ei sortert liste, etter nærmaste-rang-metoden.
+    """
+    return sorterte[max(0, -(-len(sorterte) * p // 100) - 1)]
+
+
+def akv_http_samandrag():
+    """
+    Logg tal på kall, p50/p95/p99 og maks for svartida, byte, statuskodar og nye forsøk
+    for kvart endepunkt, dei tregaste (samla tid) først, og tøm akv_http_kall.
+    """
+    with akv_http_lås:
+        kall = dict(akv_http_kall)
+        akv_http_kall.clear()
+    for namn, endepunkt in sorted(kall.items(), key=lambda e: -sum(e[1]['sekund'])):
+        sekund = sorted(endepunkt['sekund'])
+        ms = {p: 1000*akv_persentil(sekund, p) for p in (50, 95, 99)}
+        logging.info(f"HTTP {namn}: {len(sekund)} kall, {sum(sekund):.1f} s, p50 {ms[50]:.0f} ms, "
+                     f"p95 {ms[95]:.0f} ms, p99 {ms[99]:.0f} ms, maks {1000*sekund[-1]:.0f} ms, "
+                     f"{endepunkt['byte']} byte, statusar {endepunkt['statusar']}, {endepunkt['nye_forsøk']} nye forsøk")
+
+
+def akv_skriv_flammegraf(fil=None):
+    """
+    Skriv tidsbruken i køyringa som «folded stacks» (éi linje per stabel, t.d.
+    'main;timer_Canvas_Users;sql:stg.Canvas_Users 1234' i millisekund), som kan
+    teiknast med flamegraph.pl eller speedscope. Kvar måling får tida si utan
+    delmålingane og HTTP-kalla under seg; HTTP-kalla blir eigne blad. Tøm akv_http_flamme.
+    Delsteg som køyrer parallelt, kan til saman ta meir tid enn steget dei høyrer til;
+    då får steget 0 ms for seg sjølv.
+    """
+    with akv_målingar_lås:
+        målingar = list(akv_målingar)
+    with akv_http_lås:
+        http = dict(akv_http_flamme)
+        akv_http_flamme.clear()
+    stablar = {}
+    under = {}
+    for måling in målingar:
+        stabel = tuple(akv_måling_stabel(måling))
+        stablar[stabel] = stablar.get(stabel, 0.0) + måling['sekund']
+        if len(stabel) > 1:
+            under[stabel[:-1]] = under.get(stabel[:-1], 0.0) + måling['sekund']
+    for stabel, sekund in http.items():
+        under[stabel[:-1]] = under.get(stabel[:-1], 0.0) + sekund
+    linjer = {stabel: max(0.0, sekund - under.get(stabel, 0.0)) for stabel, sekund in stablar.items()}
+    linjer.update(http)
+    with open(fil or akv_flammegraf_fil, 'w', encoding='utf-8') as f_out:
+        for stabel, sekund in sorted(linjer.items()):
+            if round(1000*sekund):
+                f_out.write(f"{';'.join(stabel)} {round(1000*sekund)}\n")
+
+
+# Kvar radene blir lagra: "azure" (Azure SQL via pyodbc) eller "sqlite" (lokale filer i
+# akv_sqlite_katalog, éi per skjema, for å køyre og måle stega utan Azure)
+akv_sql_lager = os.environ.get('SQL_lager', 'azure')
+akv_sqlite_katalog = os.environ.get('SQL_lager_katalog', 'SQL_lager')
+akv_sqlite_skjema = ['stg', 'dbo']
+# Feil frå databasen, same kva lager vi brukar
+akv_sql_feil = (pyodbc.Error, sqlite3.Error)
+# T-SQL som stega brukar, og det SQLite skal ha i staden
+akv_sqlite_omsetjingar = [
+    (re.compile(r"IF\s+OBJECT_ID\(N'[^']*',\s*N'U'\)\s+IS\s+NULL\s+CREATE\s+TABLE", re.IGNORECASE), "CREATE TABLE IF NOT EXISTS"),
+    (re.compile(r"\(MAX\)", re.IGNORECASE), ""),
+    (re.compile(r"getdate\(\)\s*-\s*(\d+)", re.IGNORECASE), r"datetime('now', '-\1 days')"),
+    (re.compile(r"getdate\(\)", re.IGNORECASE), "datetime('now')"),
+]
+
+
+class SQLiteCursor:
+    """
+    Cursor til SQLite med same bruk som ein pyodbc-cursor: parametrar som eigne argument
+    eller éin tuple, execute returnerer cursoren, og han kan brukast i with (og committar då).
+    T-SQL i akv_sqlite_omsetjingar blir omsett, og EXEC (lagra prosedyrar) blir hoppa over.
+    """
+
+    def __init__(self, tilkopling):
+        self.tilkopling = tilkopling
+        self.cursor = tilkopling.sqlite.cursor()
+        self.fast_executemany = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, verdi, tb):
+        if type_ is None:
+            self.tilkopling.commit()
+        self.close()
+        return False
+
+    def execute(self, query, *parametrar):
+        if query.lstrip().upper().startswith("EXEC "):
+            logging.debug(f"Hoppar over lagra prosedyre i SQLite: {query.strip()}")
+            return self
+        if len(parametrar) == 1 and isinstance(parametrar[0], (tuple, list)):
+            parametrar = parametrar[0]
+        for mønster, erstatning in akv_sqlite_omsetjingar:
+            query = mønster.sub(erstatning, query)
+        self.cursor.execute(query, parametrar)
+        return self
+
+    def executemany(self, query, rader):
+        self.cursor.executemany(query, rader)
+        return self
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def close(self):
+        self.cursor.close()
+
+
+class SQLiteTilkopling:
+    """
+    Tilkopling til SQLite med same bruk som ei pyodbc-tilkopling (sjå SQLiteCursor).
+    """
+
+    def __init__(self, sqlite):
+        self.sqlite = sqlite
+
+    def cursor(self):
+        return SQLiteCursor(self)
+
+    def commit(self):
+        self.sqlite.commit()
+
+    def rollback(self):
+        self.sqlite.rollback()
+
+    def close(self):
+        self.sqlite.close()
+
+
+def akv_sqlite_tid(verdi):
+    """
+    Les eit tidspunkt frå SQLite som naiv UTC-datetime, slik pyodbc gir DATETIME2.
+    Verdiar som ikkje er tidspunkt, blir returnerte som tekst.
+    """
+    tekst = verdi.decode('utf-8')
+    try:
+        tid = datetime.fromisoformat(tekst.replace('Z', '+00:00'))
+    except ValueError:
+        return tekst
+    if tid.tzinfo is not None:
+        tid = tid.astimezone(timezone.utc).replace(tzinfo=None)
+    return tid
+
+
+sqlite3.register_adapter(datetime, lambda tid: tid.isoformat(" "))
+sqlite3.register_adapter(date, lambda dato: dato.isoformat())
+sqlite3.register_adapter(pd.Timestamp, lambda tid: tid.isoformat(" "))
+sqlite3.register_adapter(np.int64, int)
+sqlite3.register_adapter(np.bool_, bool)
+sqlite3.register_converter("TIMESTAMP", akv_sqlite_tid)
+
+
+def akv_sqlite_kople():
+    """
+    Opne hovudfila i akv_sqlite_katalog og kople til skjemaa (stg.db, dbo.db) med
+    ATTACH, slik at [stg].[Canvas_Users] osv. fungerer som i Azure SQL. Tabellane i
+    akv_tabellar (og dbo.akv_sist_oppdatert) blir oppretta dersom dei manglar.
+    """
+    os.makedirs(akv_sqlite_katalog, exist_ok=True)
+    sqlite = sqlite3.connect(os.path.join(akv_sqlite_katalog, "main.db"), timeout=60,
+                             detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+    for skjema in akv_sqlite_skjema:
+        sqlite.execute("ATTACH DATABASE ? AS " + skjema, (os.path.join(akv_sqlite_katalog, f"{skjema}.db"),))
+        sqlite.execute(f"PRAGMA {skjema}.journal_mode=WAL")
+    for tabell, spesifikasjon in akv_tabellar.items():
+        sqlite.execute(akv_sqlite_ddl(tabell, spesifikasjon['kolonnar'], spesifikasjon['nøkkel']))
+    sqlite.commit()
+    return SQLiteTilkopling(sqlite)
+
+
+def akv_sqlite_ddl(tabell, kolonnar, nøkkel):
+    """
+    Lag CREATE TABLE for tabell i SQLite. Kolonnane får ingen type, bortsett frå
+    tidspunkt (namn som sluttar på _at, og sist_oppdatert), som blir lesne som datetime.
+    Nøkkelen blir primærnøkkel, så ON CONFLICT i akv_sqlite_upsert kan bruke han.
+    """
+    definisjon = [f"[{k}] TIMESTAMP" if k.endswith('_at') or k == 'sist_oppdatert' else f"[{k}]" for k in kolonnar]
+    if nøkkel:
+        definisjon.append(f"PRIMARY KEY ({', '.join(f'[{k}]' for k in nøkkel)})")
+    return f"CREATE TABLE IF NOT EXISTS {akv_sql_namn(tabell)} ({', '.join(definisjon)})"
+
+
+def akv_sqlite_upsert(cnxn, tabell, kolonnar, rader):
+    """
+    Legg inn eller oppdater rader i tabell i SQLite med INSERT ... ON CONFLICT, same
+    resultat som MERGE i Azure SQL: kjem same nøkkel fleire gonger, vinn den siste.
+    """
+    nøkkel = akv_tabellar[tabell]['nøkkel']
+    oppdater = [k for k in kolonnar if k not in nøkkel]
+    query = f"""
+        INSERT INTO {akv_sql_namn(tabell)} ({', '.join(f'[{k}]' for k in kolonnar)})
+        VALUES ({', '.join('?' for _ in kolonnar)})
+        ON CONFLICT ({', '.join(f'[{k}]' for k in nøkkel)}) DO
+        {"UPDATE SET " + ", ".join(f"[{k}] = excluded.[{k}]" for k in oppdater) if oppdater else "NOTHING"}
+    """
+    with cnxn.cursor() as cursor:
+        for i in range(0, len(rader), akv_bulk_batchstorleik):
+            cursor.executemany(query, rader[i:i + akv_bulk_batchstorleik])
+
+
+# Opne tilkoplingar til databasen som kan brukast om att, delt av alle trådar i prosessen
+akv_sql_pool = []
+akv_sql_pool_lås = threading.Lock()
+akv_sql_pool_storleik = 4
+akv_sql_sjekk_etter = 60
+akv_sql_cursorar = {}
+
+
+def akv_sql_kople():
+    """
+    Opne ei ny tilkopling til databasen i akv_sql_lager. benchmark_timerar.py kan
+    byte ut denne for å køyre stega utan database i det heile.
+    """
+    if akv_sql_lager == 'sqlite':
+        return akv_sqlite_kople()
+    return pyodbc.connect(conn_str)
+
+
+@contextmanager
+def akv_sql_tilkopling():
+    """
+    Lån ei tilkopling frå poolen (eller opne ei ny) og gi henne tilbake etterpå.
+
+    Brukast som pyodbc.connect: endringane blir committa når blokka er ferdig, og
+    rulla tilbake dersom det oppstår ein feil. Tilkoplingar som har lege ubrukte i
+    meir enn akv_sql_sjekk_etter sekund, blir sjekka med SELECT 1 før dei blir lånte ut.
+    """
+    cnxn = None
+    with akv_sql_pool_lås:
+        while akv_sql_pool and cnxn is None:
+            kandidat, sist_brukt = akv_sql_pool.pop()
+            if time.monotonic() - sist_brukt > akv_sql_sjekk_etter:
+                try:
+                    kandidat.cursor().execute("SELECT 1").fetchall()
+                except akv_sql_feil:
+                    logging.debug("Kasta ei død SQL-tilkopling frå poolen")
+                    akv_sql_kast(kandidat)
+                    continue
+            cnxn = kandidat
+    if cnxn is None:
+        cnxn = akv_sql_kople()
+    try:
+        yield cnxn
+        cnxn.commit()
+    except akv_sql_feil:
+        akv_sql_kast(cnxn)
+        raise
+    except BaseException:
+        cnxn.rollback()
+        akv_sql_lever_tilbake(cnxn)
+        raise
+    else:
+        akv_sql_lever_tilbake(cnxn)
+
+
+def akv_sql_lever_tilbake(cnxn):
+    """
+    Legg ei tilkopling tilbake i poolen, eller lukk henne dersom poolen er full.
+    """
+    with akv_sql_pool_lås:
+        if len(akv_sql_pool) < akv_sql_pool_storleik:
+            akv_sql_pool.append((cnxn, time.monotonic()))
+            return
+    akv_sql_kast(cnxn)
+
+
+def akv_sql_kast(cnxn):
+    """
+    Lukk ei tilkopling og gløym cursorane som høyrde til henne.
+    """
+    akv_sql_cursorar.pop(id(cnxn), None)
+    try:
+        cnxn.close()
+    except akv_sql_feil:
+        pass
+
+
+def akv_sql_utfør(cnxn, query, *parametrar):
+    """
+    Køyr query med parametrar på ein cursor som blir teken vare på per tilkopling og query.
+
+    pyodbc førebur ei setning éin gong og brukar ho om att så lenge same cursor køyrer
+    same tekst, så faste spørjingar (t.d. MERGE mot akv_sist_oppdatert) blir berre
+    kompilerte éin gong per tilkopling. Returnerer cursoren.
+    """
+    cursorar = akv_sql_cursorar.setdefault(id(cnxn), {})
+    cursor = cursorar.get(query)
+    if cursor is None:
+        cursor = cursorar[query] = cnxn.cursor()
+    return cursor.execute(query, *parametrar)
+
+
 def akv_finn_sist_oppdatert(tabell):
     """
     Returner den siste oppdateringstida for den gitte tabellen fra akv_sist_oppdatert-tabellen.
     Hvis ingen dato er gitt (eller vi ikkje får kontakt med databasen), returner igår.
     """
     try:
-        with pyodbc.connect(conn_str) as connection:
-            cursor = connection.cursor()
+        with akv_sql_tilkopling() as connection:
             query = """
             SELECT [sist_oppdatert] FROM [dbo].[akv_sist_oppdatert]
             WHERE [tabell] = ?
             """
-            cursor.execute(query, (tabell,))
-            row = cursor.fetchone()
+            # fetchall les resultatet heilt ut, så den gjenbrukte cursoren ikkje held
+            # på eit halvlese resultat når tilkoplinga går tilbake til poolen
+            rader = akv_sql_utfør(connection, query, (tabell,)).fetchall()
+            row = rader[0] if rader else None
             if row:
-                logging.debug(f"{tabell} er sist oppdatert (Azure): {row[0].isoformat() + 'Z'}")
+                logging.debug(f"{tabell} er sist oppdatert ({akv_sql_lager}): {row[0].isoformat() + 'Z'}")
                 return row[0].isoformat() + "Z"
             
-    except pyodbc.Error as exc:
+    except akv_sql_feil as exc:
         logging.debug(f"{tabell} er sist oppdatert (lokal): {(date.today() - timedelta(days=1)).isoformat() + 'Z'}") 
         return (date.today() - timedelta(days=1)).isoformat() + "Z"
 
@@ -57,8 +596,7 @@ def akv_lagre_sist_oppdatert(tabell, dato):
     """
     
     try:
-        with pyodbc.connect(conn_str) as conn:
-            cursor = conn.cursor()
+        with akv_sql_tilkopling() as conn:
             query = """
             MERGE INTO [dbo].[akv_sist_oppdatert] AS target 
             USING (VALUES (?, ?)) AS source (tabell, sist_oppdatert) 
@@ -68,16 +606,623 @@ def akv_lagre_sist_oppdatert(tabell, dato):
             WHEN NOT MATCHED THEN
                 INSERT ([tabell], [sist_oppdatert]) VALUES (source.[tabell], source.[sist_oppdatert]);
             """ 
-            cursor.execute(query, (tabell, dato))
+            if akv_sql_lager == 'sqlite':
+                akv_sqlite_upsert(conn, "dbo.akv_sist_oppdatert", ['tabell', 'sist_oppdatert'], [(tabell, dato)])
+            else:
+                akv_sql_utfør(conn, query, (tabell, dato))
             conn.commit()
-            logging.debug(f"{tabell} er sist oppdatert (Azure): {dato}")
-    except pyodbc.Error as e:
+            logging.debug(f"{tabell} er sist oppdatert ({akv_sql_lager}): {dato}")
+    except akv_sql_feil as e:
         with open(f'sist_oppdatert_{tabell}.txt', 'w') as f_out:
             f_out.write(dato)
             logging.debug(f"{tabell} er sist oppdatert (lokal): {dato}")
     return None
 
 
+# Kolonnar og nøkkel for kvar tabell vi lastar opp til. Rekkjefølgja på kolonnane
+# er den same som i tuplane timer-funksjonane byggjer. Tabellar med 'tvp' blir
+# lasta opp via ein tabellverdi-parameter til ein lagra prosedyre (sjå akv_bulk_merge_tvp),
+# og for tabellar med 'endringssjekk' sender vi berre rader som har endra seg (sjå akv_radhash);
+# 'full_kvar' overstyrer akv_radhash_full_kvar for tabellen.
+akv_tabellar = {
+    "stg.canvas_timeplan": {
+        'kolonnar': ['id', 'title', 'start_at', 'end_at', 'location_name', 'description', 'context_code', 'teacher', 'timeedit_id'],
+        'nøkkel': ['id'],
+    },
+    "stg.FS_Studieprogram": {
+        'kolonnar': ['studieprogramkode', 'studieprogramnavn', 'fakultetsnummer', 'instituttnummer', 'instituttnavn', 'prosentAvHeltid',
+                     'studieniva', 'undervisningsorganisering', 'finansieringstype', 'vekting', 'vektingstype', 'nuskode', 'prosentEgenfinansiering'],
+        'nøkkel': ['studieprogramkode'],
+    },
+    "stg.FS_Emner": {
+        'kolonnar': ['emnekode', 'versjonskode', 'unik_kode', 'emnenavn_nob', 'emnenavn_nno', 'emnenavn_eng', 'fag', 'fakultetsnummer',
+                     'instituttnummer', 'instituttnavn', 'emnetype', 'vekting', 'vektingstype', 'LUB_NNO', 'LUB_NOB', 'LUB_ENG',
+                     'ARB_NNO', 'ARB_NOB', 'ARB_ENG'],
+        'nøkkel': ['unik_kode'],
+        'endringssjekk': True,
+        # timer_FS_emne køyrer éin gong i månaden, så alle rader blir sende kvart halvår
+        'full_kvar': 6,
+    },
+    "stg.FS_Emneansvarlige": {
+        'kolonnar': ['unik_kode', 'emneansvarlege'],
+        'nøkkel': ['unik_kode'],
+    },
+    "FS_ProgramStudieretter": {
+        'kolonnar': ['plnr', 'studieprogram', 'campus', 'år', 'termin'],
+        'nøkkel': ['plnr'],
+    },
+    "stg.FS_EmneProgKobling": {
+        'kolonnar': ['Emnekode', 'Versjonskode', 'Studieprogramkode', 'Undervises_forste_ar', 'Undervises_forste_termin',
+                     'Undervises_siste_ar', 'Undervises_siste_termin', 'Emnekode2', 'programEmneKode'],
+        'nøkkel': ['programEmneKode'],
+    },
+    "stg.Canvas_Terms": {
+        'kolonnar': ['term_id', 'name', 'start_at', 'end_at', 'created_at'],
+        'nøkkel': ['term_id'],
+    },
+    "stg.Canvas_Users": {
+        'kolonnar': ['user_id', 'sis_user_id', 'created_at', 'root_account', 'last_login'],
+        'nøkkel': ['user_id'],
+        'endringssjekk': True,
+    },
+    "stg.Canvas_Courses": {
+        'kolonnar': ['course_id', 'name', 'course_code', 'sis_course_id', 'enrollment_term_id', 'account_id', 'start_at', 'conclude_at',
+                     'created_at', 'updated_at', 'root_account_id', 'workflow_state', 'login_id', 'emnekode', 'versjonskode'],
+        'nøkkel': ['course_id'],
+        'endringssjekk': True,
+    },
+    "stg.Canvas_Enrollments": {
+        'kolonnar': ['enrollment_id', 'user_id', 'sis_user_id', 'course_id', 'type', 'created_at', 'updated_at', 'start_at', 'end_at',
+                     'enrollment_state', 'total_activity_time', 'last_activity_at'],
+        'nøkkel': ['enrollment_id'],
+        'tvp': True,
+    },
+    "stg.Canvas_Courses_StudentSummaries": {
+        'kolonnar': ['page_views', 'id', 'max_page_views', 'page_views_level', 'participations', 'max_participations',
+                     'participations_level', 'course_id', 'missing', 'late', 'on_time', 'floating', 'total'],
+        'nøkkel': ['id', 'course_id'],
+        'tvp': True,
+    },
+    "stg.Canvas_Modules": {
+        'kolonnar': ['items_count', 'items_url', 'module_id', 'course_id', 'type', 'module_item_id', 'title', 'parent_module_id',
+                     'external_url', 'item_published', 'name', 'published'],
+        'nøkkel': ['module_id', 'module_item_id'],
+        'tvp': True,
+    },
+    "stg.Canvas_History": {
+        'kolonnar': ['visited_at', 'visited_url', 'asset_readable_category', 'user_id'],
+        'nøkkel': [],
+    },
+    "dbo.akv_history_sist_sett": {
+        'kolonnar': ['user_id', 'visited_at'],
+        'nøkkel': ['user_id'],
+    },
+    "dbo.akv_radhash": {
+        'kolonnar': ['tabell', 'nøkkel', 'hash'],
+        'nøkkel': ['tabell', 'nøkkel'],
+    },
+    "dbo.akv_radhash_køyringar": {
+        'kolonnar': ['tabell', 'køyringar'],
+        'nøkkel': ['tabell'],
+    },
+    "dbo.akv_målingar": {
+        'kolonnar': ['køyring', 'steg', 'start', 'sekund', 'rader', 'byte', 'http_kall', 'nye_forsøk', 'feil'],
+        'nøkkel': [],
+    },
+    "dbo.akv_user_id_kobling": {
+        'kolonnar': ['user_id', 'sis_user_id'],
+        'nøkkel': ['user_id'],
+    },
+    "dbo.akv_sist_oppdatert": {
+        'kolonnar': ['tabell', 'sist_oppdatert'],
+        'nøkkel': ['tabell'],
+    },
+}
+akv_bulk_batchstorleik = 10000
+# Kvar akv_radhash_full_kvar-te opplasting til ein tabell med endringssjekk ser vi bort
+# frå dei lagra radhashane og sender alle rader på nytt. Talet er per tabell og uavhengig
+# av kva dagar steget køyrer ('dagar' i akv_steg), så også månadlege steg hoppar over
+# uendra rader.
+akv_radhash_full_kvar = 30
+
+
+def akv_sql_namn(tabell):
+    """
+    Gjer om "stg.Canvas_Users" til "[stg].[Canvas_Users]".
+    """
+    return ".".join(f"[{del_namn}]" for del_namn in tabell.split("."))
+
+
+def akv_bulk_merge(cnxn, tabell, rader, kolonnar=None):
+    """
+    Last opp mange rader til tabell med éin MERGE i staden for éin per rad.
+
+    Radene blir først sende til ein #temp-tabell med fast_executemany, og deretter
+    køyrer vi éin samla MERGE mot måltabellen. Kolonnar og nøkkel er henta frå
+    akv_tabellar; kolonnar kan avgrensast til eit utval (nøkkelen må vere med).
+    Dersom same nøkkel kjem fleire gonger, vinn den siste (slik som med MERGE per rad).
+    Returnerer talet på rader som vart sende til databasen.
+    """
+    with akv_måling(f"sql:{tabell}"):
+        spesifikasjon = akv_tabellar[tabell]
+        nøkkel = spesifikasjon['nøkkel']
+        if kolonnar is None:
+            kolonnar = spesifikasjon['kolonnar']
+        nøkkelindeksar = [kolonnar.index(k) for k in nøkkel]
+        unike = {}
+        for rad in rader:
+            unike[tuple(rad[i] for i in nøkkelindeksar)] = tuple(rad)
+        nye_hashar = {}
+        køyring = None
+        if spesifikasjon.get('endringssjekk'):
+            unike, nye_hashar, køyring = akv_berre_endra(cnxn, tabell, kolonnar, unike)
+        rader = list(unike.values())
+        if not rader:
+            akv_lagre_radhashar(cnxn, tabell, nye_hashar, køyring)
+            return 0
+
+        if akv_sql_lager == 'sqlite':
+            akv_sqlite_upsert(cnxn, tabell, kolonnar, rader)
+        elif spesifikasjon.get('tvp'):
+            akv_bulk_merge_tvp(cnxn, tabell, rader, kolonnar)
+        else:
+            with cnxn.cursor() as cursor:
+                akv_opprett_kjelde(cursor, tabell, kolonnar)
+                insert_query = akv_kjelde_insert(kolonnar)
+                for i in range(0, len(rader), akv_bulk_batchstorleik):
+                    cursor.executemany(insert_query, rader[i:i + akv_bulk_batchstorleik])
+                cursor.execute(akv_merge_query(tabell, kolonnar, "#akv_kjelde"))
+                cursor.execute("DROP TABLE #akv_kjelde")
+            cnxn.commit()
+            logging.debug(f"Har lasta opp {len(rader)} rader til {tabell}")
+        akv_lagre_radhashar(cnxn, tabell, nye_hashar, køyring)
+        akv_tel('rader', len(rader))
+        return len(rader)
+
+
+def akv_radhash(nøkkelverdi, kolonnar, rad):
+    """
+    Returner (nøkkel som tekst, hash av innhaldet) for ei rad, slik dei blir lagra i dbo.akv_radhash.
+    """
+    nøkkeltekst = json.dumps(nøkkelverdi, default=str, ensure_ascii=False)
+    innhald = json.dumps([kolonnar, rad], default=str, ensure_ascii=False)
+    return nøkkeltekst, hashlib.md5(innhald.encode('utf-8')).hexdigest()
+
+
+def akv_hent_radhashar(cnxn, tabell):
+    """
+    Returner (hashar, køyring): ein dict frå nøkkel (som tekst) til hash for radene vi
+    sist sende til tabell, og nummeret på denne opplastinga til tabell (til
+    akv_lagre_radhashar). Lagar dbo.akv_radhash og dbo.akv_radhash_køyringar dersom dei
+    manglar. Kvar akv_radhash_full_kvar-te køyring (eller 'full_kvar' for tabellen) gir
+    vi ein tom dict, slik at alle rader blir sende og eventuelle avvik retta opp.
+    """
+    with cnxn.cursor() as cursor:
+        cursor.execute("""
+            IF OBJECT_ID(N'dbo.akv_radhash', N'U') IS NULL
+            CREATE TABLE [dbo].[akv_radhash] (
+                [tabell] NVARCHAR(128) NOT NULL,
+                [nøkkel] NVARCHAR(450) NOT NULL,
+                [hash] CHAR(32) NOT NULL,
+                PRIMARY KEY ([tabell], [nøkkel])
+            )
+        """)
+        cursor.execute("""
+            IF OBJECT_ID(N'dbo.akv_radhash_køyringar', N'U') IS NULL
+            CREATE TABLE [dbo].[akv_radhash_køyringar] (
+                [tabell] NVARCHAR(128) NOT NULL PRIMARY KEY,
+                [køyringar] INT NOT NULL
+            )
+        """)
+        cnxn.commit()
+        rader = cursor.execute("SELECT [køyringar] FROM [dbo].[akv_radhash_køyringar] WHERE [tabell] = ?", tabell).fetchall()
+        køyring = rader[0][0] if rader else 0
+        if køyring % akv_tabellar[tabell].get('full_kvar', akv_radhash_full_kvar) == 0:
+            logging.debug(f"{tabell}: køyring {køyring}, sender alle rader på nytt")
+            return {}, køyring
+        cursor.execute("SELECT [nøkkel], [hash] FROM [dbo].[akv_radhash] WHERE [tabell] = ?", tabell)
+        return {row[0]: row[1] for row in cursor.fetchall()}, køyring
+
+
+def akv_berre_endra(cnxn, tabell, kolonnar, unike):
+    """
+    Fjern radene i unike (nøkkel -> rad) som er uendra sidan sist, og returner
+    (dei nye eller endra radene, hashane deira, køyring) til akv_lagre_radhashar.
+    """
+    gamle_hashar, køyring = akv_hent_radhashar(cnxn, tabell)
+    endra = {}
+    nye_hashar = {}
+    for nøkkelverdi, rad in unike.items():
+        nøkkeltekst, hash = akv_radhash(nøkkelverdi, kolonnar, rad)
+        if gamle_hashar.get(nøkkeltekst) != hash:
+            endra[nøkkelverdi] = rad
+            nye_hashar[nøkkeltekst] = hash
+    logging.debug(f"{tabell}: {len(unike) - len(endra)} uendra rader blir hoppa over, {len(endra)} er nye eller endra")
+    return endra, nye_hashar, køyring
+
+
+def akv_lagre_radhashar(cnxn, tabell, nye_hashar, køyring=None):
+    """
+    Lagre hashane for radene som no er sende til tabell, og tel opp køyringa
+    (frå akv_hent_radhashar) når opplastinga er ferdig.
+    """
+    if nye_hashar:
+        akv_bulk_merge(cnxn, "dbo.akv_radhash", [(tabell, nøkkeltekst, hash) for nøkkeltekst, hash in nye_hashar.items()])
+    if køyring is not None:
+        akv_bulk_merge(cnxn, "dbo.akv_radhash_køyringar", [(tabell, køyring + 1)])
+
+
+# Prosedyrar (og tabelltypar) som er klare i databasen, per tabell og kolonneutval
+akv_tvp_prosedyrar = {}
+akv_tvp_lås = threading.Lock()
+
+
+def akv_sql_kolonnetypar(cnxn, tabell):
+    """
+    Returner ein dict frå kolonnenamn til SQL-type (t.d. 'nvarchar(255)') for tabell,
+    henta frå INFORMATION_SCHEMA.COLUMNS.
+    """
+    skjema, namn = tabell.split(".") if "." in tabell else ("dbo", tabell)
+    with cnxn.cursor() as cursor:
+        cursor.execute("""
+            SELECT COLUMN_NAME, DATA_TYPE, CHARACTER_MAXIMUM_LENGTH, NUMERIC_PRECISION, NUMERIC_SCALE, DATETIME_PRECISION
+            FROM INFORMATION_SCHEMA.COLUMNS
+            WHERE TABLE_SCHEMA = ? AND TABLE_NAME = ?
+        """, skjema, namn)
+        typar = {}
+        for kolonne, datatype, lengd, presisjon, skala, tidspresisjon in cursor.fetchall():
+            if datatype in ('char', 'nchar', 'varchar', 'nvarchar', 'binary', 'varbinary'):
+                datatype = f"{datatype}({'MAX' if lengd == -1 else lengd})"
+            elif datatype in ('decimal', 'numeric'):
+                datatype = f"{datatype}({presisjon}, {skala})"
+            elif datatype in ('datetime2', 'datetimeoffset', 'time'):
+                datatype = f"{datatype}({tidspresisjon})"
+            typar[kolonne] = datatype
+    return typar
+
+
+def akv_tvp_ddl(tabell, kolonnar, typar):
+    """
+    Lag namn og DDL for tabelltypen og prosedyren som gjer MERGE mot tabell.
+
+    Namna har ein kort hash av kolonnane og typane deira, slik at ein ny versjon
+    blir laga når spesifikasjonen eller måltabellen endrar seg (ein tabelltype kan
+    ikkje endrast medan ein prosedyre brukar han).
+    Returnerer (typenamn, prosedyrenamn, type_ddl, prosedyre_ddl).
+    """
+    definisjon = ", ".join(f"[{k}] {typar[k]} NULL" for k in kolonnar)
+    kort_hash = hashlib.sha1(definisjon.encode('utf-8')).hexdigest()[:8]
+    grunnnamn = tabell.replace(".", "_")
+    typenamn = f"[dbo].[akv_tvp_{grunnnamn}_{kort_hash}]"
+    prosedyrenamn = f"[dbo].[akv_upsert_{grunnnamn}_{kort_hash}]"
+    type_ddl = f"CREATE TYPE {typenamn} AS TABLE ({definisjon})"
+    prosedyre_ddl = f"""
+        CREATE OR ALTER PROCEDURE {prosedyrenamn} @rader {typenamn} READONLY
+        AS
+        BEGIN
+            SET NOCOUNT ON;
+            {akv_merge_query(tabell, kolonnar, "@rader")}
+        END
+    """
+    return typenamn, prosedyrenamn, type_ddl, prosedyre_ddl
+
+
+def akv_opprett_tvp(cnxn, tabell, kolonnar):
+    """
+    Sørg for at tabelltypen og prosedyren for tabell finst, og returner prosedyrenamnet.
+    """
+    with akv_tvp_lås:
+        prosedyre = akv_tvp_prosedyrar.get((tabell, tuple(kolonnar)))
+        if prosedyre is not None:
+            return prosedyre
+        typar = akv_sql_kolonnetypar(cnxn, tabell)
+        typenamn, prosedyre, type_ddl, prosedyre_ddl = akv_tvp_ddl(tabell, kolonnar, typar)
+        with cnxn.cursor() as cursor:
+            if cursor.execute("SELECT TYPE_ID(?)", typenamn).fetchall()[0][0] is None:
+                cursor.execute(type_ddl)
+            cursor.execute(prosedyre_ddl)
+        cnxn.commit()
+        logging.debug(f"Har oppretta {typenamn} og {prosedyre}")
+        akv_tvp_prosedyrar[(tabell, tuple(kolonnar))] = prosedyre
+        return prosedyre
+
+
+def akv_bulk_merge_tvp(cnxn, tabell, rader, kolonnar):
+    """
+    Send radene til ein lagra prosedyre som tabellverdi-parameter (TVP), éin batch per kall,
+    og la prosedyren gjere MERGE på serveren. Radene må allereie vere utan duplikate nøklar.
+    Returnerer talet på rader som vart sende til databasen.
+    """
+    prosedyre = akv_opprett_tvp(cnxn, tabell, kolonnar)
+    with cnxn.cursor() as cursor:
+        for i in range(0, len(rader), akv_bulk_batchstorleik):
+            cursor.execute(f"EXEC {prosedyre} ?", (rader[i:i + akv_bulk_batchstorleik],))
+    cnxn.commit()
+    logging.debug(f"Har lasta opp {len(rader)} rader til {tabell} (TVP)")
+    return len(rader)
+
+
+def akv_bulk_merge_straum(cnxn, tabell, batchar, kolonnar=None, nummererte=False):
+    """
+    Som akv_bulk_merge, men radene kjem som ein straum av batchar (lister med rader).
+
+    Kvar batch blir sendt til #temp-tabellen med ein gong, så databasen kan ta imot
+    medan resten framleis blir henta. Rekkjefølgja blir teken vare på i ekstra
+    kolonnar, slik at den siste rada per nøkkel vinn i MERGE-en til slutt. Med
+    nummererte=True er kvar batch (nr, rader), og det er nr (eit heiltal) og ikkje når
+    batchen kom, som avgjer kva som er sist; då blir resultatet det same sjølv om
+    batchane kjem i vilkårleg rekkjefølgje (t.d. frå akv_FS_sharda_sider).
+    Returnerer talet på rader som vart sende til databasen.
+    """
+    with akv_måling(f"sql:{tabell}"):
+        if kolonnar is None:
+            kolonnar = akv_tabellar[tabell]['kolonnar']
+        nøkkel = akv_tabellar[tabell]['nøkkel']
+        nøkkelindeksar = [kolonnar.index(k) for k in nøkkel]
+        endringssjekk = akv_tabellar[tabell].get('endringssjekk')
+        nye_hashar = {}
+        køyring = None
+        totalt = 0
+        # SQLite har ikkje MERGE, så der går kvar batch rett til tabellen (i rekkjefølgje, så den siste vinn);
+        # nummererte batchar blir samla opp og sende i rekkjefølgja til nr til slutt
+        sqlite = akv_sql_lager == 'sqlite'
+        sqlite_batchar = []
+        with cnxn.cursor() as cursor:
+            if not sqlite:
+                akv_opprett_kjelde(cursor, tabell, kolonnar)
+                cursor.execute("ALTER TABLE #akv_kjelde ADD [akv_batch] BIGINT, [akv_nr] BIGINT")
+                insert_query = akv_kjelde_insert(kolonnar + ['akv_batch', 'akv_nr'])
+            if endringssjekk:
+                gamle_hashar, køyring = akv_hent_radhashar(cnxn, tabell)
+            for batch_nr, batch in enumerate(batchar):
+                if nummererte:
+                    batch_nr, batch = batch
+                if endringssjekk:
+                    endra = []
+                    for rad in batch:
+                        nøkkeltekst, hash = akv_radhash(tuple(rad[i] for i in nøkkelindeksar), kolonnar, tuple(rad))
+                        if gamle_hashar.get(nøkkeltekst) != hash:
+                            endra.append(rad)
+                            nye_hashar[nøkkeltekst] = hash
+                    batch = endra
+                if not batch:
+                    continue
+                if sqlite and nummererte:
+                    sqlite_batchar.append((batch_nr, [tuple(rad) for rad in batch]))
+                elif sqlite:
+                    akv_sqlite_upsert(cnxn, tabell, kolonnar, [tuple(rad) for rad in batch])
+                else:
+                    cursor.executemany(insert_query, [tuple(rad) + (batch_nr, i) for i, rad in enumerate(batch)])
+                totalt += len(batch)
+            for _, batch in sorted(sqlite_batchar, key=lambda b: b[0]):
+                akv_sqlite_upsert(cnxn, tabell, kolonnar, batch)
+            kolonneliste = ", ".join(f"[{k}]" for k in kolonnar)
+            siste_per_nøkkel = f"""(
+                SELECT {kolonneliste} FROM (
+                    SELECT *, ROW_NUMBER() OVER (PARTITION BY {", ".join(f"[{k}]" for k in nøkkel)} ORDER BY [akv_batch] DESC, [akv_nr] DESC) AS [akv_rad]
+                    FROM #akv_kjelde
+                ) AS k WHERE [akv_rad] = 1
+            )"""
+            if not sqlite:
+                if totalt:
+                    cursor.execute(akv_merge_query(tabell, kolonnar, siste_per_nøkkel))
+                cursor.execute("DROP TABLE #akv_kjelde")
+        cnxn.commit()
+        akv_lagre_radhashar(cnxn, tabell, nye_hashar, køyring)
+        logging.debug(f"Har lasta opp {totalt} rader til {tabell}")
+        akv_tel('rader', totalt)
+        return totalt
+
+
+def akv_opprett_kjelde(cursor, tabell, kolonnar):
+    """
+    Lag ein tom #akv_kjelde med dei gitte kolonnane frå tabell, klar for fast_executemany.
+    """
+    cursor.execute("DROP TABLE IF EXISTS #akv_kjelde")
+    # TOP 0 ... INTO gir #temp-tabellen same kolonnetypar som måltabellen
+    cursor.execute(f"SELECT TOP 0 {', '.join(f'[{k}]' for k in kolonnar)} INTO #akv_kjelde FROM {akv_sql_namn(tabell)}")
+    cursor.fast_executemany = True
+
+
+def akv_kjelde_insert(kolonnar):
+    """
+    Lag INSERT-setninga for å fylle #akv_kjelde med dei gitte kolonnane.
+    """
+    return f"INSERT INTO #akv_kjelde ({', '.join(f'[{k}]' for k in kolonnar)}) VALUES ({', '.join('?' for _ in kolonnar)})"
+
+
+def akv_merge_query(tabell, kolonnar, kjelde):
+    """
+    Lag MERGE-setninga som oppdaterer tabell frå kjelde (ein tabell eller ein delspørjing).
+    """
+    nøkkel = akv_tabellar[tabell]['nøkkel']
+    kolonneliste = ", ".join(f"[{k}]" for k in kolonnar)
+    oppdater = [k for k in kolonnar if k not in nøkkel]
+    return f"""
+        MERGE INTO {akv_sql_namn(tabell)} WITH (HOLDLOCK) AS t
+        USING {kjelde} AS s
+        ON {" AND ".join(f"t.[{k}] = s.[{k}]" for k in nøkkel)}
+        {"WHEN MATCHED THEN UPDATE SET " + ", ".join(f"t.[{k}] = s.[{k}]" for k in oppdater) if oppdater else ""}
+        WHEN NOT MATCHED THEN
+            INSERT ({kolonneliste})
+            VALUES ({", ".join(f"s.[{k}]" for k in kolonnar)});
+    """
+
+
+akv_røyr_kø_storleik = 4
+
+
+def akv_røyr(kjelde, funksjon=None):
+    """
+    Køyr kjelde (ein iterator) i ein eigen tråd og gi elementa vidare gjennom ein
+    avgrensa kø, eventuelt etter å ha sendt dei gjennom funksjon.
+
+    Kvart ledd i ein røyrleidning kan dermed arbeide samstundes med dei andre: når
+    køen er full, ventar tråden til neste ledd har teke unna (mottrykk). Feil i
+    tråden blir kasta vidare til den som les.
+    """
+    kø = queue.Queue(maxsize=akv_røyr_kø_storleik)
+    stopp = threading.Event()
+    ferdig = object()
+
+    def legg_i_kø(element):
+        while not stopp.is_set():
+            try:
+                kø.put(element, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def køyr():
+        try:
+            for element in kjelde:
+                if stopp.is_set():
+                    return
+                legg_i_kø(funksjon(element) if funksjon else element)
+        except Exception as feil:
+            legg_i_kø(feil)
+        finally:
+            legg_i_kø(ferdig)
+
+    tråd = threading.Thread(target=akv_med_kontekst(køyr), daemon=True)
+    tråd.start()
+    try:
+        while True:
+            element = kø.get()
+            if element is ferdig:
+                return
+            if isinstance(element, Exception):
+                raise element
+            yield element
+    finally:
+        stopp.set()
+
+
+def akv_bulk_insert(cnxn, tabell, rader):
+    """
+    Legg til mange rader i tabell med fast_executemany, utan MERGE.
+    Meint for stg-tabellar utan nøkkel (nøkkel er tom i akv_tabellar).
+    Returnerer talet på rader som vart sende til databasen.
+    """
+    with akv_måling(f"sql:{tabell}"):
+        if not rader:
+            return 0
+        kolonnar = akv_tabellar[tabell]['kolonnar']
+        kolonneliste = ", ".join(f"[{k}]" for k in kolonnar)
+        insert_query = f"INSERT INTO {akv_sql_namn(tabell)} ({kolonneliste}) VALUES ({', '.join('?' for _ in kolonnar)})"
+        with cnxn.cursor() as cursor:
+            cursor.fast_executemany = True
+            for i in range(0, len(rader), akv_bulk_batchstorleik):
+                cursor.executemany(insert_query, rader[i:i + akv_bulk_batchstorleik])
+        cnxn.commit()
+        logging.debug(f"Har lagt til {len(rader)} rader i {tabell}")
+        akv_tel('rader', len(rader))
+        return len(rader)
+
+
+akv_canvas_base_url = "https://hvl.instructure.com"
+akv_canvas_maks_parallelle = 16
+akv_canvas_sesjon_data = {'sesjon': None}
+akv_canvas_sesjon_lås = threading.Lock()
+
+
+def akv_canvas_sesjon():
+    """
+    Returner ein felles requests.Session mot Canvas, slik at alle kall gjenbrukar
+    dei same TLS-tilkoplingane (opptil akv_canvas_maks_parallelle samtidig).
+    """
+    with akv_canvas_sesjon_lås:
+        if akv_canvas_sesjon_data['sesjon'] is None:
+            sesjon = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=akv_canvas_maks_parallelle)
+            sesjon.mount("https://", adapter)
+            sesjon.headers['Authorization'] = 'Bearer ' + os.environ["tokenCanvas"]
+            akv_canvas_sesjon_data['sesjon'] = sesjon
+        return akv_canvas_sesjon_data['sesjon']
+
+
+akv_canvas_regulator = {'grense': 4, 'i_gang': 0, 'pause_til': 0.0, 'gjenverande': None, 'kostnad': None}
+akv_canvas_regulator_vilkår = threading.Condition()
+akv_canvas_bøtte_låg = 150.0
+akv_canvas_bøtte_høg = 400.0
+akv_canvas_maks_forsøk = 5
+
+
+def akv_canvas_inn():
+    """
+    Vent til regulatoren slepp eit nytt kall til Canvas og registrer det som i gang.
+    """
+    with akv_canvas_regulator_vilkår:
+        while True:
+            pause = akv_canvas_regulator['pause_til'] - time.monotonic()
+            if pause > 0:
+                akv_canvas_regulator_vilkår.wait(pause)
+            elif akv_canvas_regulator['i_gang'] >= akv_canvas_regulator['grense']:
+                akv_canvas_regulator_vilkår.wait()
+            else:
+                akv_canvas_regulator['i_gang'] += 1
+                return
+
+
+def akv_canvas_ut(respons, forsøk=0):
+    """
+    Meld frå om at eit Canvas-kall er ferdig og juster kor mange kall som kan vere i gang.
+
+    Canvas gir att kor mykje som er igjen i bøtta (X-Rate-Limit-Remaining) og kva kallet
+    kosta (X-Request-Cost). Vi aukar grensa med ein når bøtta er godt fylt, minkar ho når
+    bøtta nærmar seg tom, og halverer ho og tek pause dersom Canvas svarar 403 fordi
+    grensa er nådd. Returnerer True dersom kallet vart strupa og bør prøvast på nytt.
+    """
+    strupa = respons is not None and akv_canvas_er_strupa(respons)
+    with akv_canvas_regulator_vilkår:
+        akv_canvas_regulator['i_gang'] -= 1
+        if respons is not None:
+            try:
+                akv_canvas_regulator['gjenverande'] = float(respons.headers['X-Rate-Limit-Remaining'])
+                akv_canvas_regulator['kostnad'] = float(respons.headers['X-Request-Cost'])
+            except (KeyError, ValueError):
+                pass
+        gjenverande = akv_canvas_regulator['gjenverande']
+        # Det må vere plass i bøtta til at alle kall i gang kan koste like mykje som det siste
+        låg = max(akv_canvas_bøtte_låg, 2 * akv_canvas_regulator['grense'] * (akv_canvas_regulator['kostnad'] or 0))
+        if strupa:
+            akv_canvas_regulator['grense'] = max(1, akv_canvas_regulator['grense'] // 2)
+            pause = min(2 ** forsøk, 30)
+            akv_canvas_regulator['pause_til'] = max(akv_canvas_regulator['pause_til'], time.monotonic() + pause)
+            logging.warning(f"Canvas strupar kall, ventar {pause} s og set grensa til {akv_canvas_regulator['grense']}")
+        elif gjenverande is not None and gjenverande < låg:
+            akv_canvas_regulator['grense'] = max(1, akv_canvas_regulator['grense'] - 1)
+        elif gjenverande is not None and gjenverande > akv_canvas_bøtte_høg:
+            akv_canvas_regulator['grense'] = min(akv_canvas_maks_parallelle, akv_canvas_regulator['grense'] + 1)
+        akv_canvas_regulator_vilkår.notify_all()
+    return strupa
+
+
+def akv_canvas_er_strupa(respons):
+    """
+    Sjekk om Canvas har avvist kallet fordi grensa for førespurnader er nådd.
+    """
+    return respons.status_code == 403 and 'Rate Limit Exceeded' in respons.text
+
+
+def akv_canvas_request(metode, url, **kwargs):
+    """
+    Send eit kall til Canvas (REST eller GraphQL) gjennom den felles økta og regulatoren.
+    Kall som vert strupa, vert prøvd på nytt opptil akv_canvas_maks_forsøk gonger.
+    """
+    sesjon = akv_canvas_sesjon()
+    for forsøk in range(akv_canvas_maks_forsøk):
+        akv_canvas_inn()
+        respons = None
+        try:
+            respons = akv_http(metode, url, sesjon=sesjon, forsøk=forsøk, **kwargs)
+        finally:
+            strupa = akv_canvas_ut(respons, forsøk)
+        if not strupa:
+            return respons
+    return respons
+
+
 def akv_query_canvas_graphql(query, variable):
     """
     Send a GraphQL query to Canvas and return the response.
@@ -90,23 +1235,198 @@ def akv_query_canvas_graphql(query, variable):
     :rtype: dict
     :raises Exception: if the request fails
     """
-    hode = {
-        'Authorization': f'Bearer {os.environ["tokenCanvas"]}',
-    }
-    GraphQLurl = "https://hvl.instructure.com/api/graphql/"
-    svar = requests.post(
-        GraphQLurl, 
+    GraphQLurl = f"{akv_canvas_base_url}/api/graphql/"
+    svar = akv_canvas_request(
+        "POST",
+        GraphQLurl,
         json = {
             'query': query,
             'variables': variable
-        },
-        headers=hode)
+        })
     if 200 <= svar.status_code < 300:
         return svar.json()
     else:
         raise Exception(f"Feil i spørjing med kode {svar.status_code}. {query}")
 
 
+akv_canvas_graphql_maks_alias = 50
+akv_canvas_graphql_maks_kostnad = 5000
+akv_canvas_graphql_standardkostnad = 50
+akv_canvas_graphql_sidestorleik = 100
+
+
+def akv_canvas_graphql_batchar(idar, kostnad=None):
+    """
+    Del idar i batchar for akv_canvas_graphql_samla.
+
+    kostnad er ein dict med venta tal på nodar i svaret per id (t.d. tal på påmeldingar
+    i emnet frå førre køyring); ukjende idar får akv_canvas_graphql_standardkostnad.
+    Ein batch er full når han har akv_canvas_graphql_maks_alias idar eller summen av
+    kostnaden ville gått over akv_canvas_graphql_maks_kostnad.
+    """
+    kostnad = kostnad or {}
+    batchar = []
+    batch, sum_kostnad = [], 0
+    for id in idar:
+        k = kostnad.get(id) or akv_canvas_graphql_standardkostnad
+        if batch and (len(batch) >= akv_canvas_graphql_maks_alias or sum_kostnad + k > akv_canvas_graphql_maks_kostnad):
+            batchar.append(batch)
+            batch, sum_kostnad = [], 0
+        batch.append(id)
+        sum_kostnad += k
+    if batch:
+        batchar.append(batch)
+    return batchar
+
+
+def akv_canvas_graphql_samla(felt, type_namn, utval, idar, kostnad=None):
+    """
+    Hent same utval for mange objekt med få GraphQL-kall, ved hjelp av alias.
+
+    Kvart kall spør etter c0: felt(id: $c0) { ...Utval }, c1: ... for ein heil batch
+    (sjå akv_canvas_graphql_batchar), og batchane blir sende parallelt gjennom
+    akv_canvas_request. type_namn er GraphQL-typen utvalet gjeld (t.d. 'Course').
+
+    Dersom utvalet har ei tilkopling med (first: $antal, after: $start) og
+    pageInfo { endCursor hasNextPage }, kjem første side for alle objekta i batchane,
+    og berre tilkoplingane som har fleire sider blir følgde vidare, parallelt og med
+    eitt kall per side. Nodane frå dei vidare sidene blir lagde til i svaret.
+    Returnerer ein dict frå id til svaret for objektet (None dersom Canvas ikkje gav noko).
+    """
+    blar = '$start' in utval
+    ekstra_parametrar = "$antal: Int, $start: String, " if blar else ""
+    ekstra_variable = {'antal': akv_canvas_graphql_sidestorleik, 'start': None} if blar else {}
+    if blar and kostnad:
+        kostnad = {id: min(k, akv_canvas_graphql_sidestorleik) for id, k in kostnad.items()}
+
+    def hent(batch):
+        parametrar = ekstra_parametrar + ", ".join(f"$c{i}: ID!" for i in range(len(batch)))
+        alias = "\n".join(f"    c{i}: {felt}(id: $c{i}) {{ ...Utval }}" for i in range(len(batch)))
+        query = f"query Samla({parametrar}) {{\n{alias}\n}}\nfragment Utval on {type_namn} {utval}"
+        try:
+            svar = akv_query_canvas_graphql(query, {**ekstra_variable, **{f"c{i}": str(id) for i, id in enumerate(batch)}})
+        except Exception as feil:
+            logging.error(f"Feil ved henting av {len(batch)} {felt}: {feil}")
+            return {id: None for id in batch}
+        if svar.get('errors'):
+            logging.warning(f"Canvas GraphQL gav feil for {len(batch)} {felt}: {svar['errors']}")
+        data = svar.get('data') or {}
+        return {id: data.get(f"c{i}") for i, id in enumerate(batch)}
+
+    batchar = akv_canvas_graphql_batchar(idar, kostnad)
+    logging.debug(f"Hentar {len(idar)} {felt} i {len(batchar)} GraphQL-kall")
+    resultat = {}
+    with ThreadPoolExecutor(max_workers=akv_canvas_maks_parallelle) as pool:
+        for del_resultat in pool.map(akv_med_kontekst(hent), batchar):
+            resultat.update(del_resultat)
+
+        if blar:
+            query_éin = f"query Vidare($id: ID!, $antal: Int, $start: String) {{\n    {felt}(id: $id) {{ ...Utval }}\n}}\nfragment Utval on {type_namn} {utval}"
+
+            def bla_vidare(id, sti, tilkopling):
+                nodar = []
+                for side in akv_graphql_sider(query_éin, {'id': str(id)}, f"{felt}.{sti}", akv_canvas_graphql_sidestorleik,
+                                              spør=akv_query_canvas_graphql, start=tilkopling['pageInfo']['endCursor']):
+                    nodar.extend(side)
+                return tilkopling, nodar
+
+            vidare = [pool.submit(akv_med_kontekst(bla_vidare), id, sti, tilkopling)
+                      for id, objekt in resultat.items() if objekt is not None
+                      for sti, tilkopling in akv_graphql_tilkoplingar(objekt)
+                      if tilkopling['pageInfo'].get('hasNextPage')]
+            if vidare:
+                logging.debug(f"Følgjer {len(vidare)} tilkoplingar med fleire sider")
+            for framtid in as_completed(vidare):
+                try:
+                    tilkopling, nodar = framtid.result()
+                except Exception as feil:
+                    logging.error(f"Feil ved henting av fleire sider for {felt}: {feil}")
+                    continue
+                tilkopling['nodes'].extend(nodar)
+                tilkopling['pageInfo']['hasNextPage'] = False
+    return resultat
+
+
+def akv_graphql_tilkoplingar(objekt, sti=''):
+    """
+    Finn tilkoplingane (dict med nodes og pageInfo) i eit GraphQL-svar, og gi (sti, tilkopling).
+    Vi leitar berre gjennom objekt, ikkje inne i lister.
+    """
+    for nøkkel, verdi in objekt.items():
+        if not isinstance(verdi, dict):
+            continue
+        verdisti = f"{sti}.{nøkkel}" if sti else nøkkel
+        if 'nodes' in verdi and isinstance(verdi.get('pageInfo'), dict):
+            yield verdisti, verdi
+        else:
+            yield from akv_graphql_tilkoplingar(verdi, verdisti)
+
+
+def akv_canvas_sidenummer(url):
+    """
+    Returner page-parameteren i ein Canvas-URL som heiltal, eller None dersom han
+    manglar eller er eit bokmerke (som Canvas brukar for lister utan fast rekkjefølgje).
+    """
+    try:
+        return int(parse_qs(urlparse(url).query)['page'][0])
+    except (KeyError, ValueError):
+        return None
+
+
+def akv_canvas_sider(sti, params=None, nøkkel=None):
+    """
+    Hent alle sidene frå eit Canvas REST-endepunkt og gi elementa etter kvart.
+
+    Vi følgjer Link: rel="next". Når Canvas oppgir rel="last" med sidenummer, hentar vi
+    resten av sidene parallelt (regulert av akv_canvas_request, og aldri meir enn
+    akv_canvas_maks_parallelle sider føre lesaren), men gir dei framleis i rett rekkjefølgje. nøkkel brukast når lista ligg inni eit objekt, t.d. 'enrollment_terms'.
+    Kastar requests.exceptions.HTTPError dersom Canvas svarar med feil.
+    """
+    def hent(url, params=None):
+        respons = akv_canvas_request("GET", url, params=params)
+        respons.raise_for_status()
+        return respons
+
+    def element(respons):
+        data = respons.json()
+        return data[nøkkel] if nøkkel else data
+
+    respons = hent(f"{akv_canvas_base_url}{sti}", params)
+    yield from element(respons)
+    neste = respons.links.get('next', {}).get('url')
+    siste = respons.links.get('last', {}).get('url')
+    neste_nr = akv_canvas_sidenummer(neste) if neste else None
+    siste_nr = akv_canvas_sidenummer(siste) if siste else None
+    if neste_nr is not None and siste_nr is not None:
+        sidemal = urlparse(neste)
+        parametrar = parse_qs(sidemal.query)
+        urlar = []
+        for nr in range(neste_nr, siste_nr + 1):
+            parametrar['page'] = [str(nr)]
+            urlar.append(sidemal._replace(query=urlencode(parametrar, doseq=True)).geturl())
+        # Glidande vindauge: berre akv_canvas_maks_parallelle sider er bestilte om gongen,
+        # så ein som sluttar å lese frå generatoren, stoppar òg nye førespurnader
+        hent_i_kontekst = akv_med_kontekst(hent)
+        ventande = deque()
+        pool = ThreadPoolExecutor(max_workers=akv_canvas_maks_parallelle)
+        try:
+            for url in urlar:
+                if len(ventande) >= akv_canvas_maks_parallelle:
+                    yield from element(ventande.popleft().result())
+                ventande.append(pool.submit(hent_i_kontekst, url))
+            while ventande:
+                yield from element(ventande.popleft().result())
+        finally:
+            for framtid in ventande:
+                framtid.cancel()
+            pool.shutdown(wait=True)
+    else:
+        while neste:
+            respons = hent(neste)
+            yield from element(respons)
+            neste = respons.links.get('next', {}).get('url')
+
+
 def akv_query_FS_graphql(query, variable):
     hode = {
         'Accept': 'application/json;version=1',
@@ -114,7 +1434,8 @@ def akv_query_FS_graphql(query, variable):
         "Feature-Flags": "beta, experimental"
     }
     GraphQLurl = "https://api.fellesstudentsystem.no/graphql/"
-    svar = requests.post(
+    svar = akv_http(
+        "POST",
         GraphQLurl, 
         json = {
             'query': query,
@@ -127,112 +1448,689 @@ def akv_query_FS_graphql(query, variable):
         return {}
 
 
-def akv_hent_CD2_access_token():
-    be_om_access_token = requests.request(
-        "POST",
-        f"{CD2_base_url}/ids/auth/login",
-        data={'grant_type': 'client_credentials'},
-        auth=(CD2_client_id, CD2_client_secret)
-        )
-    if be_om_access_token.status_code == 200:
-        CD2_access_token = be_om_access_token.json()['access_token']
-        return CD2_access_token
+class GraphQLFeil(Exception):
+    """Ugyldig svar frå eit GraphQL-API (FS eller Canvas)."""
+
+
+akv_FS_maks_parallelle = 4
+akv_FS_studieprogram_per_shard = 10
+
+
+def akv_graphql_sider(query, variable, sti, antal_per_side, spør=None, start=None):
+    """
+    Bla gjennom alle sidene av ei GraphQL-spørjing og gi nodane side for side.
+
+    sti peikar på tilkoplinga i svaret, med punktum mellom ledda (t.d. 'emner' eller
+    'course.enrollmentsConnection'). Spørjinga må ta imot $antal og $start og be om
+    pageInfo { endCursor hasNextPage }. spør er funksjonen som sender spørjinga
+    (standard akv_query_FS_graphql), og start er cursoren vi byrjar etter.
+    Kastar GraphQLFeil ved ugyldig svar.
+    """
+    spør = spør or akv_query_FS_graphql
+    hent_tilkopling = akv_feltsti('data.' + sti)
+    n = 0
+    while True:
+        n += 1
+        tilkopling = hent_tilkopling(spør(query, {**variable, 'antal': antal_per_side, 'start': start}))
+        try:
+            nodar = tilkopling['nodes']
+            side_info = tilkopling['pageInfo']
+        except (KeyError, TypeError):
+            raise GraphQLFeil(f"Feil i henting av data ({sti}, side {n}).")
+        logging.debug(f"Henta side {n} av {sti} ({len(nodar)} linjer)")
+        yield nodar
+        if not side_info['hasNextPage']:
+            return
+        start = side_info['endCursor']
+
+
+def akv_feltsti(sti, standard=None, påkravd=False):
+    """
+    Lag ein funksjon som hentar feltet sti (t.d. 'kull.termin.arstall') frå ein node.
+    Manglar eit ledd, eller er det None, gir funksjonen standard i staden. Med
+    påkravd=True kastar han KeyError/TypeError i staden, slik at den som kallar kan
+    hoppe over noden; eit siste ledd som er None, blir då gitt som None.
+    """
+    nøklar = tuple(sti.split('.'))
+
+    def hent(node):
+        if påkravd:
+            for nøkkel in nøklar:
+                node = node[nøkkel]
+            return node
+        try:
+            for nøkkel in nøklar:
+                node = node[nøkkel]
+        except (KeyError, TypeError, IndexError):
+            return standard
+        return standard if node is None else node
+    return hent
+
+
+def akv_radhentar(felt, påkravd=False):
+    """
+    Lag ein funksjon som gjer om ein node til ein tuple med dei gitte felta.
+
+    felt er ei liste med stiar (sjå akv_feltsti), eventuelt som (sti, standard).
+    Med påkravd=True blir stiane utan standard påkravde (sjå akv_feltsti).
+    Stiane blir tolka éin gong, slik at kvar rad berre kostar oppslaga.
+    """
+    hentarar = [akv_feltsti(f, påkravd=påkravd) if isinstance(f, str) else akv_feltsti(*f) for f in felt]
+
+    def hent(node):
+        return tuple(h(node) for h in hentarar)
+    return hent
+
+
+def akv_FS_programstudieretter_tal(studieprogramkodar=None):
+    """
+    Returner totalCount for dei aktive programStudieretter vi hentar (avgrensa til
+    studieprogramkodar om dei er gitt), eller None dersom FS ikkje gir noko tal.
+    """
+    query = """
+    query ProgramStudieretterTal($studieprogramkodar: [String!]) {
+        programStudieretter(
+            filter: {eierOrganisasjonskode: "0203", aktivStatus: AKTIV, studieprogramkoder: $studieprogramkodar},
+            first: 1) {
+            totalCount
+        }
+    }
+    """
+    respons = akv_query_FS_graphql(query, {'studieprogramkodar': studieprogramkodar})
+    try:
+        return respons['data']['programStudieretter']['totalCount']
+    except (KeyError, TypeError):
+        logging.warning(f"Fekk ikkje totalCount for programStudieretter: {respons.get('errors')}")
+        return None
+
+
+def akv_FS_sharda_sider(query, shardar, sti, antal_per_side):
+    """
+    Bla gjennom fleire uavhengige delar (shardar) av same FS-spørjing samstundes.
+
+    shardar er ei liste med variablar, éin per del (t.d. kvar sitt utval av
+    studieprogramkodar). Kvar del har sin eigen cursor, og opptil akv_FS_maks_parallelle
+    delar blir henta parallelt. Sidene blir gitt etter kvart som dei kjem, i vilkårleg
+    rekkjefølgje, som (nr, nodar), der nr veks med delen og sida i delen, slik at
+    (nr, nodar) kan gå rett til akv_bulk_merge_straum(..., nummererte=True).
+    sti og antal_per_side er som i akv_graphql_sider.
+    Feil i ein del blir kasta vidare når han blir oppdaga.
+    """
+    kø = queue.Queue(maxsize=2 * akv_FS_maks_parallelle)
+    stopp = threading.Event()
+    ferdig = object()
+
+    def legg_i_kø(element):
+        while not stopp.is_set():
+            try:
+                kø.put(element, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def hent(del_nr, variable):
+        try:
+            for side_nr, nodar in enumerate(akv_graphql_sider(query, variable, sti, antal_per_side)):
+                if stopp.is_set():
+                    return
+                legg_i_kø(((del_nr << 32) + side_nr, nodar))
+        except Exception as feil:
+            legg_i_kø(feil)
+        finally:
+            legg_i_kø(ferdig)
+
+    with ThreadPoolExecutor(max_workers=akv_FS_maks_parallelle) as pool:
+        for del_nr, variable in enumerate(shardar):
+            pool.submit(akv_med_kontekst(hent), del_nr, variable)
+        try:
+            att = len(shardar)
+            while att:
+                element = kø.get()
+                if element is ferdig:
+                    att -= 1
+                elif isinstance(element, Exception):
+                    raise element
+                else:
+                    yield element
+        finally:
+            stopp.set()
+
+
+class CD2Feil(Exception):
+    """Feil i kommunikasjonen med Canvas Data 2."""
+
+
+class CD2TokenFeil(CD2Feil):
+    """Klarte ikkje å skaffe access_token frå Canvas Data 2."""
+
+
+# Access_token til CD2, delt av alle trådar i prosessen
+akv_CD2_token = {'token': None, 'utløper': 0.0, 'margin': 0.0, 'fornying': None}
+akv_CD2_token_lås = threading.Lock()
+akv_CD2_token_margin = 120
+
+
+def akv_hent_CD2_access_token(tving=False):
+    """
+    Returner eit gyldig access_token til CD2. Tokenet blir gjenbrukt til det er
+    akv_CD2_token_margin sekund (men aldri meir enn halve levetida) att, og blir då
+    fornya i bakgrunnen.
+    Med tving=True hentar vi nytt token uansett (t.d. etter 401 frå CD2).
+    Kastar CD2TokenFeil dersom vi ikkje får nytt token.
+    """
+    with akv_CD2_token_lås:
+        if not tving and akv_CD2_token['token'] and time.time() < akv_CD2_token['utløper'] - akv_CD2_token['margin']:
+            return akv_CD2_token['token']
+        try:
+            with akv_måling("auth"):
+                be_om_access_token = akv_http(
+                    "POST",
+                    f"{CD2_base_url}/ids/auth/login",
+                    data={'grant_type': 'client_credentials'},
+                    auth=(CD2_client_id, CD2_client_secret)
+                    )
+        except requests.exceptions.RequestException as exc:
+            raise CD2TokenFeil(f"Klarte ikkje å skaffe access_token: {exc}") from exc
+        if be_om_access_token.status_code != 200:
+            feilmelding = f"Klarte ikkje å skaffe access_token, feil {be_om_access_token.status_code}"
+            logging.error(feilmelding)
+            raise CD2TokenFeil(feilmelding)
+        svar = be_om_access_token.json()
+        levetid = svar.get('expires_in', 3600)
+        akv_CD2_token['token'] = svar['access_token']
+        akv_CD2_token['utløper'] = time.time() + levetid
+        # Med kort levetid ville heile marginen gjere at tokenet aldri blir gjenbrukt,
+        # og at fornyinga går kvart sekund
+        akv_CD2_token['margin'] = min(akv_CD2_token_margin, levetid / 2)
+        if akv_CD2_token['fornying'] is not None:
+            akv_CD2_token['fornying'].cancel()
+        # Fornyinga høyrer til køyringa som henta tokenet, så målinga av henne hamnar der
+        fornying = threading.Timer(max(levetid - akv_CD2_token['margin'], 1), akv_med_kontekst(akv_forny_CD2_access_token))
+        fornying.daemon = True
+        fornying.start()
+        akv_CD2_token['fornying'] = fornying
+        logging.debug(f"Henta nytt access_token til CD2, gyldig i {levetid} s")
+        return akv_CD2_token['token']
+
+
+def akv_forny_CD2_access_token():
+    """
+    Forny access_token i bakgrunnen før det går ut.
+    """
+    try:
+        akv_hent_CD2_access_token(tving=True)
+    except CD2TokenFeil:
+        logging.exception("Klarte ikkje å fornye access_token i bakgrunnen")
+
+
+def akv_stopp_CD2_fornying():
+    """
+    Stopp fornyinga av access_token i bakgrunnen når køyringa er ferdig, så ho ikkje
+    held fram i ein Functions-vert som lever vidare. Neste køyring hentar nytt token.
+    """
+    with akv_CD2_token_lås:
+        if akv_CD2_token['fornying'] is not None:
+            akv_CD2_token['fornying'].cancel()
+        akv_CD2_token.update({'token': None, 'utløper': 0.0, 'margin': 0.0, 'fornying': None})
+
+
+def akv_CD2_request(metode, requesturl, **kwargs):
+    """
+    Send ein førespurnad til CD2 med gjeldande access_token. Får vi 401, hentar
+    vi nytt token og prøver éin gong til.
+    """
+    headers = {'x-instauth': akv_hent_CD2_access_token(), 'Content-Type': 'text/plain'}
+    respons = akv_http(metode, requesturl, headers=headers, **kwargs)
+    if respons.status_code == 401:
+        headers['x-instauth'] = akv_hent_CD2_access_token(tving=True)
+        respons = akv_http(metode, requesturl, forsøk=1, headers=headers, **kwargs)
+    return respons
+
+
+# Førehandssignerte URL-ar til CD2-filer: objekt-id -> {'url': ..., 'utløper': ...}
+akv_CD2_urlar = {}
+akv_CD2_urlar_lås = threading.Lock()
+
+
+def akv_CD2_url_utløper(url):
+    """
+    Finn tidspunktet (time.time()) då ein førehandssignert S3-URL sluttar å vere gyldig.
+    Dersom URL-en ikkje seier noko om det, reknar vi med 15 minutt.
+    """
+    parametrar = parse_qs(urlparse(url).query)
+    try:
+        signert = datetime.strptime(parametrar['X-Amz-Date'][0], "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
+        return signert.timestamp() + int(parametrar['X-Amz-Expires'][0])
+    except (KeyError, ValueError):
+        return time.time() + 15*60
+
+
+def akv_hent_CD2_urlar(filar):
+    """
+    Hent URL-ane til alle filene i ein CD2-jobb med eitt kall til /dap/object/url
+    og legg dei i akv_CD2_urlar.
+    """
+    requesturl = f"{CD2_base_url}/dap/object/url"
+    r4 = akv_CD2_request("POST", requesturl, data=json.dumps(filar))
+    r4.raise_for_status()
+    for objekt_id, oppføring in r4.json()['urls'].items():
+        akv_CD2_urlar[objekt_id] = {'url': oppføring['url'], 'utløper': akv_CD2_url_utløper(oppføring['url'])}
+    logging.debug(f"Henta {len(r4.json()['urls'])} URL-ar frå CD2")
+
+
+def akv_hent_CD2_url(innfil, filar):
+    """
+    Returner URL-en til fila innfil frå akv_CD2_urlar. Berre dersom URL-en manglar
+    eller er i ferd med å gå ut, hentar vi URL-ane for heile jobben (filar) på nytt.
+    """
+    with akv_CD2_urlar_lås:
+        oppføring = akv_CD2_urlar.get(innfil)
+        if oppføring is None or oppføring['utløper'] - 60 < time.time():
+            akv_hent_CD2_urlar(filar)
+            oppføring = akv_CD2_urlar[innfil]
+    return oppføring['url']
+
+
+def akv_les_CD2_parquet(buffer):
+    """
+    Les ei parquet-fil frå CD2 med typane i behald. Dei nøsta key/value/meta-kolonnane
+    blir flata ut til 'key.id', 'value.user_id' osv., same namn som i CSV-filene, og
+    heiltal med manglande verdiar blir Int64 i staden for float med NaN.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    tabell = pq.read_table(buffer)
+    while any(pa.types.is_struct(felt.type) for felt in tabell.schema):
+        tabell = tabell.flatten()
+    heiltal = {pa.int8(): pd.Int8Dtype(), pa.int16(): pd.Int16Dtype(), pa.int32(): pd.Int32Dtype(), pa.int64(): pd.Int64Dtype()}
+    return tabell.to_pandas(types_mapper=heiltal.get)
+
+
+def akv_les_CD2_jsonl(utpakka_fil):
+    """
+    Les ei utpakka jsonl-fil frå CD2 linje for linje. Kolonnane får same namn som i
+    CSV-filene, og tidspunkt (kolonnar som sluttar på _at) blir gjort om til datetime.
+    """
+    df = pd.json_normalize([json.loads(linje) for linje in utpakka_fil if linje.strip()])
+    for kolonne in df.columns:
+        if kolonne.endswith('_at'):
+            df[kolonne] = pd.to_datetime(df[kolonne], utc=True, errors='coerce')
+    return df
+
+
+def akv_les_CD2_fil(url, format="csv"):
+    """
+    Last ned ei fil frå CD2 og les ho rett inn i ein DataFrame. CSV- og jsonl-filer
+    blir pakka ut medan dei blir lasta ned, så verken den komprimerte eller den
+    utpakka teksten blir halden i minnet. Parquet-filer treng tilfeldig tilgang og
+    blir difor lasta ned heilt før dei blir lesne. Returnerer (dataramme, byte, sekund).
+    """
+    start = time.perf_counter()
+    with akv_http("GET", url, stream=True) as respons:
+        respons.raise_for_status()
+        if format == "parquet":
+            df = akv_les_CD2_parquet(io.BytesIO(respons.content))
+        else:
+            with gzip.GzipFile(fileobj=respons.raw, mode='rb') as utpakka_fil:
+                if format == "jsonl":
+                    df = akv_les_CD2_jsonl(utpakka_fil)
+                else:
+                    df = pd.read_csv(utpakka_fil, sep=",")
+        byte = respons.raw.tell()
+    akv_tel('byte', byte)
+    return df, byte, time.perf_counter() - start
+
+
+akv_CD2_maks_nedlastingar = 4
+
+
+def akv_les_CD2_filar(filar, format="csv"):
+    """
+    Last ned og les alle filene i ein CD2-jobb parallelt (maks akv_CD2_maks_nedlastingar
+    om gongen). URL-ane blir henta med eitt kall før nedlastinga startar.
+    Returnerer ei liste med DataFrames i same rekkjefølgje som filar.
+    """
+    def les(fil):
+        with akv_måling(f"nedlasting:{fil['id']}"):
+            url = akv_hent_CD2_url(fil['id'], filar)
+            try:
+                df, byte, sekund = akv_les_CD2_fil(url, format)
+            except requests.exceptions.HTTPError as exc:
+                if exc.response.status_code != 403:
+                    raise
+                # URL-en har gått ut undervegs; hent nye URL-ar og prøv ein gong til
+                with akv_CD2_urlar_lås:
+                    akv_CD2_urlar.pop(fil['id'], None)
+                akv_tel('nye_forsøk')
+                df, byte, sekund = akv_les_CD2_fil(akv_hent_CD2_url(fil['id'], filar), format)
+            akv_tel('rader', len(df))
+        logging.info(f"Henta {fil['id']}: {byte} byte på {sekund:.2f} s ({len(df)} rader)")
+        return df
+
+    with akv_CD2_urlar_lås:
+        akv_hent_CD2_urlar(filar)
+    with ThreadPoolExecutor(max_workers=akv_CD2_maks_nedlastingar) as pool:
+        return list(pool.map(akv_med_kontekst(les), filar))
+
+
+akv_CD2_tabellar = ["users", "pseudonyms", "enrollments", "courses", "calendar_events", "roles", "accounts", "access_tokens"]
+# Pause mellom kvar gong vi spør om status for ein CD2-jobb: startar kort og aukar gradvis
+akv_CD2_poll_start = 1.0
+akv_CD2_poll_faktor = 1.5
+akv_CD2_poll_maks = 30.0
+
+
+def akv_start_CD2_jobb(tabell, since, format="csv"):
+    """
+    Be CD2 om alle endringar i tabell sidan since, som csv, jsonl eller parquet.
+    Utan since (None) ber vi om eit fullt øyeblinksbilete av tabellen.
+    Returnerer svaret med jobb-id og status.
+    """
+    payload = {"format": format}
+    if since is not None:
+        payload["since"] = since
+    payload = json.dumps(payload)
+    requesturl = f"{CD2_base_url}/dap/query/canvas/table/{tabell}/data"
+    logging.debug(f"Sender søk til {requesturl}")
+    r = akv_CD2_request("POST", requesturl, data=payload)
+    r.raise_for_status()
+    return r.json()
+
+
+def akv_vent_på_CD2_jobbar(jobbar):
+    """
+    Vent på fleire CD2-jobbar samtidig. jobbar er ein dict {tabell: svar frå akv_start_CD2_jobb}.
+    Gir (tabell, jobbsvar) etter kvart som jobbane blir ferdige. Kvar jobb blir spurd
+    ofte i starten og sjeldnare etter kvart, med mindre CD2 sender Retry-After.
+    Kastar CD2Feil til slutt dersom nokon av jobbane feila.
+    """
+    ventar = {}
+    for tabell, respons in jobbar.items():
+        if respons['status'] == "complete":
+            yield tabell, respons
+        else:
+            ventar[tabell] = {'id': respons['id'], 'neste': time.monotonic(), 'pause': akv_CD2_poll_start,
+                              'start': time.monotonic(), 'spurnader': 0}
+    feila = []
+    while ventar:
+        tabell = min(ventar, key=lambda t: ventar[t]['neste'])
+        jobb = ventar[tabell]
+        time.sleep(max(0.0, jobb['neste'] - time.monotonic()))
+        r2 = akv_CD2_request("GET", f"{CD2_base_url}/dap//job/{jobb['id']}")
+        r2.raise_for_status()
+        jobb['spurnader'] += 1
+        respons2 = r2.json()
+        logging.debug(respons2)
+        if respons2['status'] == "complete":
+            del ventar[tabell]
+            akv_registrer_måling(f"jobb:{tabell}", time.monotonic() - jobb['start'], http_kall=jobb['spurnader'])
+            yield tabell, respons2
+        elif respons2['status'] == "failed":
+            del ventar[tabell]
+            logging.error(f"CD2-jobben for {tabell} feila: {respons2}")
+            feila.append(tabell)
+        else:
+            try:
+                pause = float(r2.headers['Retry-After'])
+            except (KeyError, ValueError):
+                pause = jobb['pause']
+                jobb['pause'] = min(jobb['pause'] * akv_CD2_poll_faktor, akv_CD2_poll_maks)
+            jobb['neste'] = time.monotonic() + pause
+    if feila:
+        raise CD2Feil(f"CD2-jobbane for {', '.join(feila)} feila")
+
+
+def akv_les_CD2_tabellar(tabellar=None, since=None, format="csv"):
+    """
+    Start CD2-jobbar for alle tabellane på ein gong og gi (tabell, alledata, sist_oppdatert, until)
+    for kvar tabell så snart jobben er ferdig og filene er lesne. Utan since hentar vi
+    endringane sidan sist oppdatering av kvar tabell; since kan òg vere ein dict med
+    eigen since per tabell, der None gir eit fullt øyeblinksbilete. Med format="parquet"
+    kjem kolonnane ut med rette typar (tidspunkt som datetime, id-ar som Int64), og
+    format kan på same måte som since vere ein dict med eige format per tabell.
+    """
+    if tabellar is None:
+        tabellar = akv_CD2_tabellar
+    if isinstance(since, dict):
+        sist_oppdatert = since
     else:
-        feilmelding = f"Klarte ikkje å skaffe access_token, feil {be_om_access_token.status_code}"
-        logging.error(feilmelding)
-        return feilmelding
+        sist_oppdatert = {tabell: since or akv_finn_sist_oppdatert(tabell) for tabell in tabellar}
+    formatar = format if isinstance(format, dict) else {tabell: format for tabell in tabellar}
+    jobbar = {tabell: akv_start_CD2_jobb(tabell, sist_oppdatert[tabell], formatar[tabell]) for tabell in tabellar}
+    for tabell, respons2 in akv_vent_på_CD2_jobbar(jobbar):
+        dr_liste = akv_les_CD2_filar(respons2['objects'], formatar[tabell])
+        ikkje_tomme = [df for df in dr_liste if not df.empty] or dr_liste[:1]
+        alledata = pd.concat(ikkje_tomme) if ikkje_tomme else pd.DataFrame()
+        # Øyeblinksbilete har 'at' i staden for 'until'
+        yield tabell, alledata, sist_oppdatert[tabell], respons2.get('until', respons2.get('at'))
+
+
+def akv_les_CD2_tabell(tabell, format="csv"):
+    for _, alledata, sist_oppdatert, until in akv_les_CD2_tabellar([tabell], format=format):
+        return alledata, sist_oppdatert, until
+    
+
+# Lokalt lager med siste tilstand for CD2-tabellane, som parquet-filer fordelte på
+# akv_CD2_lager_partisjonar partisjonar etter key.id
+akv_CD2_lager_katalog = os.environ.get('CD2_lager', 'CD2_lager')
+akv_CD2_lager_partisjonar = 16
+
+
+def akv_CD2_lager_tabellkatalog(tabell):
+    """
+    Returner katalogen til tabell i det lokale lageret. Vart ei utskifting av heile
+    tabellen (sjå akv_oppdater_CD2_lager) avbroten mellom dei to omdøypingane, blir
+    ho fullført her, så lageret aldri står att utan ein komplett tilstand.
+    """
+    katalog = os.path.join(akv_CD2_lager_katalog, tabell)
+    if not os.path.isdir(katalog) and os.path.exists(os.path.join(katalog + ".ny", "status.json")):
+        os.replace(katalog + ".ny", katalog)
+    return katalog
+
+
+def akv_CD2_lager_status(tabell):
+    """
+    Returner status for tabellen i det lokale lageret ({'until': ...}), eller None
+    dersom tabellen ikkje er lasta inn enno.
+    """
+    statusfil = os.path.join(akv_CD2_lager_tabellkatalog(tabell), "status.json")
+    if not os.path.exists(statusfil):
+        return None
+    with open(statusfil, 'r') as f_in:
+        return json.load(f_in)
 
 
-def akv_hent_CD2_filar(innfil, token, svar):
-    requesturl = f"{CD2_base_url}/dap/object/url"
-    payload = f"{svar['objects']}"
-    payload = payload.replace('\'', '\"')
-    headers = {'x-instauth': token, 'Content-Type': 'text/plain'}
-    r4 = requests.request("POST", requesturl, headers=headers, data=payload)
-    if r4.status_code == 200:
-        respons4 = r4.json()
-        url = respons4['urls'][innfil]['url']
-        data = requests.request("GET", url)
-        buffer = io.BytesIO(data.content)
-        with gzip.GzipFile(fileobj=buffer, mode='rb') as utpakka_fil:
-            utpakka_data = utpakka_fil.read().decode()
-    return utpakka_data
-
-
-def akv_les_CD2_tabell(tabell):
-    CD2_access_token = akv_hent_CD2_access_token()
-    headers = {'x-instauth': CD2_access_token, 'Content-Type': 'text/plain'}
-    sist_oppdatert = akv_finn_sist_oppdatert(tabell)
-    payload = '{"format": "csv", "since": \"%s\"}' % (sist_oppdatert)
-    requesturl = f"{CD2_base_url}/dap/query/canvas/table/{tabell}/data"
-    print(f"Sender søk til {requesturl}")
-    try:
-        r = requests.request("POST", requesturl, headers=headers, data=payload)
-        r.raise_for_status()
-        respons = r.json()
-        id = respons['id']
-        vent = True
-        while vent:
-            requesturl2 = f"{CD2_base_url}/dap//job/{id}"
-            r2 = requests.request("GET", requesturl2, headers=headers)
-            time.sleep(5)
-            respons2 = r2.json()
-            print(respons2)
-            if respons2['status'] == "complete":
-                vent = False
-                filar = respons2['objects']
-        dr_liste = []
-        print(filar)
-        for fil in filar:
-            data = io.StringIO(akv_hent_CD2_filar(fil['id'], CD2_access_token, respons2))
-            df = pd.read_csv(data, sep=",")
-            dr_liste.append(df)
-        alledata = pd.concat(df for df in dr_liste if not df.empty)
-        return alledata, sist_oppdatert, respons2['until']
-    except requests.exceptions.RequestException as exc:
-        raise exc
-    
+def akv_oppdater_CD2_lager(tabell, endringar, until, erstatt=False):
+    """
+    Legg endringar frå CD2 inn i det lokale lageret for tabell. Rader med same key.id
+    blir erstatta, og rader med meta.action == 'D' blir sletta. Berre partisjonane
+    som har endringar blir skrivne på nytt, kvar med os.replace; stoppar vi undervegs,
+    står status.json framleis på førre until, og neste køyring legg dei same
+    endringane inn på nytt. Med erstatt=True (fullt øyeblinksbilete) blir heile
+    tabellen, med status.json, skriven i ein ny katalog og bytt inn til slutt.
+    """
+    katalog = akv_CD2_lager_tabellkatalog(tabell)
+    mål = katalog
+    if erstatt:
+        katalog = katalog + ".ny"
+        shutil.rmtree(katalog, ignore_errors=True)
+    os.makedirs(katalog, exist_ok=True)
+    if not endringar.empty:
+        partisjon = pd.util.hash_pandas_object(endringar['key.id'].astype(str), index=False) % akv_CD2_lager_partisjonar
+        for nr, del_endringar in endringar.groupby(partisjon.values):
+            filnamn = os.path.join(katalog, f"del-{nr:03}.parquet")
+            if os.path.exists(filnamn):
+                del_endringar = pd.concat([pd.read_parquet(filnamn), del_endringar], ignore_index=True)
+            del_endringar = del_endringar.drop_duplicates(subset='key.id', keep='last')
+            if 'meta.action' in del_endringar.columns:
+                del_endringar = del_endringar[del_endringar['meta.action'] != 'D']
+            del_endringar.to_parquet(filnamn + ".tmp", index=False)
+            os.replace(filnamn + ".tmp", filnamn)
+    statusfil = os.path.join(katalog, "status.json")
+    with open(statusfil + ".tmp", 'w') as f_out:
+        json.dump({'until': until}, f_out)
+    os.replace(statusfil + ".tmp", statusfil)
+    if erstatt:
+        gammal = mål + ".gammal"
+        shutil.rmtree(gammal, ignore_errors=True)
+        if os.path.isdir(mål):
+            os.replace(mål, gammal)
+        os.replace(katalog, mål)
+        shutil.rmtree(gammal, ignore_errors=True)
+    logging.debug(f"Lokalt lager for {tabell} er oppdatert til {until} ({len(endringar)} endringar)")
+
+
+def akv_les_CD2_lager(tabell, kolonnar=None):
+    """
+    Les siste tilstand for tabell frå det lokale lageret, eventuelt berre kolonnar.
+    """
+    katalog = akv_CD2_lager_tabellkatalog(tabell)
+    filer = sorted(f for f in os.listdir(katalog) if f.endswith(".parquet")) if os.path.isdir(katalog) else []
+    if not filer:
+        return pd.DataFrame(columns=kolonnar)
+    return pd.concat([pd.read_parquet(os.path.join(katalog, f), columns=kolonnar) for f in filer], ignore_index=True)
+
+
+def akv_CD2_lager_since(tabell, full=False):
+    """
+    Returner since for neste synkronisering av tabell til det lokale lageret: None
+    (fullt øyeblinksbilete) med full=True, elles until frå førre synkronisering, eller
+    sist_oppdatert i Azure dersom lageret er tomt.
+    """
+    status = akv_CD2_lager_status(tabell)
+    if full:
+        return None
+    if status is not None:
+        return status['until']
+    return akv_finn_sist_oppdatert(tabell)
+
+
+def akv_synk_CD2_lager(tabell, full=False):
+    """
+    Hent endringane i tabell sidan førre synkronisering (sjå akv_CD2_lager_since) og
+    legg dei inn i det lokale lageret. Med full=True hentar vi eit fullt øyeblinksbilete
+    og byggjer lageret på nytt.
+    Returnerer (endringar, since, until) på same måte som akv_les_CD2_tabell.
+    """
+    since = akv_CD2_lager_since(tabell, full)
+    for _, endringar, since, until in akv_les_CD2_tabellar([tabell], since={tabell: since}, format="parquet"):
+        akv_oppdater_CD2_lager(tabell, endringar, until, erstatt=full)
+        return endringar, since, until
+
 
 def akv_les_CD2_pseudonyms():
     """
     Leser pseudonyms-tabellen fra Canvas Data 2, henter nye poster og oppdaterer Azure-tabellen "akv_user_id_kobling.
     """
     start_CD2_pseudonyms = time.perf_counter()
+    timer_CD2(["pseudonyms"])
+    print(f"Total tidsbruk: {time.perf_counter() - start_CD2_pseudonyms}")
+
+
+def akv_handsam_CD2_pseudonyms(alledata, sist_oppdatert, denne_oppdateringa):
+    """
+    Legg endringane i pseudonyms inn i det lokale lageret og dei nye koplingane
+    mellom user_id og sis_user_id i dbo.akv_user_id_kobling.
+    """
     CD2_tabell = "pseudonyms"
-    alledata, sist_oppdatert, denne_oppdateringa = akv_les_CD2_tabell(CD2_tabell)
-    alle_nye = alledata[(alledata['value.created_at']>sist_oppdatert)]
+    akv_oppdater_CD2_lager(CD2_tabell, alledata, denne_oppdateringa, erstatt=sist_oppdatert is None)
+    alle_nye = alledata
+    if sist_oppdatert is not None:
+        alle_nye = alledata[pd.to_datetime(alledata['value.created_at'], utc=True) > pd.Timestamp(sist_oppdatert)]
     alle_nye.to_csv(f"{CD2_tabell}_nye_{denne_oppdateringa[0:10]}.csv", index=False)
     ekte_nye = alle_nye.dropna(subset='value.sis_user_id')
 
-    query = """
-        MERGE INTO [dbo].[akv_user_id_kobling] AS target 
-        USING (VALUES (?, ?)) AS source (user_id, sis_user_id) 
-        ON target.[user_id] = source.[user_id]
-        WHEN MATCHED THEN
-            UPDATE SET target.[sis_user_id] = source.[sis_user_id]
-        WHEN NOT MATCHED THEN
-            INSERT ([user_id], [sis_user_id]) VALUES (source.[user_id], source.[sis_user_id]);
-    """
     try:
         nye = ekte_nye[['value.user_id', 'value.sis_user_id']]
-        with pyodbc.connect(conn_str) as conn:
-            cursor = conn.cursor()
-            for index, row in nye.iterrows():
-                user_id = str(row[0])
-                sis_user_id = str(row[1])
-                cursor.execute(query, (user_id, sis_user_id))
-            conn.commit()
-    except pyodbc.Error as e:
+        rader = [(str(user_id), str(sis_user_id)) for user_id, sis_user_id in nye.itertuples(index=False)]
+        with akv_sql_tilkopling() as conn:
+            akv_bulk_merge(conn, "dbo.akv_user_id_kobling", rader)
+    except akv_sql_feil as e:
         with open(f'sist_oppdatert_{CD2_tabell}.txt', 'w') as f_out:
             f_out.write(idag)
             logging.debug(f"{CD2_tabell} er sist oppdatert (lokal): {idag}")
     akv_lagre_sist_oppdatert(CD2_tabell, denne_oppdateringa)
     print(f"Tabell: {CD2_tabell} er oppdatert {denne_oppdateringa}")
-    print(f"Total tidsbruk: {time.perf_counter() - start_CD2_pseudonyms}")
+
+
+# Aktuelle terminar og emna deira, rekna ut éin gong og delte av timer-funksjonane
+akv_termincache = {'tid': 0.0, 'terminar': None, 'emne_per_termin': None}
+akv_termincache_lås = threading.Lock()
+akv_termincache_levetid = 3600
+
+
+def akv_termin_intervall(namn):
+    """
+    Gjer om eit terminnamn frå Canvas til (start, slutt) som desimalår, der HØST er +0.5.
+    "2024 HØST" gir (2024.5, 2024.5) og "2023 HØST-2024 VÅR" gir (2023.5, 2024.0).
+    Returnerer None for namn som ikkje er terminar (t.d. "Standardtermin").
+    """
+    try:
+        if '-' in namn:
+            start_termin, slutt_termin = namn.split('-')[:2]
+            start_år, start_semester = start_termin.split()[:2]
+            slutt_år, slutt_semester = slutt_termin.split()[:2]
+            return (int(start_år) + 0.5*(start_semester == 'HØST'), int(slutt_år) + 0.5*(slutt_semester == 'HØST'))
+        termin_år, semester = namn.split(' ')
+        if semester not in ('VÅR', 'HØST'):
+            return None
+        desimal = int(termin_år) + 0.5*(semester == 'HØST')
+        return (desimal, desimal)
+    except (ValueError, TypeError):
+        return None
+
+
+def akv_nullstill_termincache():
+    """
+    Gløym aktuelle terminar og emne, t.d. etter at Canvas_Terms eller Canvas_Courses er oppdaterte.
+    """
+    with akv_termincache_lås:
+        akv_termincache.update({'tid': 0.0, 'terminar': None, 'emne_per_termin': None})
+
+
+def akv_aktuelle_emne():
+    """
+    Returner course_id for alle emne i terminar som gjeld no (år og termin).
+
+    Terminane i stg.Canvas_Terms blir tolka éin gong (akv_termin_intervall), og berre
+    emna i dei aktuelle terminane blir henta frå stg.Canvas_Courses med
+    WHERE enrollment_term_id IN (...). Svaret blir hugsa i akv_termincache_levetid sekund.
+    """
+    with akv_termincache_lås:
+        if akv_termincache['emne_per_termin'] is None or time.monotonic() - akv_termincache['tid'] > akv_termincache_levetid:
+            desimal = int(år) + 0.5*(termin == 'HØST')
+            with akv_sql_tilkopling() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT [term_id], [name] FROM [stg].[Canvas_Terms]")
+                    aktuelle_terminar = []
+                    for term_id, namn in cursor.fetchall():
+                        intervall = akv_termin_intervall(namn)
+                        if intervall is not None and intervall[0] <= desimal <= intervall[1]:
+                            aktuelle_terminar.append(term_id)
+                    emne_per_termin = {term_id: [] for term_id in aktuelle_terminar}
+                    if aktuelle_terminar:
+                        cursor.execute(f"""
+                            SELECT [course_id], [enrollment_term_id] FROM [stg].[Canvas_Courses]
+                            WHERE [enrollment_term_id] IN ({", ".join("?" for _ in aktuelle_terminar)})
+                        """, *aktuelle_terminar)
+                        for course_id, term_id in cursor.fetchall():
+                            emne_per_termin[term_id].append(course_id)
+            akv_termincache.update({'tid': time.monotonic(), 'terminar': aktuelle_terminar, 'emne_per_termin': emne_per_termin})
+            logging.debug(f"Aktuelle terminar: {aktuelle_terminar} ({sum(len(e) for e in emne_per_termin.values())} emne)")
+        return [course_id for emne in akv_termincache['emne_per_termin'].values() for course_id in emne]
 
 
 def timer_Canvas_Calendar():
     start_Canvas_Calendar = time.perf_counter()
+    timer_CD2(["calendar_events"])
+    logging.info(f"Tidsbruk Canvas_Calendar: {time.perf_counter() - start_Canvas_Calendar} s")
+
+
+def akv_handsam_Canvas_Calendar(alledata, sist_oppdatert, until):
+    """
+    Last opp aktive kalenderhendingar frå calendar_events i CD2 til stg.canvas_timeplan,
+    med lærar og TimeEdit-id henta ut frå skildringa.
+    """
     def finn_lærar(rekke):
         if type(rekke['value.description']) is str:
             streng = rekke['value.description']
@@ -243,59 +2141,15 @@ def timer_Canvas_Calendar():
             streng = rekke['value.description']
             return streng[streng.find("ID:")+4:streng.find("<", streng.find("ID:"))]
 
-    CD2_access_token = akv_hent_CD2_access_token()
-    headers = {'x-instauth': CD2_access_token, 'Content-Type': 'text/plain'}
-
-    tabell = "calendar_events"
-
-    # Her set eg sist_oppdatert til "i går" (meir presist "kl. 12 føremiddag i går")
-    sist_oppdatert_dato = f"{igår.year}-{igår.month:02}-{igår.day:02}T{12}:00:00Z"
-    payload = '{"format": "csv", "since": \"%s\"}' %(sist_oppdatert_dato)
-
-    try:
-        requesturl = f"{CD2_base_url}/dap/query/canvas/table/{tabell}/data"
-        logging.debug(f"Sender søk til {requesturl}")
-        r = requests.request("POST", requesturl, headers=headers, data=payload)
-        if r.status_code == 200:
-            respons = r.json()
-            id = respons['id']
-            vent = True
-            while vent:
-                requesturl = f"{CD2_base_url}/dap//job/{id}"
-                r2 = requests.request("GET", requesturl, headers=headers)
-                time.sleep(5)
-                respons2 = r2.json()
-                logging.debug(respons2)
-                if respons2['status'] == "complete":
-                    logging.debug(respons2)
-                    vent = False
-        else:
-            logging.error(f"Feil i spørjing mot CD2, kode {r.status_code}")
-        antal = len(respons2['objects'])
-        data_i_dag = []
-        for i in range(antal):
-            data = io.StringIO(akv_hent_CD2_filar(respons2['objects'][i]['id'], CD2_access_token, respons2))
-            df = pd.read_csv(data, sep=",")
-            data_i_dag.append(df)
-        logging.debug(f"{idag}: har henta {len(data_i_dag)} filer med kalenderhendingar")
-    except RuntimeError:
-        logging.error(f"{idag}: får ikkje lasta data frå kalenderen i Canvas")
-
-    les_inn_startdata = data_i_dag[0]
-    startdata = les_inn_startdata.loc[(les_inn_startdata['value.start_at'] > '2023') & (les_inn_startdata['value.workflow_state'] == 'active')][['key.id', 'value.title', 'value.start_at', 'value.end_at', 'value.location_name', 'value.description', 'value.context_code']]
-    startdata['teacher'] = None
-    startdata['timeedit_id'] = None
-    liste_av_datarammer = [startdata]
-    for les_inn_data in data_i_dag[1:]:
-        data = les_inn_data.loc[(les_inn_data['value.start_at'] > '2023') & (les_inn_data['value.workflow_state'] == 'active')][['key.id', 'value.title', 'value.start_at', 'value.end_at', 'value.location_name', 'value.description', 'value.context_code']]
-        liste_av_datarammer.append(data)
-    behandla = pd.concat(liste_av_datarammer, ignore_index=True)
+    logging.debug(f"{idag}: har henta {len(alledata)} kalenderhendingar")
+    behandla = alledata.loc[(alledata['value.start_at'] > '2023') & (alledata['value.workflow_state'] == 'active')][['key.id', 'value.title', 'value.start_at', 'value.end_at', 'value.location_name', 'value.description', 'value.context_code']]
+    behandla = behandla.reset_index(drop=True)
     behandla['teacher'] = behandla.apply(finn_lærar, axis=1)
     behandla['timeedit_id'] = behandla.apply(finn_timeedit_id, axis=1)
     dikt = behandla.to_dict('records')
 
     try:
-        with pyodbc.connect(conn_str) as cnxn:
+        with akv_sql_tilkopling() as cnxn:
             data_to_insert = []
             for hending in dikt:
                 logging.debug(f"Legg inn hending {hending['key.id']}")
@@ -322,62 +2176,10 @@ def timer_Canvas_Calendar():
                                     context_code,
                                     teacher,
                                     timeedit_id))
-            query = """
-                MERGE INTO [stg].[canvas_timeplan] AS t
-                USING (VALUES (?,?,?,?,?,?,?,?,?)) AS s(
-                    [id],
-                    [title],
-                    [start_at],
-                    [end_at],
-                    [location_name],
-                    [description],
-                    [context_code],
-                    [teacher],
-                    [timeedit_id]
-                )
-                ON t.[id] = s.[id]
-                WHEN MATCHED THEN
-                    UPDATE SET
-                        t.[title] = s.[title],
-                        t.[start_at] = s.[start_at],
-                        t.[end_at] = s.[end_at],
-                        t.[location_name] = s.[location_name],
-                        t.[description] = s.[description],
-                        t.[context_code] = s.[context_code],
-                        t.[teacher] = s.[teacher],
-                        t.[timeedit_id] = s.[timeedit_id]
-                WHEN NOT MATCHED THEN
-                    INSERT (
-                        [id],
-                        [title],
-                        [start_at],
-                        [end_at],
-                        [location_name],
-                        [description],
-                        [context_code],
-                        [teacher],
-                        [timeedit_id]
-                    )
-                    VALUES (
-                        s.[id],
-                        s.[title],
-                        s.[start_at],
-                        s.[end_at],
-                        s.[location_name],
-                        s.[description],
-                        s.[context_code],
-                        s.[teacher],
-                        s.[timeedit_id]
-                    );
-            """
-            with cnxn.cursor() as cursor:
-                for data in data_to_insert:
-                    cursor.execute(query, data)
-                cnxn.commit()
+            akv_bulk_merge(cnxn, "stg.canvas_timeplan", data_to_insert)
         logging.debug(f"Har lasta opp {len(dikt)} kalender-hendingar til databasen")
     except RuntimeError:
         logging.error("Feil når eg skal legge timeplan-data inn i tabellen.")
-    logging.info(f"Tidsbruk Canvas_Calendar: {time.perf_counter() - start_Canvas_Calendar} s")
 
 
 def timer_FS_Studieprogram():
@@ -437,121 +2239,47 @@ def timer_FS_Studieprogram():
         }
     }
     """
+
+    hent_rad = akv_radhentar(['kode',
+                              'navnAlleSprak.nb',
+                              'organisasjonsenhet.studieansvarlig.fakultet.fakultetsnummer',
+                              'organisasjonsenhet.studieansvarlig.instituttnummer',
+                              'organisasjonsenhet.studieansvarlig.navnAlleSprak.nb',
+                              'prosentHeltid',
+                              ('studieniva.navnAlleSprak.nb', ''),
+                              'undervisningsorganisering.navnAlleSprak.und',
+                              ('finansieringstype.navn.und', ''),
+                              ('vekting.verdi', ''),
+                              ('vekting.vektingstype.kode', ''),
+                              ('nusKode', ''),
+                              'prosentEgenfinansiering'])
+
+    def studieprogramrad(item):
+        (studieprogramkode, studieprogramnavn, fakultetsnummer, instituttnummer, instituttnavn, prosentAvHeltid,
+         studieniva, undervisningsorganisering, finansieringstype, vekting, vektingstype, nuskode,
+         prosentEgenfinansiering) = hent_rad(item)
+        return (studieprogramkode,
+                studieprogramnavn,
+                fakultetsnummer,
+                instituttnummer,
+                instituttnavn,
+                int(prosentAvHeltid),
+                studieniva,
+                undervisningsorganisering,
+                finansieringstype,
+                float(vekting),
+                vektingstype,
+                nuskode,
+                int(prosentEgenfinansiering))
+
     try:
-        with pyodbc.connect(conn_str) as cnxn:
-            data_to_insert = []
-            n = 0
-            hentmeir = True
-            antal_per_side = 500
-            while hentmeir:
-                if n == 0:
-                    start = None
-                else:
-                    start = studieprogramRespons['data']['studieprogram']['pageInfo']['endCursor']
-                variable = {'antal': antal_per_side, 'start': start}
-                n += 1
-                logging.debug(f"Les side {n} studieprogram")
-                studieprogramRespons = akv_query_FS_graphql(query, variable)
-                logging.debug(f"Henta {len(studieprogramRespons['data']['studieprogram']['nodes'])} linjer frå FS")
-                for item in studieprogramRespons['data']['studieprogram']['nodes']:
-                    studieprogramkode = item['kode']
-                    studieprogramnavn = item['navnAlleSprak']['nb']
-                    fakultetsnummer = item['organisasjonsenhet']['studieansvarlig']['fakultet']['fakultetsnummer']
-                    instituttnummer = item['organisasjonsenhet']['studieansvarlig']['instituttnummer']
-                    instituttnavn = item['organisasjonsenhet']['studieansvarlig']['navnAlleSprak']['nb']
-                    prosentAvHeltid = item['prosentHeltid']
-                    studieniva = item['studieniva']['navnAlleSprak']['nb'] if item['studieniva'] is not None else ''
-                    undervisningsorganisering = item['undervisningsorganisering']['navnAlleSprak']['und']
-                    finansieringstype = item['finansieringstype']['navn']['und'] if item['finansieringstype'] is not None else ''
-                    vekting = item['vekting']['verdi'] if item['vekting'] is not None else ''
-                    vektingstype = item['vekting']['vektingstype']['kode'] if item['vekting'] is not None else ''
-                    nuskode = item['nusKode'] if item['nusKode'] is not None else ''
-                    prosentEgenfinansiering = item['prosentEgenfinansiering']
-                    data_to_insert.append((studieprogramkode,
-                                           studieprogramnavn,
-                                           fakultetsnummer,
-                                           instituttnummer,
-                                           instituttnavn,
-                                           int(prosentAvHeltid),
-                                           studieniva,
-                                           undervisningsorganisering,
-                                           finansieringstype,
-                                           float(vekting),
-                                           vektingstype,
-                                           nuskode if nuskode is not None else None,
-                                           int(prosentEgenfinansiering)))
-                hentmeir = studieprogramRespons['data']['studieprogram']['pageInfo']['hasNextPage']
-                logging.debug(f"Variabelen 'hentmeir' er satt til {hentmeir}")
-            query = """
-                MERGE INTO [stg].[FS_Studieprogram] AS t
-                USING (VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)) AS s(
-                    [studieprogramkode],
-                    [studieprogramnavn],
-                    [fakultetsnummer],
-                    [instituttnummer],
-                    [instituttnavn],
-                    [prosentAvHeltid],
-                    [studieniva],
-                    [undervisningsorganisering],
-                    [finansieringstype],
-                    [vekting],
-                    [vektingstype],
-                    [nuskode],
-                    [prosentEgenfinansiering]
-                )
-                ON t.[studieprogramkode] = s.[studieprogramkode]
-                WHEN MATCHED THEN
-                    UPDATE SET
-                        t.[studieprogramnavn] = s.[studieprogramnavn],
-                        t.[fakultetsnummer] = s.[fakultetsnummer],
-                        t.[instituttnummer] = s.[instituttnummer],
-                        t.[instituttnavn] = s.[instituttnavn],
-                        t.[prosentAvHeltid] = s.[prosentAvHeltid],
-                        t.[studieniva] = s.[studieniva],
-                        t.[undervisningsorganisering] = s.[undervisningsorganisering],
-                        t.[finansieringstype] = s.[finansieringstype],
-                        t.[vekting] = s.[vekting],
-                        t.[vektingstype] = s.[vektingstype],
-                        t.[nuskode] = s.[nuskode],
-                        t.[prosentEgenfinansiering] = s.[prosentEgenfinansiering]
-                WHEN NOT MATCHED THEN
-                    INSERT (
-                        [studieprogramkode],
-                        [studieprogramnavn],
-                        [fakultetsnummer],
-                        [instituttnummer],
-                        [instituttnavn],
-                        [prosentAvHeltid],
-                        [studieniva],
-                        [undervisningsorganisering],
-                        [finansieringstype],
-                        [vekting],
-                        [vektingstype],
-                        [nuskode],
-                        [prosentEgenfinansiering]
-                    )
-                    VALUES (
-                        s.[studieprogramkode],
-                        s.[studieprogramnavn],
-                        s.[fakultetsnummer],
-                        s.[instituttnummer],
-                        s.[instituttnavn],
-                        s.[prosentAvHeltid],
-                        s.[studieniva],
-                        s.[undervisningsorganisering],
-                        s.[finansieringstype],
-                        s.[vekting],
-                        s.[vektingstype],
-                        s.[nuskode],
-                        s.[prosentEgenfinansiering]
-                    );
-            """
-            with cnxn.cursor() as cursor:
-                for data in data_to_insert:
-                    cursor.execute(query, data)
-                cnxn.commit()
-                logging.debug("Data lasta opp til FS_Studieprogram")
-    except (KeyError, TypeError):
+        with akv_sql_tilkopling() as cnxn:
+            # Henting, uttrekk av rader og opplasting går samstundes i kvar sin tråd
+            sider = akv_røyr(akv_graphql_sider(query, {}, 'studieprogram', 500))
+            batchar = akv_røyr(sider, lambda nodar: [studieprogramrad(item) for item in nodar])
+            akv_bulk_merge_straum(cnxn, "stg.FS_Studieprogram", batchar)
+            logging.debug("Data lasta opp til FS_Studieprogram")
+    except (KeyError, TypeError, GraphQLFeil):
         raise Exception("Feil i henting av FS-data.")
     logging.info(f"Tidsbruk FS_Studieprogram: {time.perf_counter() - start_FS_Studieprogram} s")
 
@@ -639,189 +2367,78 @@ def timer_FS_emne():
   }
 }
     """
-    try:
-        with pyodbc.connect(conn_str) as cnxn:
-            if måned < 5:
-                år_lub = år - 1
-            else:
-                år_lub = år
-            if måned < 7:
-                termin_emne = "VAR"
-            else:
-                termin_emne = "HOST"
-            liste_utan_emneansvarlege = []
-            liste_med_emneansvarlege = []
-            n = 0
-            hentmeir = True
-            antal_per_side = 100
+    hent_emne = akv_radhentar(['kode',
+                               'versjonskode',
+                               'navnAlleSprak.nb',
+                               'navnAlleSprak.nn',
+                               'navnAlleSprak.en',
+                               'fagkoblinger.viktigsteFag.navnAlleSprak.nob',
+                               'organisasjonsenhet.administrativtAnsvarlig.fakultet.fakultetsnummer',
+                               'organisasjonsenhet.administrativtAnsvarlig.instituttnummer',
+                               'organisasjonsenhet.administrativtAnsvarlig.navnAlleSprak.nb',
+                               'emnetype',
+                               'vekting.emnevekting.verdi',
+                               'vekting.emnevekting.vektingstype.kode'],
+                              påkravd=True)
+    hent_beskriving = akv_radhentar(['tekstkategori.kode', 'sprak.iso6392Kode', 'innhold'])
+    hent_emneansvarleg = akv_radhentar(['personProfil.navn.fornavn', 'personProfil.navn.etternavn', 'fagperson.feideBruker'])
+
+    liste_med_emneansvarlege = []
+
+    def emnerader(nodar):
+        """
+        Gjer om ei side med emne til rader for FS_Emner (og samle emneansvarlege).
+        Emne der eit av felta i hent_emne manglar, blir hoppa over (og logga), så
+        dei ikkje skriv over radene som alt ligg i FS_Emner med tomme verdiar.
+        """
+        rader = []
+        for item in nodar:
             try:
-                while hentmeir:
-                    if n == 0:
-                        start = None
-                    else:
-                        start = svar['data']['emner']['pageInfo']['endCursor']
-                    variable = {'aar_emne': år, 'termin_emne': termin_emne, 'aar_lub': år_lub, 'antal': antal_per_side, 'start': start}
-                    n += 1
-                    logging.debug(f"Les side {n} emneoversikt")
-                    svar = akv_query_FS_graphql(query, variable)
-                    for item in svar['data']['emner']['nodes']:
-                        try:
-                            emnekode = item['kode']
-                            versjonskode = item['versjonskode']
-                            unik_kode = emnekode + "_" + versjonskode
-                            emnenavn_nob = item['navnAlleSprak']['nb']
-                            emnenavn_nno = item['navnAlleSprak']['nn']
-                            emnenavn_eng = item['navnAlleSprak']['en']
-                            fag = item['fagkoblinger']['viktigsteFag']['navnAlleSprak']['nob']
-                            fakultetsnummer = item['organisasjonsenhet']['administrativtAnsvarlig']['fakultet']['fakultetsnummer']
-                            instituttnummer = item['organisasjonsenhet']['administrativtAnsvarlig']['instituttnummer']
-                            instituttnavn = item['organisasjonsenhet']['administrativtAnsvarlig']['navnAlleSprak']['nb']
-                            emnetype = item['emnetype']
-                            vekting = item['vekting']['emnevekting']['verdi']
-                            vektingstype = item['vekting']['emnevekting']['vektingstype']['kode']
-                            lubarb = {'ARB_NNO': "Ikkje registrert", 'ARB_NOB': "Ikkje registrert", 'ARB_ENG': "Ikkje registrert", 'LUB_NNO': "Ikkje registrert", 'LUB_NOB': "Ikkje registrert", 'LUB_ENG': "Ikkje registrert"}
-                            try:
-                                for b in item['beskrivelser']:
-                                    kode = b['tekstkategori']['kode'][2:] + "_" + b['sprak']['iso6392Kode']
-                                    lubarb[kode] = b['innhold']
-                            except:
-                                pass
-                            ARB_NNO = lubarb['ARB_NNO']
-                            ARB_NOB = lubarb['ARB_NOB']
-                            ARB_ENG = lubarb['ARB_ENG']
-                            LUB_NNO = lubarb['LUB_NNO']
-                            LUB_NOB = lubarb['LUB_NOB']
-                            LUB_ENG = lubarb['LUB_ENG']               
-                            personroller = item['personroller']
-                            emneansvarlege = []
-                            try:
-                                for person in personroller:
-                                    etternavn = person['personProfil']['navn']['etternavn']
-                                    fornavn = person['personProfil']['navn']['fornavn']
-                                    feidebruker = person['fagperson']['feideBruker']
-                                    emneansvarlege.append((fornavn, etternavn, feidebruker))
-                            except:
-                                emneansvarlege = 'Ikkje registrert'
-                            emneansvarlege = json.dumps(emneansvarlege, ensure_ascii=False)
-                            liste_utan_emneansvarlege.append((emnekode, versjonskode, unik_kode, emnenavn_nob, emnenavn_nno, emnenavn_eng, fag, fakultetsnummer, instituttnummer, instituttnavn, emnetype, vekting, vektingstype, LUB_NNO, LUB_NOB, LUB_ENG, ARB_NNO, ARB_NOB, ARB_ENG))
-                            liste_med_emneansvarlege.append((unik_kode, emneansvarlege))
-                        except:
-                            logging.debug(f"Feil i {item['kode']}")
-                    hentmeir = svar['data']['emner']['pageInfo']['hasNextPage']
-            except:
-                raise Exception(f"Feil i henting av data om emnet. Side {n}")
-            query = """MERGE INTO [stg].[FS_Emner] AS t
-                USING (VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)) AS s(
-                    [emnekode],
-                    [versjonskode],
-                    [unik_kode],
-                    [emnenavn_nob],
-                    [emnenavn_nno],
-                    [emnenavn_eng],
-                    [fag],
-                    [fakultetsnummer],
-                    [instituttnummer],
-                    [instituttnavn],
-                    [emnetype],
-                    [vekting],
-                    [vektingstype],
-                    [LUB_NNO],
-                    [LUB_NOB],
-                    [LUB_ENG],
-                    [ARB_NNO],
-                    [ARB_NOB],
-                    [ARB_ENG]
-                )
-                ON t.[unik_kode] = s.[unik_kode] 
-                WHEN MATCHED THEN UPDATE SET
-                    t.[emnekode] = s.[emnekode],
-                    t.[versjonskode] = s.[versjonskode],
-                    t.[emnenavn_nob] = s.[emnenavn_nob],
-                    t.[emnenavn_nno] = s.[emnenavn_nno],
-                    t.[emnenavn_eng] = s.[emnenavn_eng],
-                    t.[fag] = s.[fag],
-                    t.[fakultetsnummer] = s.[fakultetsnummer],
-                    t.[instituttnummer] = s.[instituttnummer],
-                    t.[instituttnavn] = s.[instituttnavn],
-                    t.[emnetype] = s.[emnetype],
-                    t.[vekting] = s.[vekting],
-                    t.[vektingstype] = s.[vektingstype],
-                    t.[LUB_NNO] = s.[LUB_NNO],
-                    t.[LUB_NOB] = s.[LUB_NOB],
-                    t.[LUB_ENG] = s.[LUB_ENG],
-                    t.[ARB_NNO] = s.[ARB_NNO],
-                    t.[ARB_NOB] = s.[ARB_NOB],
-                    t.[ARB_ENG] = s.[ARB_ENG]
-                WHEN NOT MATCHED THEN INSERT (
-                    [unik_kode],
-                    [emnekode],
-                    [versjonskode],
-                    [emnenavn_nob],
-                    [emnenavn_nno],
-                    [emnenavn_eng],
-                    [fag],
-                    [fakultetsnummer],
-                    [instituttnummer],
-                    [instituttnavn],
-                    [emnetype],
-                    [vekting],
-                    [vektingstype],
-                    [LUB_NNO],
-                    [LUB_NOB],
-                    [LUB_ENG],
-                    [ARB_NNO],
-                    [ARB_NOB],
-                    [ARB_ENG])
-                  VALUES (
-                    s.[unik_kode],
-                    s.[emnekode],
-                    s.[versjonskode],
-                    s.[emnenavn_nob],
-                    s.[emnenavn_nno],
-                    s.[emnenavn_eng],
-                    s.[fag],
-                    s.[fakultetsnummer],
-                    s.[instituttnummer],
-                    s.[instituttnavn],
-                    s.[emnetype],
-                    s.[vekting],
-                    s.[vektingstype],
-                    s.[LUB_NNO],
-                    s.[LUB_NOB],
-                    s.[LUB_ENG],
-                    s.[ARB_NNO],
-                    s.[ARB_NOB],
-                    s.[ARB_ENG]);    
-                """
-            cursor = cnxn.cursor()
-            for data in liste_utan_emneansvarlege:
-                cursor.execute(query, data)
-            cnxn.commit()
-            cursor.close()
-            logging.debug("Data lasta opp til FS_Emner")
-            
-            query = """
-                MERGE INTO [stg].[FS_Emneansvarlige] AS t
-                USING (VALUES (?, ?)) AS s(
-                    [unik_kode],
-                    [emneansvarlege]
-                )
-                ON t.[unik_kode] = s.[unik_kode] 
-                WHEN MATCHED THEN UPDATE SET
-                    t.[emneansvarlege] = s.[emneansvarlege]
-                WHEN NOT MATCHED THEN INSERT (
-                    [unik_kode],
-                    [emneansvarlege])
-                VALUES (
-                    s.[unik_kode],
-                    s.[emneansvarlege]);    
-                """
-            cursor = cnxn.cursor()
-            for data in liste_med_emneansvarlege:
-                cursor.execute(query, data)
-            cnxn.commit()
-            cursor.close()
-            logging.debug("Data lasta opp til FS_Emneansvarlige")
+                (emnekode, versjonskode, emnenavn_nob, emnenavn_nno, emnenavn_eng, fag, fakultetsnummer,
+                 instituttnummer, instituttnavn, emnetype, vekting, vektingstype) = hent_emne(item)
+                unik_kode = emnekode + "_" + versjonskode
+                lubarb = {'ARB_NNO': "Ikkje registrert", 'ARB_NOB': "Ikkje registrert", 'ARB_ENG': "Ikkje registrert", 'LUB_NNO': "Ikkje registrert", 'LUB_NOB': "Ikkje registrert", 'LUB_ENG': "Ikkje registrert"}
+                for b in item['beskrivelser'] or []:
+                    tekstkategori, språk, innhald = hent_beskriving(b)
+                    if tekstkategori is not None and språk is not None:
+                        lubarb[tekstkategori[2:] + "_" + språk] = innhald
+                ARB_NNO = lubarb['ARB_NNO']
+                ARB_NOB = lubarb['ARB_NOB']
+                ARB_ENG = lubarb['ARB_ENG']
+                LUB_NNO = lubarb['LUB_NNO']
+                LUB_NOB = lubarb['LUB_NOB']
+                LUB_ENG = lubarb['LUB_ENG']
+                try:
+                    emneansvarlege = [hent_emneansvarleg(person) for person in item['personroller']]
+                except TypeError:
+                    emneansvarlege = 'Ikkje registrert'
+                emneansvarlege = json.dumps(emneansvarlege, ensure_ascii=False)
+                rader.append((emnekode, versjonskode, unik_kode, emnenavn_nob, emnenavn_nno, emnenavn_eng, fag, fakultetsnummer, instituttnummer, instituttnavn, emnetype, vekting, vektingstype, LUB_NNO, LUB_NOB, LUB_ENG, ARB_NNO, ARB_NOB, ARB_ENG))
+                liste_med_emneansvarlege.append((unik_kode, emneansvarlege))
+            except (KeyError, TypeError):
+                logging.debug(f"Feil i {item.get('kode')}")
+        return rader
+
+    try:
+        if måned < 5:
+            år_lub = år - 1
+        else:
+            år_lub = år
+        if måned < 7:
+            termin_emne = "VAR"
+        else:
+            termin_emne = "HOST"
+        variable = {'aar_emne': år, 'termin_emne': termin_emne, 'aar_lub': år_lub}
+        try:
+            with akv_sql_tilkopling() as cnxn:
+                # Henting, uttrekk av rader og opplasting går samstundes i kvar sin tråd
+                sider = akv_røyr(akv_graphql_sider(query, variable, 'emner', 100))
+                akv_bulk_merge_straum(cnxn, "stg.FS_Emner", akv_røyr(sider, emnerader))
+                logging.debug("Data lasta opp til FS_Emner")
+                akv_bulk_merge(cnxn, "stg.FS_Emneansvarlige", liste_med_emneansvarlege)
+                logging.debug("Data lasta opp til FS_Emneansvarlige")
+        except GraphQLFeil:
+            raise Exception("Feil i henting av data om emnet.")
     except:
         logging.debug("Feil ved oppdatering av tabell FS_Emne.")
         logging.debug(traceback.format_exc())
@@ -830,9 +2447,9 @@ def timer_FS_emne():
 
 def timer_FS_ProgramStudieretter():
     query = """
-    query MyQuery($antal: Int, $start: String) {
+    query MyQuery($antal: Int, $start: String, $studieprogramkodar: [String!]) {
         programStudieretter(
-            filter: {eierOrganisasjonskode: "0203", aktivStatus: AKTIV}, 
+            filter: {eierOrganisasjonskode: "0203", aktivStatus: AKTIV, studieprogramkoder: $studieprogramkodar}, 
             after: $start,
             first: $antal) {
             pageInfo {
@@ -867,341 +2484,148 @@ def timer_FS_ProgramStudieretter():
     """
 
     start_les_FS_programstudierettar = time.perf_counter()
-    programstudierettar = []
-    n = 0
-    hentmeir = True
-    antal_per_side = 1000
-    while hentmeir:
-        if n == 0:
-            start = None
+    # Del spørjinga opp etter studieprogram, slik at fleire cursorar kan gå samstundes.
+    # stg.FS_Studieprogram er fylt av timer_FS_Studieprogram tidlegare i same køyring.
+    # Shardane blir berre brukte når dei dekkjer alle programStudieretter (totalCount
+    # med og utan filter er like); elles hentar vi alt i éi usharda spørjing.
+    usharda = [{'studieprogramkodar': None}]
+    alle = akv_FS_programstudieretter_tal()
+    try:
+        with akv_sql_tilkopling() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT [studieprogramkode] FROM [stg].[FS_Studieprogram]")
+                studieprogramkodar = sorted(row[0] for row in cursor.fetchall())
+    except akv_sql_feil:
+        logging.warning("Får ikkje lese stg.FS_Studieprogram, hentar programStudieretter usharda")
+        logging.debug(traceback.format_exc())
+        studieprogramkodar = []
+    shardar = usharda
+    if studieprogramkodar and alle is not None:
+        dekte = akv_FS_programstudieretter_tal(studieprogramkodar)
+        if dekte == alle:
+            shardar = [{'studieprogramkodar': studieprogramkodar[i:i + akv_FS_studieprogram_per_shard]}
+                       for i in range(0, len(studieprogramkodar), akv_FS_studieprogram_per_shard)]
         else:
-            start = svar['data']['programStudieretter']['pageInfo']['endCursor']
-        variable = {'antal': antal_per_side, 'start': start}
-        n += 1
-        print(f"Hentar side {n} ({antal_per_side*(n-1)}-{antal_per_side*n})")
-        svar = akv_query_FS_graphql(query, variable)
-        try:
-            for pSr in svar['data']['programStudieretter']['nodes']:
-                try:
-                    plnr = pSr['personProfil']['personlopenummer']
-                except (TypeError, KeyError, ValueError):
-                    plnr = ''
-                try:
-                    studieprogram = pSr['studieprogram']['kode']
-                except (TypeError, KeyError, ValueError):
-                    studieprogram = ''
-                try:
-                    campus = pSr['campus']['navnAlleSprak']['nb']
-                except (TypeError, KeyError, ValueError):
-                    campus = ''
-                try:
-                    år = pSr['kull']['termin']['arstall']
-                except (TypeError, KeyError, ValueError):
-                    år = ''
-                try:
-                    termin = pSr['kull']['termin']['betegnelse']['navnAlleSprak']['nb']
-                except (TypeError, KeyError, ValueError):
-                    termin = ''
-                programstudierettar.append([plnr, studieprogram, campus, år, termin])
-        except (KeyError, TypeError):
-            raise Exception("Feil i henting av FS-data.")
-        hentmeir = svar['data']['programStudieretter']['pageInfo']['hasNextPage']
+            logging.warning(f"stg.FS_Studieprogram dekkjer {dekte} av {alle} programStudieretter, hentar usharda")
+    logging.debug(f"Hentar programStudieretter i {len(shardar)} delar")
+
+    hent_rad = akv_radhentar([('personProfil.personlopenummer', ''),
+                              ('studieprogram.kode', ''),
+                              ('campus.navnAlleSprak.nb', ''),
+                              ('kull.termin.arstall', ''),
+                              ('kull.termin.betegnelse.navnAlleSprak.nb', '')])
+    antal_per_side = 1000
 
-    with pyodbc.connect(conn_str) as connection:
-        try:
-            query = """
-            MERGE INTO [FS_ProgramStudieretter] AS target 
-            USING (VALUES (?, ?, ?, ?, ?)) AS source (plnr, studieprogram, campus, år, termin) 
-            ON target.[plnr] = source.[plnr]
-            WHEN MATCHED THEN
-                UPDATE SET 
-                    target.[termin] = source.[termin],
-                    target.[studieprogram] = source.[studieprogram],
-                    target.[campus] = source.[campus],
-                    target.[år] = source.[år]
-            WHEN NOT MATCHED THEN
-                INSERT ([plnr], [studieprogram], [campus], [år], [termin]) VALUES (source.[plnr], source.[studieprogram], source.[campus], source.[år], source.[termin]);
-            """
-            with connection.cursor() as cursor:
-                for data in programstudierettar:
-                    cursor.execute(query, (data[0], data[1], data[2], data[3], data[4]))
-                connection.commit()
-        except pyodbc.Error as exc:
-            logging.debug("Feil ved oppdatering av tabell FS_Emne.")
-            logging.debug(traceback.format_exc())
+    def hent_og_last_opp(shardar):
+        henta = 0
+
+        def rader(side):
+            nonlocal henta
+            nr, nodar = side
+            henta += len(nodar)
+            return nr, [hent_rad(pSr) for pSr in nodar]
+
+        # Henting (shardane), uttrekk av rader og opplasting går samstundes i kvar sin tråd.
+        # Sidene er nummererte etter del og side, så den same rada vinn for ein person med
+        # fleire studieretter same kva rekkjefølgje delane blir ferdige i.
+        sider = akv_FS_sharda_sider(query, shardar, 'programStudieretter', antal_per_side)
+        batchar = akv_røyr(sider, rader)
+        with akv_sql_tilkopling() as connection:
+            akv_bulk_merge_straum(connection, "FS_ProgramStudieretter", batchar, nummererte=True)
+        return henta
+
+    try:
+        henta = hent_og_last_opp(shardar)
+        if shardar is not usharda and henta != alle:
+            # Rader som manglar, blir lagde til; dei andre blir skrivne over med same innhald
+            logging.warning(f"Henta {henta} av {alle} programStudieretter i delar, hentar alt på nytt usharda")
+            hent_og_last_opp(usharda)
+    except akv_sql_feil as exc:
+        logging.debug("Feil ved oppdatering av tabell FS_ProgramStudieretter.")
+        logging.debug(traceback.format_exc())
     logging.info(f"Tidsbruk FS_ProgramStudieretter: {time.perf_counter() - start_les_FS_programstudierettar} s")
 
 
 def timer_Canvas_Terms():
     start_Canvas_Terms = time.perf_counter()
-    headers = {'Authorization': 'Bearer ' + os.environ["tokenCanvas"]}
-    url_template = 'https://hvl.instructure.com/api/v1/accounts/1/terms?sort=id&order=desc&per_page=100&page={0}'
-    with pyodbc.connect(conn_str) as cnxn:
-        with cnxn.cursor() as cursor:
-            page = 1
-            while True:
-                url = url_template.format(page)
-                response = requests.get(url, headers=headers)
-                data = response.json()['enrollment_terms']
-                if not data:
-                    break
-                for item in data:
-                    term_id = item['id']
-                    name = item['name']
-                    start_at = item['start_at']
-                    end_at = item['end_at']
-                    created_at = item['created_at']
-                    # (chatgpt)Removed unnecessary parameters and fixed the query
-                    canvas_term_query = """
-                        MERGE INTO [stg].[Canvas_Terms] AS t
-                        USING (VALUES (?, ?, ?, ?, ?)) AS s (
-                            [term_id],
-                            [name],
-                            [start_at],
-                            [end_at],
-                            [created_at]
-                        )
-                        ON t.[term_id] = s.[term_id]
-                        WHEN MATCHED THEN
-                            UPDATE SET
-                                t.[name] = s.[name],
-                                t.[start_at] = s.[start_at],
-                                t.[end_at] = s.[end_at],
-                                t.[created_at] = s.[created_at]
-                        WHEN NOT MATCHED THEN
-                            INSERT ([term_id], [name], [start_at], [end_at], [created_at])
-                            VALUES (s.[term_id], s.[name], s.[start_at], s.[end_at], s.[created_at]);
-                    """
-                    cursor.execute(canvas_term_query, term_id, name, start_at, end_at, created_at)
-                    cnxn.commit()
-                page += 1
-            logging.debug("Data lasta opp til Canvas_Terms")
+    terminar = []
+    for item in akv_canvas_sider("/api/v1/accounts/1/terms", {'sort': 'id', 'order': 'desc', 'per_page': 100}, nøkkel='enrollment_terms'):
+        terminar.append((item['id'], item['name'], item['start_at'], item['end_at'], item['created_at']))
+    with akv_sql_tilkopling() as cnxn:
+        akv_bulk_merge(cnxn, "stg.Canvas_Terms", terminar)
+        akv_nullstill_termincache()
+        logging.debug("Data lasta opp til Canvas_Terms")
     logging.info(f"Tidsbruk Canvas_Terms: {time.perf_counter() - start_Canvas_Terms} s")
 
 
 def timer_Canvas_Users():
     start_Canvas_Users = time.perf_counter()
-    headers = {'Authorization': 'Bearer ' + os.environ["tokenCanvas"]}
-    url_template = 'https://hvl.instructure.com/api/v1/accounts/54/users?sort=last_login&order=desc&per_page=100&page={0}'
-    with pyodbc.connect(conn_str) as cnxn:
-        with cnxn.cursor() as cursor:
-            page = 1
-            while True:
-                url = url_template.format(page)
-                response = requests.get(url, headers=headers)
-                data = response.json()
-                if not data:
-                    break
-                for item in data:
-                    user_id = item['id']
-                    sis_user_id = item['sis_user_id']
-                    created_at = item['created_at']
-                    root_account = item.get('root_account')
-                    last_login = item['last_login']                    
-                    query = """
-                        MERGE INTO [stg].[Canvas_Users] WITH (HOLDLOCK) AS t \
-                        USING (VALUES (?,?,?,?,?)) AS s(
-                            [user_id],
-                            [sis_user_id],
-                            [created_at],
-                            [root_account],
-                            [last_login]
-                        )
-                        ON t.[user_id] = s.[user_id]
-                        WHEN MATCHED THEN
-                            UPDATE SET
-                            t.[sis_user_id] = s.[sis_user_id],
-                            t.[created_at] = s.[created_at],
-                            t.[root_account] = s.[root_account],
-                            t.[last_login] = s.[last_login]
-                        WHEN NOT MATCHED THEN
-                            INSERT (
-                                [user_id],
-                                [sis_user_id],
-                                [created_at],
-                                [root_account],
-                                [last_login]
-                            )
-                            VALUES (
-                                s.[user_id],
-                                s.[sis_user_id],
-                                s.[created_at],
-                                s.[root_account],
-                                s.[last_login]
-                            );
-                    """
-                    cursor.execute(query, user_id, sis_user_id,
-                                   created_at, root_account, last_login)
-                    cnxn.commit()
-                page += 1
-            logging.debug("Data lasta opp til Canvas_Users")
+    brukarar = []
+    for item in akv_canvas_sider("/api/v1/accounts/54/users", {'sort': 'last_login', 'order': 'desc', 'per_page': 100}):
+        user_id = item['id']
+        sis_user_id = item['sis_user_id']
+        created_at = item['created_at']
+        root_account = item.get('root_account')
+        last_login = item['last_login']
+        brukarar.append((user_id, sis_user_id, created_at, root_account, last_login))
+    with akv_sql_tilkopling() as cnxn:
+        akv_bulk_merge(cnxn, "stg.Canvas_Users", brukarar)
+        logging.debug("Data lasta opp til Canvas_Users")
     logging.info(f"Tidsbruk Canvas_Users: {time.perf_counter() - start_Canvas_Users} s")
 
 
 def timer_Canvas_Courses():
     start_Canvas_Courses = time.perf_counter()
-    headers = {'Authorization': 'Bearer ' + os.environ["tokenCanvas"]}
-    url_template = 'https://hvl.instructure.com/api/v1/accounts/54/courses?sort=created_at&order=desc&per_page=100&page={0}'
-    with pyodbc.connect(conn_str) as cnxn:
-        with cnxn.cursor() as cursor:
-            page = 1
-            while True:
-                url = url_template.format(page)
-                response = requests.get(url, headers=headers)
-                data = response.json()
-                if not data:
-                    break
-                for item in data:
-                    course_id = item['id']
-                    name = item['name']
-                    course_code = item['course_code']
-                    sis_course_id = item['sis_course_id']
-                    enrollment_term_id = item['enrollment_term_id']
-                    account_id = item['account_id']
-                    start_at = item['start_at']
-                    conclude_at = item['end_at']
-                    created_at = item['created_at']
-                    updated_at = item.get('updated_at')
-                    root_account_id = item['root_account_id']
-                    workflow_state = item['workflow_state']
-                    login_id = item.get('login_id')
-                    if (sis_course_id is not None) and ('_203_' in sis_course_id):
-                        emnekode = sis_course_id.split("_")[2]
-                        versjonskode = sis_course_id.split("_")[3]
-                    else:
-                        emnekode = ' '
-                        versjonskode = ' '
-                    query = """
-                        MERGE INTO [stg].[Canvas_Courses] WITH (HOLDLOCK) AS t
-                        USING (VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)) AS s(
-                            [course_id],
-                            [name],
-                            [course_code],
-                            [sis_course_id],
-                            [enrollment_term_id],
-                            [account_id],
-                            [start_at],
-                            [conclude_at],
-                            [created_at],
-                            [updated_at],
-                            [root_account_id],
-                            [workflow_state],
-                            [login_id],
-                            [emnekode],
-                            [versjonskode]
-                        )
-                        ON t.[course_id] = s.[course_id]
-                        WHEN MATCHED THEN
-                            UPDATE SET 
-                                t.[name] = s.[name],
-                                t.[course_code] = s.[course_code],
-                                t.[sis_course_id] = s.[sis_course_id],
-                                t.[enrollment_term_id] = s.[enrollment_term_id],
-                                t.[account_id] = s.[account_id],
-                                t.[start_at] = s.[start_at],
-                                t.[conclude_at] = s.[conclude_at],
-                                t.[created_at] = s.[created_at],
-                                t.[updated_at] = s.[updated_at],
-                                t.[root_account_id] = s.[root_account_id],
-                                t.[workflow_state] = s.[workflow_state],
-                                t.[login_id] = s.[login_id],
-                                t.[emnekode] = s.[emnekode],
-                                t.[versjonskode] = s.[versjonskode]
-                        WHEN NOT MATCHED THEN
-                            INSERT ([course_id],
-                                [name],
-                                [course_code],
-                                [sis_course_id],
-                                [enrollment_term_id],
-                                [account_id],
-                                [start_at],
-                                [conclude_at],
-                                [created_at],
-                                [updated_at],
-                                [root_account_id],
-                                [workflow_state],
-                                [login_id],
-                                [emnekode],
-                                [versjonskode]
-                            )
-                            VALUES (s.[course_id],
-                                s.[name],
-                                s.[course_code],
-                                s.[sis_course_id],
-                                s.[enrollment_term_id],
-                                s.[account_id],
-                                s.[start_at],
-                                s.[conclude_at],
-                                s.[created_at],
-                                s.[updated_at],
-                                s.[root_account_id],
-                                s.[workflow_state],
-                                s.[login_id],
-                                s.[emnekode],
-                                s.[versjonskode]
-                            );
-                    """
-                    try:
-                        cursor.execute(query, course_id, name, course_code, sis_course_id, enrollment_term_id, account_id,
-                                       start_at, conclude_at, created_at, updated_at, root_account_id, workflow_state, login_id, emnekode, versjonskode)
-                        cnxn.commit()
-                    except pyodbc.Error as feil:
-                        logging.error(f"Noko gjekk galt med opplasting av {emnekode}: {feil}")
-                page += 1
-            logging.debug("Data lasta opp til Canvas_Courses")
+    emne = []
+    for item in akv_canvas_sider("/api/v1/accounts/54/courses", {'sort': 'created_at', 'order': 'desc', 'per_page': 100}):
+        course_id = item['id']
+        name = item['name']
+        course_code = item['course_code']
+        sis_course_id = item['sis_course_id']
+        enrollment_term_id = item['enrollment_term_id']
+        account_id = item['account_id']
+        start_at = item['start_at']
+        conclude_at = item['end_at']
+        created_at = item['created_at']
+        updated_at = item.get('updated_at')
+        root_account_id = item['root_account_id']
+        workflow_state = item['workflow_state']
+        login_id = item.get('login_id')
+        if (sis_course_id is not None) and ('_203_' in sis_course_id):
+            emnekode = sis_course_id.split("_")[2]
+            versjonskode = sis_course_id.split("_")[3]
+        else:
+            emnekode = ' '
+            versjonskode = ' '
+        emne.append((course_id, name, course_code, sis_course_id, enrollment_term_id, account_id, start_at, conclude_at,
+                     created_at, updated_at, root_account_id, workflow_state, login_id, emnekode, versjonskode))
+    try:
+        with akv_sql_tilkopling() as cnxn:
+            akv_bulk_merge(cnxn, "stg.Canvas_Courses", emne)
+        akv_nullstill_termincache()
+        logging.debug("Data lasta opp til Canvas_Courses")
+    except akv_sql_feil as feil:
+        logging.error(f"Noko gjekk galt med opplasting av Canvas_Courses: {feil}")
     logging.info(f"Tidsbruk Canvas_Courses: {time.perf_counter() - start_Canvas_Courses} s")
 
 
 def timer_Canvas_Enrollments_Ny():
     start_Canvas_Enrollments_Ny = time.perf_counter()
+    timer_CD2(["enrollments"])
+    logging.info(f"Tidsbruk Canvas_Enrollments_Ny: {time.perf_counter() - start_Canvas_Enrollments_Ny} s")
 
-    CD2_access_token = akv_hent_CD2_access_token()
-    headers = {'x-instauth': CD2_access_token, 'Content-Type': 'text/plain'}
-
-    tabell = "enrollments"
-    sist_oppdatert_dato = f"{igår.year}-{igår.month:02}-{igår.day:02}T{12}:00:00Z"
-    payload = '{"format": "csv", "since": \"%s\"}' % (sist_oppdatert_dato)
 
-    try:
-        requesturl = f"{CD2_base_url}/dap/query/canvas/table/{tabell}/data"
-        logging.debug(f"Sender søk til {requesturl}")
-        r = requests.request("POST", requesturl, headers=headers, data=payload)
-        if r.status_code == 200:
-            respons = r.json()
-            id = respons['id']
-            vent = True
-            while vent:
-                requesturl = f"{CD2_base_url}/dap//job/{id}"
-                r2 = requests.request("GET", requesturl, headers=headers)
-                time.sleep(5)
-                respons2 = r2.json()
-                logging.debug(respons2)
-                if respons2['status'] == "complete":
-                    vent = False
-        else:
-            logging.error(f"Feil i spørjing mot CD2, kode {r.status_code}")
-        antal = len(respons2['objects'])
-        data_i_dag = []
-        for i in range(antal):
-            data = io.StringIO(akv_hent_CD2_filar(
-                respons2['objects'][i]['id'], CD2_access_token, respons2))
-            df = pd.read_csv(data, sep=",")
-            data_i_dag.append(df)
-        # logging.info(f"Har henta {len(data_i_dag)} filer med enrollments")
-    except RuntimeError:
-        logging.error("Får ikkje lasta data frå enrollments i Canvas Data 2")
-    dataliste = [data_i_dag[0][['key.id', 'value.user_id', 'value.course_id', 'value.type', 'value.created_at', 'value.updated_at', 'value.start_at', 'value.end_at', 'value.workflow_state', 'value.total_activity_time', 'value.last_activity_at']]]
-    for datasett in data_i_dag[1:]:
-        dataliste.append(datasett[['key.id', 'value.user_id', 'value.course_id', 'value.type', 'value.created_at', 'value.updated_at', 'value.start_at', 'value.end_at', 'value.workflow_state', 'value.total_activity_time', 'value.last_activity_at']])
-    oppsamla = pd.concat(dataliste)
+def akv_handsam_Canvas_Enrollments_Ny(alledata, sist_oppdatert, until):
+    """
+    Last opp endringane i enrollments frå CD2 (parquet) til stg.Canvas_Enrollments.
+    """
+    oppsamla = alledata[['key.id', 'value.user_id', 'value.course_id', 'value.type', 'value.created_at', 'value.updated_at', 'value.start_at', 'value.end_at', 'value.workflow_state', 'value.total_activity_time', 'value.last_activity_at']].copy()
     oppsamla['sis_user_id'] = " "
-    oppsamla['value.total_activity_time'] = oppsamla['value.total_activity_time'].fillna(0.0)
-    oppsamla['value.total_activity_time'] = oppsamla['value.total_activity_time'].astype(int)
-    # Ensure created_at, updated_at, start_at, end_at, and last_activity_at are datetime
-    oppsamla['value.created_at'] = oppsamla['value.created_at'].apply(lambda x: None if np.isnan(x) else pd.to_datetime(x))
-    oppsamla['value.updated_at'] = oppsamla['value.updated_at'].apply(lambda x: None if np.isnan(x) else pd.to_datetime(x))
-    oppsamla['value.start_at'] = oppsamla['value.start_at'].apply(lambda x: None if np.isnan(x) else pd.to_datetime(x))
-    oppsamla['value.end_at'] = oppsamla['value.end_at'].apply(lambda x: None if np.isnan(x) else pd.to_datetime(x))
+    oppsamla['value.total_activity_time'] = oppsamla['value.total_activity_time'].fillna(0).astype(int)
+    # Parquet-fila gir tidspunkta som datetime (UTC); databasen vil ha dei utan tidssone
+    for kolonne in ['value.created_at', 'value.updated_at', 'value.start_at', 'value.end_at', 'value.last_activity_at']:
+        oppsamla[kolonne] = pd.to_datetime(oppsamla[kolonne], utc=True).dt.tz_convert(None)
+    oppsamla = oppsamla.astype(object).where(oppsamla.notna(), None)
     dikt = oppsamla.to_dict('records')
 
     data_to_insert = []
@@ -1221,189 +2645,97 @@ def timer_Canvas_Enrollments_Ny():
             e['value.workflow_state'],
             e['value.total_activity_time'],
             e['value.last_activity_at']))
-    query = """
-        MERGE INTO [stg].[Canvas_Enrollments] AS target
-        USING (SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) AS source (
-            [enrollment_id],
-            [user_id],
-            [sis_user_id],
-            [course_id],
-            [type],
-            [created_at],
-            [updated_at],
-            [start_at],
-            [end_at],
-            [enrollment_state],
-            [total_activity_time],
-            [last_activity_at]
-        )
-        ON target.[enrollment_id] = source.[enrollment_id]
-        WHEN MATCHED THEN
-            UPDATE SET target.[user_id]= source.[user_id],
-                target.[sis_user_id] = source.[sis_user_id],
-                target.[course_id] = source.[course_id],
-                target.[type] = source.[type],
-                target.[created_at] = source.[created_at],
-                target.[updated_at] = source.[updated_at],
-                target.[start_at] = source.[start_at],
-                target.[end_at] = source.[end_at],
-                target.[enrollment_state] = source.[enrollment_state],
-                target.[total_activity_time] = source.[total_activity_time],
-                target.[last_activity_at] = source.[last_activity_at]
-        WHEN NOT MATCHED THEN
-            INSERT ([enrollment_id],
-                [user_id],
-                [sis_user_id],
-                [course_id],
-                [type],
-                [created_at],
-                [updated_at],
-                [start_at],
-                [end_at],
-                [enrollment_state],
-                [total_activity_time],
-                [last_activity_at]
-            )
-        VALUES (source.[enrollment_id],
-            source.[user_id],
-            source.[sis_user_id],
-            source.[course_id],
-            source.[type],
-            source.[created_at],
-            source.[updated_at],
-            source.[start_at],
-            source.[end_at],
-            source.[workflow_state],
-            source.[total_activity_time],
-            source.[last_activity_at]
-        );
-    """
     try:
-        første_feil = True
-
-        def is_valid_bigint(value):
-            try:
-                # Convert to integer and check if it fits within the range of bigint
-                int_value = int(value)
-                if -(2**63) <= int_value <= (2**63 - 1):
-                    return True
-                else:
-                    return False
-            except ValueError:
-                return False
-
-        with pyodbc.connect(conn_str) as cnxn:
-            with cnxn.cursor() as cursor:
-                for data in data_to_insert:
-                    if første_feil:
-                        try:
-                            cursor.execute(query, data)
-                        except:
-                            første_feil = False
-                            logging.error(f"Feil ved opplasting av ein post.\nData: {data}")
-                            logging.error(traceback.format_exc())
-                cnxn.commit()
+        with akv_sql_tilkopling() as cnxn:
+            akv_bulk_merge(cnxn, "stg.Canvas_Enrollments", data_to_insert)
     except:
         logging.error(f"Feil når eg skal legge enrollments inn i tabellen.")
         logging.error(traceback.format_exc())
-    logging.info(f"Tidsbruk Canvas_Enrollments_Ny: {time.perf_counter() - start_Canvas_Enrollments_Ny} s")
+
+
+def akv_CD2_sidan_igår(tabell):
+    """
+    since for CD2-tabellar som blir henta frå «kl. 12 føremiddag i går».
+    """
+    return f"{igår.year}-{igår.month:02}-{igår.day:02}T{12}:00:00Z"
+
+
+# CD2-tabellane timer_CD2 kan hente: korleis since blir funnen, kva format filene skal
+# ha, og funksjonen som tek imot (alledata, sist_oppdatert, until) for tabellen
+akv_CD2_oppgåver = {
+    'calendar_events': {'since': akv_CD2_sidan_igår, 'format': "csv", 'handsamar': akv_handsam_Canvas_Calendar},
+    'enrollments': {'since': akv_CD2_sidan_igår, 'format': "parquet", 'handsamar': akv_handsam_Canvas_Enrollments_Ny},
+    'pseudonyms': {'since': akv_CD2_lager_since, 'format': "parquet", 'handsamar': akv_handsam_CD2_pseudonyms},
+}
+# Tabellane i den nattlege timer_CD2
+akv_CD2_nattlege = ['calendar_events', 'enrollments']
+
+
+def timer_CD2(tabellar=None):
+    """
+    Hent CD2-tabellane (standard akv_CD2_nattlege) i éin runde: jobbane for alle
+    tabellane blir starta samstundes (sjå akv_les_CD2_tabellar), og kvar tabell blir
+    handsama så snart han er klar. Ein tabell som feilar, stoppar ikkje dei andre.
+    """
+    if tabellar is None:
+        tabellar = akv_CD2_nattlege
+    oppgåver = {tabell: akv_CD2_oppgåver[tabell] for tabell in tabellar}
+    since = {tabell: oppgåve['since'](tabell) for tabell, oppgåve in oppgåver.items()}
+    formatar = {tabell: oppgåve['format'] for tabell, oppgåve in oppgåver.items()}
+    try:
+        for tabell, alledata, sist_oppdatert, until in akv_les_CD2_tabellar(tabellar, since=since, format=formatar):
+            try:
+                with akv_måling(f"cd2:{tabell}"):
+                    oppgåver[tabell]['handsamar'](alledata, sist_oppdatert, until)
+            except Exception:
+                logging.exception(f"Feil ved handsaming av CD2-tabellen {tabell}")
+    except (RuntimeError, CD2Feil):
+        logging.exception(f"{idag}: får ikkje lasta data frå Canvas Data 2")
 
 
 def timer_Canvas_Enrollments():
     start_Canvas_Enrollments = time.perf_counter()
-    with pyodbc.connect(conn_str) as conn:
-        cursor = conn.cursor()
-        try:
-            query = """
-            SELECT ALL * FROM [stg].[Canvas_Terms]
-            """
-            cursor.execute(query)
-            row = cursor.fetchall()
-            terminar = []
-            for t in row:
-                try:
-                    term_id = t[0]
-                    name = t[1]
-                    start_at = t[2]
-                    end_at = t[3]
-                    created_at = t[4]
-                    terminar.append([term_id, name, start_at, end_at, created_at])
-                except IndexError:
-                    logging.error("Ingen data i denne raden: {t}")
-        except pyodbc.Error as e:
-            logging.error(f"Feil: {e}")
-
-    aktuelle_terminar = []
-    try:
-        for t in terminar:
-            desimal = int(år) + 0.5*(termin == 'HØST')
-            if '-' in t[1]:
-                start_termin = t[1].split('-')[0]
-                slutt_termin = t[1].split('-')[1]
-                start_år = start_termin.split(' ')[0]
-                slutt_år = slutt_termin.split(' ')[0]
-                start_semester = start_termin.split(' ')[1]
-                slutt_semester = slutt_termin.split(' ')[1]
-                start_desimal = int(start_år) + 0.5*(start_semester == 'HØST')
-                slutt_desimal = int(slutt_år) + 0.5*(slutt_semester == 'HØST')
-                if start_desimal <= desimal <= slutt_desimal:
-                    aktuelle_terminar.append(t[0])
-                else:
-                    pass
-            elif t[1] == f"{str(år)} {termin}":
-                aktuelle_terminar.append(t[0])
-            else:
-                pass
-    except:
-        logging.error(f"Feil: {traceback.format_exc()}")
+    aktuelle_emne = akv_aktuelle_emne()
 
-    with pyodbc.connect(conn_str) as conn:
-        cursor = conn.cursor()
-        try:
-            query = """
-            SELECT ALL * FROM [stg].[Canvas_Courses]
-            """
-            cursor.execute(query)
-            row = cursor.fetchall()
-            aktuelle_emne = []
-            for emne in row:
-                try:
-                    if emne[4] in aktuelle_terminar:
-                        aktuelle_emne.append(emne[0])
-                except IndexError:
-                    pass
-        except pyodbc.Error as e:
-            logging.error(f"Feil: {e}")
-
-    queryCanvas = """
-    query MyQuery($courseId: ID!) {
-        course(id: $courseId) {
-            enrollmentsConnection {
-                nodes {
-                    user {
-                        _id
-                        sisId
-                        createdAt
-                        updatedAt
-                        name
-                    }
-                    type
-                    state
+    # Tal på påmeldingar per emne frå førre køyring, for å storleikstilpasse batchane
+    påmeldingar_per_emne = {}
+    try:
+        with akv_sql_tilkopling() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT [course_id], COUNT(*) FROM [stg].[Canvas_Enrollments] GROUP BY [course_id]")
+                påmeldingar_per_emne = {row[0]: row[1] for row in cursor.fetchall()}
+    except akv_sql_feil as e:
+        logging.error(f"Feil: {e}")
+
+    utvalCanvas = """{
+        enrollmentsConnection(first: $antal, after: $start) {
+            pageInfo {
+                endCursor
+                hasNextPage
+            }
+            nodes {
+                user {
                     _id
-                    totalActivityTime
-                    lastActivityAt
+                    sisId
+                    createdAt
+                    updatedAt
+                    name
                 }
+                type
+                state
+                _id
+                totalActivityTime
+                lastActivityAt
             }
         }
     }
     """
     statistikk = []
     enrollments_data = []
+    kurs = akv_canvas_graphql_samla('course', 'Course', utvalCanvas, aktuelle_emne, påmeldingar_per_emne)
     for emne in aktuelle_emne:
-        variables = {"courseId": emne}
         try:
-            resultat = akv_query_canvas_graphql(queryCanvas, variables)
-            enrollments = resultat['data']['course']['enrollmentsConnection']['nodes']
+            enrollments = kurs[emne]['enrollmentsConnection']['nodes']
             for enrollment in enrollments:
                 enrollment_id = enrollment['_id']
                 user_id = enrollment['user']['_id']
@@ -1429,397 +2761,122 @@ def timer_Canvas_Enrollments():
         except:
             logging.error(f"Feil: {traceback.format_exc()}")
 
-    with pyodbc.connect(conn_str) as cnxn:
-        with cnxn.cursor() as cursor:
-            try:
-                for row in enrollments_data:
-                    merge_query = """
-                        MERGE INTO [stg].[Canvas_Enrollments] AS target
-                        USING (SELECT ?, ?, ?, ?, ?, CONVERT(datetime, ?, 127), CONVERT(datetime, ?, 127), ?, ?, CONVERT(datetime, ?, 127)) AS source (
-                            [enrollment_id],
-                            [user_id],
-                            [sis_user_id],
-                            [course_id],
-                            [type],
-                            [created_at],
-                            [updated_at],
-                            [enrollment_state],
-                            [total_activity_time],
-                            [last_activity_at]
-                        )
-                        ON target.[enrollment_id] = source.[enrollment_id]
-                        WHEN MATCHED THEN
-                            UPDATE SET target.[user_id]= source.[user_id],
-                                target.[sis_user_id] = source.[sis_user_id],
-                                target.[course_id] = source.[course_id],
-                                target.[type] = source.[type],
-                                target.[created_at] = source.[created_at],
-                                target.[updated_at] = source.[updated_at],
-                                target.[enrollment_state] = source.[enrollment_state],
-                                target.[total_activity_time] = source.[total_activity_time],
-                                target.[last_activity_at] = source.[last_activity_at]
-                        WHEN NOT MATCHED THEN
-                            INSERT ([enrollment_id],
-                                [user_id],
-                                [sis_user_id],
-                                [course_id],
-                                [type],
-                                [created_at],
-                                [updated_at],
-                                [enrollment_state],
-                                [total_activity_time],
-                                [last_activity_at]
-                            )
-                            VALUES (source.[enrollment_id],
-                                source.[user_id],
-                                source.[sis_user_id],
-                                source.[course_id],
-                                source.[type],
-                                source.[created_at],
-                                source.[updated_at],
-                                source.[enrollment_state],
-                                source.[total_activity_time],
-                                source.[last_activity_at]
-                            );
-                    """
-                    cursor.execute(merge_query, row)
-            except pyodbc.Error as e:
-                logging.error(f"Feil: {e}\n{row}")
-            cnxn.commit()
+    try:
+        with akv_sql_tilkopling() as cnxn:
+            akv_bulk_merge(cnxn, "stg.Canvas_Enrollments", enrollments_data,
+                           kolonnar=['enrollment_id', 'user_id', 'sis_user_id', 'course_id', 'type', 'created_at',
+                                     'updated_at', 'enrollment_state', 'total_activity_time', 'last_activity_at'])
+    except akv_sql_feil as e:
+        logging.error(f"Feil: {e}")
     logging.info(f"Tidsbruk Canvas_Enrollments: {time.perf_counter() - start_Canvas_Enrollments} s")
 
 def timer_Canvas_Courses_StudentSummaries():
     start_Canvas_StudentSummaries = time.perf_counter()
-    headers = {'Authorization': 'Bearer ' + os.environ["tokenCanvas"]}
-    url_template = 'https://hvl.instructure.com/api/v1/courses/{course_id}/analytics/student_summaries?per_page=100&page={page_number}'
-
-    with pyodbc.connect(conn_str) as conn:
-        cursor = conn.cursor()
-        try:
-            query = """
-            SELECT ALL * FROM [stg].[Canvas_Terms]
-            """
-            cursor.execute(query)
-            row = cursor.fetchall()
-            terminar = []
-            for t in row:
-                try:
-                    term_id = t[0]
-                    name = t[1]
-                    start_at = t[2]
-                    end_at = t[3]
-                    created_at = t[4]
-                    terminar.append([term_id, name, start_at, end_at, created_at])
-                except IndexError:
-                    logging.error("Ingen data i denne raden: {t}")
-        except pyodbc.Error as e:
-            logging.error(f"Feil: {e}")
-
-    aktuelle_terminar = []
-    try:
-        for t in terminar:
-            desimal = int(år) + 0.5*(termin == 'HØST')
-            if '-' in t[1]:
-                start_termin = t[1].split('-')[0]
-                slutt_termin = t[1].split('-')[1]
-                start_år = start_termin.split(' ')[0]
-                slutt_år = slutt_termin.split(' ')[0]
-                start_semester = start_termin.split(' ')[1]
-                slutt_semester = slutt_termin.split(' ')[1]
-                start_desimal = int(start_år) + 0.5*(start_semester == 'HØST')
-                slutt_desimal = int(slutt_år) + 0.5*(slutt_semester == 'HØST')
-                if start_desimal <= desimal <= slutt_desimal:
-                    aktuelle_terminar.append(t[0])
-                else:
-                    pass
-            elif t[1] == f"{str(år)} {termin}":
-                aktuelle_terminar.append(t[0])
-            else:
-                pass
-    except:
-        logging.error(f"Feil: {traceback.format_exc()}")
+    aktuelle_emne = akv_aktuelle_emne()
 
-    with pyodbc.connect(conn_str) as conn:
-        cursor = conn.cursor()
+    oppsummeringar = []
+    for emne in aktuelle_emne:
         try:
-            query = """
-            SELECT ALL * FROM [stg].[Canvas_Courses]
-            """
-            cursor.execute(query)
-            row = cursor.fetchall()
-            aktuelle_emne = []
-            for emne in row:
-                try:
-                    if emne[4] in aktuelle_terminar:
-                        aktuelle_emne.append(emne[0])
-                except IndexError:
-                    pass
-        except pyodbc.Error as e:
-            logging.error(f"Feil: {e}")
-
-    with pyodbc.connect(conn_str) as cnxn:
-        cursor = cnxn.cursor()
-        for emne in aktuelle_emne:
-            page_number = 1
-            while True:
-                url = url_template.format(course_id=emne, page_number=page_number)
-                response = requests.get(url, headers=headers)
-                data = response.json()
-                if not data or 'errors' in data:
-                    break
-                for item in data:
-                    user_id = item['id']
-                    page_views = item['page_views']
-                    max_page_views = item['max_page_views']
-                    page_views_level = item['page_views_level']
-                    participations = item['participations']
-                    max_participations = item['max_participations']
-                    participations_level = item['participations_level']
-                    course_id = emne
-                    missing = item['tardiness_breakdown']['missing']
-                    late = item['tardiness_breakdown']['late']
-                    on_time = item['tardiness_breakdown']['on_time']
-                    floating = item['tardiness_breakdown']['floating']
-                    total = item['tardiness_breakdown']['total']
-                    merge_query = """
-                        MERGE INTO [stg].[Canvas_Courses_StudentSummaries] AS target
-                        USING (SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) AS source (
-                            page_views,
-                            id,
-                            max_page_views,
-                            page_views_level,
-                            participations,
-                            max_participations,
-                            participations_level,
-                            course_id,
-                            missing,
-                            late,
-                            on_time,
-                            floating,
-                            total
-                        )
-                        ON target.id = source.id AND target.course_id = source.course_id
-                        WHEN MATCHED THEN
-                            UPDATE SET 
-                                target.max_page_views = source.max_page_views,
-                                target.page_views = source.page_views,
-                                target.page_views_level = source.page_views_level,
-                                target.participations = source.participations,
-                                target.max_participations = source.max_participations,
-                                target.participations_level = source.participations_level,
-                                target.missing = source.missing,
-                                target.late = source.late,
-                                target.on_time = source.on_time,
-                                target.floating = source.floating,
-                                target.total = source.total
-                        WHEN NOT MATCHED THEN
-                            INSERT (
-                                page_views,
-                                id,
-                                max_page_views,
-                                page_views_level,
-                                participations,
-                                max_participations,
-                                participations_level,
-                                course_id,
-                                missing,
-                                late,
-                                on_time,
-                                floating,
-                                total
-                            )
-                            VALUES (
-                                source.page_views,
-                                source.id,
-                                source.max_page_views,
-                                source.page_views_level,
-                                source.participations,
-                                source.max_participations,
-                                source.participations_level,
-                                source.course_id,
-                                source.missing,
-                                source.late,
-                                source.on_time,
-                                source.floating,
-                                source.total
-                            );
-                    """
-                    cursor.execute(merge_query, page_views, user_id, max_page_views, page_views_level, participations,
-                                    max_participations, participations_level, course_id, missing, late, on_time, floating, total)
-                cnxn.commit()
-                page_number += 1
-            logging.debug("Data lasta opp til Canvas_Courses_StudentSummaries")
+            for item in akv_canvas_sider(f"/api/v1/courses/{emne}/analytics/student_summaries", {'per_page': 100}):
+                user_id = item['id']
+                page_views = item['page_views']
+                max_page_views = item['max_page_views']
+                page_views_level = item['page_views_level']
+                participations = item['participations']
+                max_participations = item['max_participations']
+                participations_level = item['participations_level']
+                course_id = emne
+                missing = item['tardiness_breakdown']['missing']
+                late = item['tardiness_breakdown']['late']
+                on_time = item['tardiness_breakdown']['on_time']
+                floating = item['tardiness_breakdown']['floating']
+                total = item['tardiness_breakdown']['total']
+                oppsummeringar.append((page_views, user_id, max_page_views, page_views_level, participations,
+                                       max_participations, participations_level, course_id, missing, late, on_time, floating, total))
+        except requests.exceptions.HTTPError as feil:
+            logging.warning(f"Fekk ikkje henta student_summaries for emne {emne}: {feil}")
+    with akv_sql_tilkopling() as cnxn:
+        akv_bulk_merge(cnxn, "stg.Canvas_Courses_StudentSummaries", oppsummeringar)
+        logging.debug("Data lasta opp til Canvas_Courses_StudentSummaries")
     logging.info(f"Tidsbruk Canvas_StudentSummaries: {time.perf_counter() - start_Canvas_StudentSummaries} s")
 
 
 def timer_Canvas_Modules():
     start_Canvas_Modules = time.perf_counter()
-    headers = {'Authorization': 'Bearer ' + os.environ["tokenCanvas"]}
-    url_template = 'https://hvl.instructure.com/api/v1/courses/{course_id}/modules?include[]=items&per_page=100&page={page_number}'
-    with pyodbc.connect(conn_str) as conn:
-        cursor = conn.cursor()
-        try:
-            query = """
-            SELECT ALL * FROM [stg].[Canvas_Terms]
-            """
-            cursor.execute(query)
-            row = cursor.fetchall()
-            terminar = []
-            for t in row:
-                try:
-                    term_id = t[0]
-                    name = t[1]
-                    start_at = t[2]
-                    end_at = t[3]
-                    created_at = t[4]
-                    terminar.append([term_id, name, start_at, end_at, created_at])
-                except IndexError:
-                    logging.error("Ingen data i denne raden: {t}")
-        except pyodbc.Error as e:
-            logging.error(f"Feil: {e}")
-        aktuelle_terminar = []
-        try:
-            for t in terminar:
-                desimal = int(år) + 0.5*(termin == 'HØST')
-                if '-' in t[1]:
-                    start_termin = t[1].split('-')[0]
-                    slutt_termin = t[1].split('-')[1]
-                    start_år = start_termin.split(' ')[0]
-                    slutt_år = slutt_termin.split(' ')[0]
-                    start_semester = start_termin.split(' ')[1]
-                    slutt_semester = slutt_termin.split(' ')[1]
-                    start_desimal = int(start_år) + 0.5*(start_semester == 'HØST')
-                    slutt_desimal = int(slutt_år) + 0.5*(slutt_semester == 'HØST')
-                    if start_desimal <= desimal <= slutt_desimal:
-                        aktuelle_terminar.append(t[0])
-                    else:
-                        pass
-                elif t[1] == f"{str(år)} {termin}":
-                    aktuelle_terminar.append(t[0])
-                else:
-                    pass
-        except:
-            logging.error(f"Feil: {traceback.format_exc()}")
+    aktuelle_emne = akv_aktuelle_emne()
 
-    with pyodbc.connect(conn_str) as conn:
-        cursor = conn.cursor()
+    moduler = []
+    for emne in aktuelle_emne:
         try:
-            query = """
-            SELECT ALL * FROM [stg].[Canvas_Courses]
-            """
-            cursor.execute(query)
-            row = cursor.fetchall()
-            aktuelle_emne = []
-            for emne in row:
-                try:
-                    if emne[4] in aktuelle_terminar:
-                        aktuelle_emne.append(emne[0])
-                except IndexError:
-                    pass
-        except pyodbc.Error as e:
-            logging.error(f"Feil: {e}")
-
-    with pyodbc.connect(conn_str) as cnxn:
-        cursor = cnxn.cursor()
-        for emne in aktuelle_emne:
-            page_number = 1
-            while True:
-                url = url_template.format(course_id=emne, page_number=page_number)
-                response = requests.get(url, headers=headers)
-                data = response.json()
-                if not data or 'errors' in data:
-                    break
-                for item in data:
-                    module_id = item['id']
-                    name = item['name']
-                    published = item['published']
-                    items_count = item['items_count']
-                    items_url = item['items_url']
-                    course_id = emne
-                    for items in item['items']:
-                        module_item_id = items['id']
-                        title = items['title']
-                        type = items['type']
-                        parent_module_id = items['module_id']
-                        item_published = items['published']
-                        if 'external_url' in item:
-                            external_url = items['external_url']
-                        else:
-                            external_url = None
-                        merge_query = """
-                            MERGE INTO [stg].[Canvas_Modules] AS target
-                            USING (SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) AS source (
-                                [items_count],
-                                [items_url],
-                                [module_id],
-                                [course_id],
-                                [type],
-                                [module_item_id],
-                                [title],
-                                [parent_module_id],
-                                [external_url],
-                                [item_published],
-                                [name],
-                                [published]
-                            )
-                            ON target.[module_id] = source.[module_id] and target.[module_item_id] = source.[module_item_id]
-                            WHEN MATCHED THEN
-                                UPDATE SET 
-                                    target.[items_url] = source.[items_url],
-                                    target.[items_count] = source.[items_count],
-                                    target.[course_id] = source.[course_id],
-                                    target.[type] = source.[type],
-                                    target.[title] = source.[title],
-                                    target.[parent_module_id] = source.[parent_module_id],
-                                    target.[external_url] = source.[external_url],
-                                    target.[item_published] = source.[item_published],
-                                    target.[name] = source.[name],
-                                    target.[published] = source.[published]
-                            WHEN NOT MATCHED THEN
-                                INSERT (
-                                    [items_count],
-                                    [items_url],
-                                    [module_id],
-                                    [course_id],
-                                    [type],
-                                    [module_item_id],
-                                    [title],
-                                    [parent_module_id],
-                                    [external_url],
-                                    [item_published],
-                                    [name],
-                                    [published]
-                                )
-                            VALUES (
-                                source.[items_count],
-                                source.[items_url],
-                                source.[module_id],
-                                source.[course_id],
-                                source.[type],
-                                source.[module_item_id],
-                                source.[title],
-                                source.[parent_module_id],
-                                source.[external_url],
-                                source.[item_published],
-                                source.[name],
-                                source.[published]
-                            );
-                        """
-                        cursor.execute(merge_query, items_count, items_url, module_id, course_id, type,
-                                        module_item_id, title, parent_module_id, external_url, item_published, name, published)
-                    cnxn.commit()
-                page_number += 1
-            logging.debug("Data lasta opp til Canvas_Modules")
+            for item in akv_canvas_sider(f"/api/v1/courses/{emne}/modules", {'include[]': 'items', 'per_page': 100}):
+                module_id = item['id']
+                name = item['name']
+                published = item['published']
+                items_count = item['items_count']
+                items_url = item['items_url']
+                course_id = emne
+                for items in item['items']:
+                    module_item_id = items['id']
+                    title = items['title']
+                    type = items['type']
+                    parent_module_id = items['module_id']
+                    item_published = items['published']
+                    if 'external_url' in item:
+                        external_url = items['external_url']
+                    else:
+                        external_url = None
+                    moduler.append((items_count, items_url, module_id, course_id, type,
+                                    module_item_id, title, parent_module_id, external_url, item_published, name, published))
+        except requests.exceptions.HTTPError as feil:
+            logging.warning(f"Fekk ikkje henta moduler for emne {emne}: {feil}")
+    with akv_sql_tilkopling() as cnxn:
+        akv_bulk_merge(cnxn, "stg.Canvas_Modules", moduler)
+        logging.debug("Data lasta opp til Canvas_Modules")
     logging.info(f"Tidsbruk Canvas_Modules: {time.perf_counter() - start_Canvas_Modules} s")
 
+def akv_canvas_tid(tekst):
+    """
+    Gjer om eit tidspunkt frå Canvas ("2024-03-01T12:34:56Z") til datetime i UTC utan tidssone,
+    slik det blir lagra i DATETIME2-kolonnar.
+    """
+    return pd.Timestamp(tekst).tz_convert('UTC').tz_localize(None).to_pydatetime()
+
+
+def akv_hent_Canvas_History(user_id, sist_sett=None):
+    """
+    Hent ny historikk for ein brukar og returner (rader til stg.Canvas_History, nyaste visited_at).
+
+    Canvas gir historikken med nyaste først, så vi sluttar å bla når vi kjem til
+    sist_sett (nyaste visited_at frå førre køyring). Utan sist_sett hentar vi alt.
+    """
+    rader = []
+    nyaste = sist_sett
+    for item in akv_canvas_sider(f"/api/v1/users/{user_id}/history", {'per_page': 100}):
+        visited_at = item.get('visited_at', '')
+        if visited_at:
+            tid = akv_canvas_tid(visited_at)
+            if sist_sett is not None and tid <= sist_sett:
+                break
+            if nyaste is None or tid > nyaste:
+                nyaste = tid
+        rader.append((visited_at, item.get('visited_url', ''), item.get('asset_readable_category', ''), user_id))
+    return rader, nyaste
+
+
 def timer_Canvas_History():
     start_Canvas_History = time.perf_counter()
-    headers = {'Authorization': 'Bearer ' + os.environ["tokenCanvas"]}
-    url_template = 'https://hvl.instructure.com/api/v1/users/{0}/history'
-    query = "DELETE FROM [stg].[Canvas_History]"
-    with pyodbc.connect(conn_str) as cnxn:
+    with akv_sql_tilkopling() as cnxn:
         with cnxn.cursor() as cursor:
-            cursor.execute(query)
+            # Staging inneheld berre det som er nytt sidan førre køyring, slik at
+            # Populate_dbo_Canvas_History berre treng å handsame deltaet.
+            cursor.execute("DELETE FROM [stg].[Canvas_History]")
+            cursor.execute("""
+                IF OBJECT_ID(N'dbo.akv_history_sist_sett', N'U') IS NULL
+                CREATE TABLE [dbo].[akv_history_sist_sett] (
+                    [user_id] BIGINT NOT NULL PRIMARY KEY,
+                    [visited_at] DATETIME2 NOT NULL
+                )
+            """)
             cnxn.commit()
             query = """
                 SELECT DISTINCT [stg].[Canvas_Users].[user_id]
@@ -1831,30 +2888,38 @@ def timer_Canvas_History():
             """
             cursor.execute(query)
             user_ids = [row[0] for row in cursor.fetchall()]
-            for user_id in user_ids:
-                url = url_template.format(user_id)
-                response = requests.get(url, headers=headers)
-                for item in response.json():
-                    try:
-                        visitedAt = item['visited_at']
-                    except:
-                        visitedAt = ''
-                    try:
-                        visitedURL = item['visited_url']
-                    except:
-                        visitedURL = ''
-                    try:
-                        assetReadableCategory = item['asset_readable_category']
-                    except:
-                        assetReadableCategory = ''
-                    userId = user_id
-                    query = "INSERT INTO [stg].[Canvas_History] (visited_at, visited_url, asset_readable_category, user_id) VALUES (?,?,?,?)"
-                    cursor.execute(query, visitedAt, visitedURL, assetReadableCategory, userId)
-                    cnxn.commit()
+            cursor.execute("SELECT [user_id], [visited_at] FROM [dbo].[akv_history_sist_sett]")
+            sist_sett = {row[0]: row[1] for row in cursor.fetchall()}
+
+        # Canvas-kalla går parallelt (regulert av akv_canvas_request), medan opplastinga
+        # skjer her i hovudtråden kvar gong bufferen har fylt ein batch.
+        buffer = []
+        nye_merke = []
+        totalt = 0
+        with ThreadPoolExecutor(max_workers=akv_canvas_maks_parallelle) as pool:
+            framtider = {pool.submit(akv_med_kontekst(akv_hent_Canvas_History), user_id, sist_sett.get(user_id)): user_id for user_id in user_ids}
+            for framtid in as_completed(framtider):
+                user_id = framtider[framtid]
+                try:
+                    rader, nyaste = framtid.result()
+                except requests.exceptions.HTTPError as feil:
+                    logging.warning(f"Fekk ikkje henta historikk for brukar {user_id}: {feil}")
+                    continue
+                buffer.extend(rader)
+                if nyaste is not None and nyaste != sist_sett.get(user_id):
+                    nye_merke.append((user_id, nyaste))
+                if len(buffer) >= akv_bulk_batchstorleik:
+                    totalt += akv_bulk_insert(cnxn, "stg.Canvas_History", buffer)
+                    buffer = []
+        totalt += akv_bulk_insert(cnxn, "stg.Canvas_History", buffer)
+
+        with cnxn.cursor() as cursor:
             query = "EXEC dbo.Populate_dbo_Canvas_History"
             cursor.execute(query)
             cnxn.commit()
-            logging.debug("Data lasta opp til Canvas_History")
+        # Merka blir først flytta når deltaet er handsama, elles hentar neste køyring det på nytt
+        akv_bulk_merge(cnxn, "dbo.akv_history_sist_sett", nye_merke)
+        logging.debug(f"Data lasta opp til Canvas_History: {totalt} nye rader frå {len(user_ids)} brukarar")
     logging.info(f"Tidsbruk Canvas_History: {time.perf_counter() - start_Canvas_History} s")
 
 
@@ -1908,39 +2973,16 @@ def timer_FS_EmneProgKobling():
     }
     """
 
+    hent_periode = akv_radhentar(['kode',
+                                  'versjonskode',
+                                  'undervisesIPeriode.forsteTermin.arstall',
+                                  'undervisesIPeriode.forsteTermin.betegnelse.kode',
+                                  'undervisesIPeriode.sisteTermin.arstall',
+                                  'undervisesIPeriode.sisteTermin.betegnelse.kode'])
     emnekoblingar = []
-    n = 0
-    hentmeir = True
-    antal_per_side = 100
-    while hentmeir:
-        if n == 0:
-            start = None
-        else:
-            start = svar['data']['emner']['pageInfo']['endCursor']
-        variable = {'antal': antal_per_side, 'start': start}
-        n += 1
-        svar = akv_query_FS_graphql(query_FS_EmneProgKobling, variable)
-        if svar == {}:
-            hentmeir = False # Avbryt prosessen når ein feil oppstår, slik at resten av programmet ikkje kræsjer
-        for emner in svar['data']['emner']['nodes']:
-            emnekode = emner['kode']
-            versjonskode = emner['versjonskode']
-            try:
-                emnestart_år = emner['undervisesIPeriode']['forsteTermin']['arstall']
-            except:
-                emnestart_år = None
-            try:
-                emnestart_termin = emner['undervisesIPeriode']['forsteTermin']['betegnelse']['kode']
-            except:
-                emnestart_termin = None
-            try:
-                emneslutt_år = emner['undervisesIPeriode']['sisteTermin']['arstall']
-            except:
-                emneslutt_år = None
-            try:
-                emneslutt_termin = emner['undervisesIPeriode']['sisteTermin']['betegnelse']['kode']
-            except:
-                emneslutt_termin = None
+    for nodar in akv_graphql_sider(query_FS_EmneProgKobling, {}, 'emner', 100):
+        for emner in nodar:
+            emnekode, versjonskode, emnestart_år, emnestart_termin, emneslutt_år, emneslutt_termin = hent_periode(emner)
             if (emneslutt_år is None) or (emneslutt_år > 2016):
                 for studieprogram in emner['studieprogramkoblinger']:
                     if studieprogram is not None:
@@ -1973,8 +3015,6 @@ def timer_FS_EmneProgKobling():
                                             'Undervises_siste_ar': emneslutt_år,
                                             'Undervises_siste_termin': emneslutt_termin})
 
-        hentmeir = svar['data']['emner']['pageInfo']['hasNextPage']
-
     dataramme = pd.DataFrame(emnekoblingar, columns=['Emnekode', 'Versjonskode', 'Studieprogramkode', 'Undervises_forste_ar', 'Undervises_forste_termin', 'Undervises_siste_ar', 'Undervises_siste_termin'])
     dataramme['Emnekode2'] = dataramme['Emnekode'] + '_' + dataramme['Versjonskode']
     dataramme['programEmneKode'] = dataramme['Studieprogramkode'] + '_' + dataramme['Emnekode'] + '_' + dataramme['Versjonskode']
@@ -1982,121 +3022,84 @@ def timer_FS_EmneProgKobling():
     dataramme = dataramme.where(pd.notnull(dataramme), "")
     emnekoblingar = dataramme.values.tolist()
 
-    conn_str = os.environ["Connection_SQL"]
-    with pyodbc.connect(conn_str) as cnxn:
-        with cnxn.cursor() as cursor:
-            merge_query = """
-                MERGE INTO [stg].[FS_EmneProgKobling] AS target
-                USING (SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?) AS source (
-                    [Emnekode],
-                    [Versjonskode],
-                    [Studieprogramkode],
-                    [Undervises_forste_ar],
-                    [Undervises_forste_termin],
-                    [Undervises_siste_ar],
-                    [Undervises_siste_termin],
-                    [Emnekode2],
-                    [programEmneKode]
-                )
-                ON target.[programEmneKode] = source.[programEmneKode]
-                WHEN MATCHED THEN UPDATE SET 
-                    target.[Studieprogramkode]= source.[Studieprogramkode],
-                    target.[Emnekode] = source.[Emnekode],
-                    target.[Versjonskode] = source.[Versjonskode],
-                    target.[Undervises_forste_ar]= source.[Undervises_forste_ar],
-                    target.[Undervises_forste_termin]= source.[Undervises_forste_termin],
-                    target.[Undervises_siste_ar]= source.[Undervises_siste_ar],
-                    target.[Undervises_siste_termin]= source.[Undervises_siste_termin],
-                    target.[Emnekode2] = source.[Emnekode2]
-                WHEN NOT MATCHED THEN INSERT (
-                    [Emnekode],
-                    [Versjonskode],
-                    [Studieprogramkode],
-                    [Undervises_forste_ar],
-                    [Undervises_forste_termin],
-                    [Undervises_siste_ar],
-                    [Undervises_siste_termin],
-                    [Emnekode2],
-                    [programEmnekode])
-                VALUES (
-                    source.[Emnekode],
-                    source.[Versjonskode],
-                    source.[Studieprogramkode],
-                    source.[Undervises_forste_ar],
-                    source.[Undervises_forste_termin],
-                    source.[Undervises_siste_ar],
-                    source.[Undervises_siste_termin],
-                    source.[Emnekode2],
-                    source.[programEmneKode]
-                );
-            """
-            for rad in emnekoblingar:
-                Emnekode = rad[0]
-                Versjonskode = rad[1]
-                Studieprogramkode = rad[2]
-                Undervises_forste_ar = rad[3]
-                Undervises_forste_termin = rad[4]
-                Undervises_siste_ar = rad[5]
-                Undervises_siste_termin = rad[6]
-                Emnekode2 = rad[7]
-                programEmneKode = rad[8]
-                cursor.execute(merge_query, (Emnekode, Versjonskode, Studieprogramkode, Undervises_forste_ar, Undervises_forste_termin, Undervises_siste_ar, Undervises_siste_termin, Emnekode2, programEmneKode))
-            cnxn.commit()
+    with akv_sql_tilkopling() as cnxn:
+        akv_bulk_merge(cnxn, "stg.FS_EmneProgKobling", emnekoblingar)
     logging.info(f"Tidsbruk FS_EmneProgKobling: {time.perf_counter() - start_FS_EmneProgKobling} s")
 
 
+# Stega i den nattlege køyringa. 'treng' er steg som må vere ferdige først (fordi vi les
+# tabellane dei skriv), 'kjelde' avgrensar kor mange steg mot same API som går samstundes,
+# 'dagar' avgrensar steget til visse dagar i månaden, og med 'stopp_ved_feil' blir steget
+# hoppa over når eit steg det treng, har feila.
+akv_steg = [
+    # CD2-tabellane (kalender og enrollments) blir henta saman i éin runde av timer_CD2
+    # {'namn': 'timer_CD2', 'funksjon': timer_CD2, 'kjelde': 'CD2', 'treng': []},
+    {'namn': 'timer_Canvas_Users', 'funksjon': timer_Canvas_Users, 'kjelde': 'Canvas', 'treng': []},
+    {'namn': 'timer_Canvas_Terms', 'funksjon': timer_Canvas_Terms, 'kjelde': 'Canvas', 'treng': [], 'dagar': [1]},
+    {'namn': 'timer_FS_Studieprogram', 'funksjon': timer_FS_Studieprogram, 'kjelde': 'FS', 'treng': []},
+    {'namn': 'timer_FS_emne', 'funksjon': timer_FS_emne, 'kjelde': 'FS', 'treng': [], 'dagar': [1]},
+    {'namn': 'timer_FS_ProgramStudieretter', 'funksjon': timer_FS_ProgramStudieretter, 'kjelde': 'FS', 'treng': ['timer_FS_Studieprogram'], 'stopp_ved_feil': True},
+    {'namn': 'timer_Canvas_Courses', 'funksjon': timer_Canvas_Courses, 'kjelde': 'Canvas', 'treng': []},
+    {'namn': 'timer_Canvas_Enrollments', 'funksjon': timer_Canvas_Enrollments, 'kjelde': 'Canvas', 'treng': ['timer_Canvas_Terms', 'timer_Canvas_Courses']},
+    {'namn': 'timer_Canvas_Courses_StudentSummaries', 'funksjon': timer_Canvas_Courses_StudentSummaries, 'kjelde': 'Canvas', 'treng': ['timer_Canvas_Terms', 'timer_Canvas_Courses']},
+    {'namn': 'timer_Canvas_Modules', 'funksjon': timer_Canvas_Modules, 'kjelde': 'Canvas', 'treng': ['timer_Canvas_Terms', 'timer_Canvas_Courses']},
+    {'namn': 'timer_Canvas_History', 'funksjon': timer_Canvas_History, 'kjelde': 'Canvas', 'treng': ['timer_Canvas_Users', 'timer_Canvas_Enrollments']},
+    {'namn': 'timer_FS_EmneProgKobling', 'funksjon': timer_FS_EmneProgKobling, 'kjelde': 'FS', 'treng': []},
+]
+akv_steg_per_kjelde = {'Canvas': 3, 'FS': 2, 'CD2': 2}
+
+
+def akv_køyr_steg(steg):
+    """
+    Køyr stega så snart alt dei treng er ferdig, med fleire steg samstundes.
+
+    Steg som ikkje skal køyrast i dag, tel som ferdige. Eit steg som feilar blir logga
+    og tel òg som ferdig, slik at dei andre stega køyrer vidare (som før), bortsett frå
+    steg med 'stopp_ved_feil': dei blir hoppa over (og tel som feila) når eit steg dei
+    treng, har feila.
+    Kjeldene i akv_steg_per_kjelde avgrensar kor mange steg mot same API som køyrer samstundes.
+    """
+    dagens = [s for s in steg if dag in s.get('dagar', [dag])]
+    namn_i_dag = {s['namn'] for s in dagens}
+    grenser = {kjelde: threading.Semaphore(grense) for kjelde, grense in akv_steg_per_kjelde.items()}
+    ferdige = set()
+    feila = set()
+    venter = list(dagens)
+
+    def køyr(s):
+        if s.get('stopp_ved_feil') and feila.intersection(s['treng']):
+            logging.error(f"Hoppar over {s['namn']} fordi {', '.join(sorted(feila.intersection(s['treng'])))} feila")
+            feila.add(s['namn'])
+            return
+        with grenser[s['kjelde']]:
+            try:
+                with akv_måling(s['namn']):
+                    s['funksjon']()
+            except:
+                logging.exception(f"Feil i {s['namn']}")
+                feila.add(s['namn'])
+
+    with ThreadPoolExecutor(max_workers=len(dagens) or 1) as pool:
+        i_gang = {}
+        while venter or i_gang:
+            klare = [s for s in venter if all(t in ferdige or t not in namn_i_dag for t in s['treng'])]
+            for s in klare:
+                venter.remove(s)
+                i_gang[pool.submit(akv_med_kontekst(køyr), s)] = s['namn']
+            if not i_gang:
+                raise RuntimeError(f"Steg som ventar på kvarandre: {[s['namn'] for s in venter]}")
+            for framtid in as_completed(list(i_gang)):
+                ferdige.add(i_gang.pop(framtid))
+                break
+
+
 def main(mytimer: func.TimerRequest) -> None:
     logging.basicConfig(filename='timerRequest.log', encoding='utf-8', level=logging.INFO)
-    # try:
-    #     timer_Canvas_Calendar()
-    # except:
-    #     logging.exception("Feil i timer_Canvas_Calendar")
-    try:
-        timer_Canvas_Users()
-    except:
-        logging.exception("Feil i timer_Canvas_Users")
-    if dag in [1]:            
-        try:
-            timer_Canvas_Terms()
-        except:
-            logging.exception("Feil i timer_Canvas_Terms")
-        try:
-            timer_FS_Studieprogram()
-        except:
-            logging.exception("Feil i timer_FS_Studieprogram")
-        try:
-            timer_FS_emne()
-        except:
-            logging.exception("Feil i timer_FS_emne")
-    try:
-        timer_FS_ProgramStudieretter()
-    except:
-        logging.exception("Feil i timer_FS_ProgramStudieretter")
-    try:
-        timer_Canvas_Courses() 
-    except:
-        logging.exception("Feil i timer_Canvas_Courses")
-    try:
-        timer_Canvas_Enrollments()
-    except:
-        logging.exception("Feil i timer_Canvas_Enrollments")
-    try:
-        timer_Canvas_Courses_StudentSummaries()
-    except:
-        logging.exception("Feil i timer_Canvas_Courses_StudentSummaries")
-    try:
-        timer_Canvas_Modules()
-    except:
-        logging.exception("Feil i timer_Canvas_Modules")
-    try:
-        timer_Canvas_History()
-    except:
-        logging.exception("Feil i timer_Canvas_History")
     try:
-        timer_FS_EmneProgKobling()
-    except:
-        logging.exception("Feil i timer_FS_EmneProgKobling")
-    # try:
-    #     timer_Canvas_Enrollments_Ny()
-    # except:
-    #     logging.exception("Feil i timer_Canvas_Enrollments_Ny")
\ No newline at end of file
+        with akv_måling('main'):
+            akv_køyr_steg(akv_steg)
+    finally:
+        akv_stopp_CD2_fornying()
+        akv_http_samandrag()
+        akv_skriv_flammegraf()
+        akv_lagre_målingar()
@@ -0,0 +1,408 @@
+"""
+Benchmark for stega i __init__arbeidskopi.py med opptekne HTTP-svar i staden for
+Canvas, CD2 og FS, og ein lokal database (SQLite) i staden for Azure SQL.
+
+Ta opp svar frå ei vanleg køyring (krev dei same miljøvariablane som funksjonen):
+
+    python benchmark_timerar.py opptak --fixturar fixturar timer_Canvas_Users akv_les_CD2_tabell:users
+
+Spel dei av igjen, gjerne med skalerte data (t.d. 10 gonger så mange brukarar):
+
+    python benchmark_timerar.py avspel --fixturar fixturar --skala 10 timer_Canvas_Users akv_les_CD2_tabell:users
+
+Ved avspeling blir radene lagra i SQLite i --sql_katalog (sjå akv_sqlite_kople), så
+stega som les frå databasen, får det tidlegare steg har lagra. Med --sql null blir
+radene berre tekne imot og kasta.
+
+Utan stegnamn blir alle stega i akv_steg køyrde, i rekkjefølgja der. For kvart steg
+blir tid, CPU-tid, netto allokert minne, toppminne, HTTP-kall, byte, rader lasta opp
+og rader lesne frå CD2 skrivne ut (og til --ut som JSON-linjer). Fixturane inneheld persondata og skal ikkje sjekkast inn.
+"""
+import argparse
+import gzip
+import hashlib
+import importlib.util
+import io
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+from urllib.parse import urlparse, parse_qsl, urlencode
+
+import pandas as pd
+import requests
+from requests.structures import CaseInsensitiveDict
+
+# Parametrar i URL-ar som endrar seg frå gong til gong (S3-signaturar) og ikkje skal vere med i nøkkelen
+flyktige_parametrar = ('X-Amz-',)
+# Kor mykje id-ane i kvar kopi blir forskuvde når fixturane blir skalerte
+skala_forskyving = 10**9
+# Vertar der JSON-svar blir skalerte (CD2-svara er jobbar og fil-lister, ikkje data)
+skalerte_vertar = ('hvl.instructure.com', 'api.fellesstudentsystem.no')
+
+
+def last_arbeidskopi():
+    """
+    Importer __init__arbeidskopi.py som modul (filnamnet kan ikkje importerast direkte).
+    """
+    spec = importlib.util.spec_from_file_location("arbeidskopi", Path(__file__).with_name("__init__arbeidskopi.py"))
+    modul = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(modul)
+    return modul
+
+
+def fixturnøkkel(metode, url, kwargs):
+    """
+    Returner (nøkkel, kropp_hash) for eit kall: metode og URL med sorterte parametrar
+    (utan flyktige_parametrar), og ein hash av det som blir sendt i kroppen.
+    """
+    url = urlparse(url)
+    parametrar = sorted((k, v) for k, v in parse_qsl(url.query) if not k.startswith(flyktige_parametrar))
+    parametrar += sorted((k, str(v)) for k, v in (kwargs.get('params') or {}).items())
+    nøkkel = f"{metode.upper()} {url._replace(query=urlencode(parametrar)).geturl()}"
+    if kwargs.get('json') is not None:
+        kropp = json.dumps(kwargs['json'], sort_keys=True, ensure_ascii=False)
+    else:
+        kropp = kwargs.get('data') or ''
+    if isinstance(kropp, dict):
+        kropp = json.dumps(kropp, sort_keys=True)
+    if isinstance(kropp, str):
+        kropp = kropp.encode('utf-8')
+    return nøkkel, hashlib.sha1(kropp).hexdigest()
+
+
+def lag_respons(url, status, headers, innhald):
+    """
+    Lag ein requests.Response av eit opptak. Innhaldet er både i .content og i .raw,
+    slik at både vanlege kall og stream=True (CD2-filene) kan lesast.
+    """
+    respons = requests.Response()
+    respons.status_code = status
+    respons.headers = CaseInsensitiveDict(headers)
+    respons.url = url
+    respons.reason = ''
+    respons.encoding = 'utf-8'
+    respons._content = innhald
+    respons.raw = io.BytesIO(innhald)
+    return respons
+
+
+class Opptak:
+    """
+    HTTP-transport som sender kalla vidare til nettverket og lagrar svara i katalogen:
+    indeks.jsonl med éi linje per svar og innhaldet i svar/<sha1>.
+    """
+
+    def __init__(self, katalog):
+        self.katalog = Path(katalog)
+        (self.katalog / 'svar').mkdir(parents=True, exist_ok=True)
+        self.lås = threading.Lock()
+
+    def __call__(self, metode, url, sesjon=None, **kwargs):
+        respons = (sesjon or requests).request(metode, url, **kwargs)
+        innhald = respons.content
+        nøkkel, kropp_hash = fixturnøkkel(metode, url, kwargs)
+        fil = hashlib.sha1(innhald).hexdigest()
+        with self.lås:
+            (self.katalog / 'svar' / fil).write_bytes(innhald)
+            with open(self.katalog / 'indeks.jsonl', 'a', encoding='utf-8') as f_out:
+                f_out.write(json.dumps({
+                    'nøkkel': nøkkel,
+                    'kropp_hash': kropp_hash,
+                    'status': respons.status_code,
+                    'headers': dict(respons.headers),
+                    'fil': fil,
+                }, ensure_ascii=False) + "\n")
+        return lag_respons(respons.url, respons.status_code, respons.headers, innhald)
+
+
+class Avspeling:
+    """
+    HTTP-transport som svarer med opptekne svar frå katalogen i staden for nettverket.
+
+    Fleire svar på same kall (t.d. status for ein CD2-jobb) kjem i same rekkjefølgje
+    som då dei vart tekne opp; det siste blir gjenteke. Finst det ikkje opptak med same
+    kropp, men berre éin variant av kallet (t.d. CD2-jobbar med ein annan since), blir
+    den brukt. Med skala > 1 blir dataa i svara gjorde om til skala kopiar.
+    """
+
+    def __init__(self, katalog, skala=1):
+        self.katalog = Path(katalog)
+        self.skala = skala
+        self.lås = threading.Lock()
+        self.opptak = {}
+        self.skalerte = {}
+        with open(self.katalog / 'indeks.jsonl', encoding='utf-8') as f_inn:
+            for linje in f_inn:
+                post = json.loads(linje)
+                # Ventetida CD2 ber om, høyrer ikkje til koden som blir målt
+                post['headers'].pop('Retry-After', None)
+                self.opptak.setdefault(post['nøkkel'], {}).setdefault(post['kropp_hash'], []).append(post)
+
+    def __call__(self, metode, url, sesjon=None, **kwargs):
+        nøkkel, kropp_hash = fixturnøkkel(metode, url, kwargs)
+        with self.lås:
+            variantar = self.opptak.get(nøkkel, {})
+            svar = variantar.get(kropp_hash)
+            if svar is None and len(variantar) == 1:
+                svar = next(iter(variantar.values()))
+            if not svar:
+                raise KeyError(f"Manglar opptak av {nøkkel}")
+            post = svar.pop(0) if len(svar) > 1 else svar[0]
+        return lag_respons(url, post['status'], post['headers'], self.innhald(post, urlparse(url)))
+
+    def innhald(self, post, url):
+        """
+        Returner innhaldet i svaret, skalert dersom skala > 1 (kvar fil blir skalert éin gong).
+        """
+        with self.lås:
+            if post['fil'] in self.skalerte:
+                return self.skalerte[post['fil']]
+        innhald = (self.katalog / 'svar' / post['fil']).read_bytes()
+        if self.skala > 1:
+            if innhald[:2] == b'\x1f\x8b':
+                innhald = skaler_gzip(innhald, self.skala)
+            elif url.netloc in skalerte_vertar and innhald[:1] in (b'[', b'{'):
+                innhald = json.dumps(skaler_json(json.loads(innhald), self.skala)).encode('utf-8')
+        with self.lås:
+            self.skalerte[post['fil']] = innhald
+        return innhald
+
+
+def er_id(namn):
+    return namn in ('id', '_id', 'key.id') or namn.endswith('_id') or namn.endswith('.id')
+
+
+def forskyv_idar(objekt, forskyving):
+    """
+    Returner ein kopi av objekt der alle id-felt (tal eller tal som tekst) er forskuvde.
+    """
+    if isinstance(objekt, dict):
+        kopi = {}
+        for namn, verdi in objekt.items():
+            if er_id(namn) and isinstance(verdi, int) and not isinstance(verdi, bool):
+                kopi[namn] = verdi + forskyving
+            elif er_id(namn) and isinstance(verdi, str) and verdi.isdigit():
+                kopi[namn] = str(int(verdi) + forskyving)
+            else:
+                kopi[namn] = forskyv_idar(verdi, forskyving)
+        return kopi
+    if isinstance(objekt, list):
+        return [forskyv_idar(element, forskyving) for element in objekt]
+    return objekt
+
+
+def skaler_json(objekt, skala):
+    """
+    Gjer den ytste lista med objekt (sida i Canvas REST, nodes/edges i GraphQL) om til
+    skala kopiar med forskuvde id-ar. Lister inni lista blir ikkje skalerte ein gong til.
+    """
+    if isinstance(objekt, list) and objekt and all(isinstance(element, dict) for element in objekt):
+        return objekt + [forskyv_idar(element, k*skala_forskyving) for k in range(1, skala) for element in objekt]
+    if isinstance(objekt, dict):
+        return {namn: skaler_json(verdi, skala) for namn, verdi in objekt.items()}
+    if isinstance(objekt, list):
+        return [skaler_json(element, skala) for element in objekt]
+    return objekt
+
+
+def skaler_gzip(innhald, skala):
+    """
+    Skaler ei gzip-fil frå CD2: jsonl blir skalert linje for linje, CSV med pandas.
+    Parquet-filer er ikkje gzip og blir ikkje skalerte.
+    """
+    tekst = gzip.decompress(innhald)
+    if tekst.lstrip()[:1] == b'{':
+        linjer = [json.loads(linje) for linje in tekst.splitlines() if linje.strip()]
+        linjer = skaler_json(linjer, skala)
+        return gzip.compress("\n".join(json.dumps(linje) for linje in linjer).encode('utf-8'))
+    # Alt blir lese som tekst, så verdiane kjem ut att akkurat slik dei var
+    df = pd.read_csv(io.BytesIO(tekst), sep=",", dtype=str, keep_default_na=False)
+    kopiar = [df]
+    for k in range(1, skala):
+        kopi = df.copy()
+        for kolonne in kopi.columns:
+            if er_id(kolonne):
+                kopi[kolonne] = kopi[kolonne].map(lambda v: str(int(v) + k*skala_forskyving) if v.isdigit() else v)
+        kopiar.append(kopi)
+    return gzip.compress(pd.concat(kopiar).to_csv(index=False).encode('utf-8'))
+
+
+class NullCursor:
+    """
+    Cursor som godtek alle spørjingar utan å gjere noko, og aldri returnerer rader.
+    """
+
+    def __init__(self):
+        self.fast_executemany = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, query, *parametrar):
+        return self
+
+    def executemany(self, query, rader):
+        return self
+
+    def fetchall(self):
+        return []
+
+    def fetchone(self):
+        return None
+
+    def __iter__(self):
+        return iter([])
+
+    def close(self):
+        pass
+
+
+class NullTilkopling:
+    """
+    SQL-erstatning som berre tek imot (--sql null): stega kan køyrast og målast utan
+    nokon database, men spørjingar etter data (t.d. aktuelle emne) får tomme svar.
+    """
+
+    def cursor(self):
+        return NullCursor()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def finn_steg(modul, namna):
+    """
+    Returner [(namn, funksjon)] for stega i namna, eller alle stega i akv_steg.
+    'akv_les_CD2_tabell:users' les CD2-tabellen users.
+    """
+    if not namna:
+        return [(s['namn'], s['funksjon']) for s in modul.akv_steg]
+    steg = []
+    for namn in namna:
+        if namn.startswith('akv_les_CD2_tabell:'):
+            tabell = namn.split(':', 1)[1]
+            steg.append((namn, lambda tabell=tabell: modul.akv_les_CD2_tabell(tabell)))
+        else:
+            steg.append((namn, getattr(modul, namn)))
+    return steg
+
+
+def tel_rader(modul, måling):
+    """
+    Returner (rader lasta opp, rader lesne) i køyringa til måling. Opplasta rader kjem
+    berre frå dei ytste sql:-delstega, så radhashane ei opplasting lagrar (sql: inni sql:)
+    ikkje blir talde med; lesne rader kjem frå nedlasting:-delstega (CD2-filene).
+    """
+    lasta_opp = lesne = 0
+    with modul.akv_målingar_lås:
+        for m in modul.akv_målingar:
+            if m['køyring'] != måling['køyring']:
+                continue
+            delsteg = [namn.split(':')[0] for namn in modul.akv_måling_stabel(m)[1:] if ':' in namn]
+            if delsteg == ['sql']:
+                lasta_opp += m['rader']
+            elif delsteg[-1:] == ['nedlasting']:
+                lesne += m['rader']
+    return lasta_opp, lesne
+
+
+def mål_steg(modul, namn, funksjon):
+    """
+    Køyr eitt steg og returner tid, CPU-tid, minne og teljarane frå akv_måling.
+    Minnet blir berre målt for heile steget: tracemalloc gjeld heile prosessen, og
+    delstega går i fleire trådar samstundes.
+    """
+    tracemalloc.reset_peak()
+    minne_før = tracemalloc.get_traced_memory()[0]
+    blokker_før = sys.getallocatedblocks()
+    cpu_start = time.process_time()
+    feil = None
+    try:
+        with modul.akv_måling(namn) as måling:
+            funksjon()
+    except Exception as exc:
+        logging.exception(f"Feil i {namn}")
+        feil = repr(exc)
+    minne_etter, topp = tracemalloc.get_traced_memory()
+    rader, rader_lesne = tel_rader(modul, måling)
+    return {
+        'steg': namn,
+        'sekund': måling['sekund'],
+        'cpu_sekund': time.process_time() - cpu_start,
+        'allokert_mb': (minne_etter - minne_før) / 2**20,
+        'topp_mb': (topp - minne_før) / 2**20,
+        'netto_blokker': sys.getallocatedblocks() - blokker_før,
+        'http_kall': måling['http_kall'],
+        'byte': måling['byte'],
+        'rader': rader,
+        'rader_lesne': rader_lesne,
+        'feil': feil,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ta opp eller spel av HTTP-svar og mål stega i __init__arbeidskopi.py")
+    parser.add_argument('modus', choices=['opptak', 'avspel'])
+    parser.add_argument('steg', nargs='*', help="timer_*-funksjonar eller akv_les_CD2_tabell:<tabell>; standard er alle i akv_steg")
+    parser.add_argument('--fixturar', default='fixturar', help="katalog med opptekne svar")
+    parser.add_argument('--skala', type=int, default=1, help="kor mange kopiar av dataa kvart svar skal innehalde ved avspeling")
+    parser.add_argument('--sql', choices=['sqlite', 'null'], default='sqlite', help="database ved avspeling")
+    parser.add_argument('--sql_katalog', default='SQL_lager_benchmark', help="katalog for SQLite-filene")
+    parser.add_argument('--ut', help="fil som resultata blir lagde til i, som JSON-linjer")
+    parser.add_argument('--flammegraf', help="fil for tidsbruken som folded stacks")
+    argument = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    if argument.modus == 'avspel':
+        for variabel in ('CD2_client_id', 'CD2_client_secret', 'Connection_SQL', 'tokenCanvas', 'tokenFS'):
+            os.environ.setdefault(variabel, 'avspeling')
+        if argument.sql == 'sqlite':
+            os.environ['SQL_lager'] = 'sqlite'
+            os.environ['SQL_lager_katalog'] = argument.sql_katalog
+    modul = last_arbeidskopi()
+    if argument.modus == 'opptak':
+        modul.akv_http_transport = Opptak(argument.fixturar)
+    else:
+        modul.akv_http_transport = Avspeling(argument.fixturar, argument.skala)
+        if argument.sql == 'null':
+            modul.akv_sql_kople = NullTilkopling
+            # Tabellverdi-parametrar finst berre i Azure SQL
+            for spesifikasjon in modul.akv_tabellar.values():
+                spesifikasjon.pop('tvp', None)
+        modul.akv_CD2_poll_start = 0.0
+
+    tracemalloc.start()
+    resultat = []
+    for namn, funksjon in finn_steg(modul, argument.steg):
+        resultat.append({'modus': argument.modus, 'skala': argument.skala, **mål_steg(modul, namn, funksjon)})
+        r = resultat[-1]
+        print(f"{namn:45} {r['sekund']:8.2f} s {r['cpu_sekund']:8.2f} s CPU {r['allokert_mb']:8.1f} MB "
+              f"{r['topp_mb']:8.1f} MB topp {r['http_kall']:6} kall {r['byte']:12} byte {r['rader']:9} rader {r['rader_lesne']:9} lesne"
+              + (f"  FEIL {r['feil']}" if r['feil'] else ""))
+    tracemalloc.stop()
+
+    modul.akv_http_samandrag()
+    if argument.flammegraf:
+        modul.akv_skriv_flammegraf(argument.flammegraf)
+    if argument.ut:
+        with open(argument.ut, 'a', encoding='utf-8') as f_out:
+            for r in resultat:
+                f_out.write(json.dumps(r, ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,8 @@
 import requests
 import os
 import io
-from datetime import datetime, timedelta, date
+from datetime import datetime, timedelta, date, timezone
+from urllib.parse import urlparse, parse_qs
 import time
 import json
 import gzip
@@ -39,16 +40,37 @@ def akv_hent_CD2_access_token():
         raise exc
 
 
+# URL-ane til filene i jobben, henta med eitt kall til /dap/object/url, og når dei går ut
+CD2_urlar = {}
+
+
+def akv_CD2_url_utløper(url):
+    """
+    Finn tidspunktet (time.time()) då ein førehandssignert S3-URL sluttar å vere gyldig.
+    Dersom URL-en ikkje seier noko om det, reknar vi med 15 minutt.
+    """
+    parametrar = parse_qs(urlparse(url).query)
+    try:
+        signert = datetime.strptime(parametrar['X-Amz-Date'][0], "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
+        return signert.timestamp() + int(parametrar['X-Amz-Expires'][0])
+    except (KeyError, ValueError):
+        return time.time() + 15*60
+
+
 def akv_hent_CD2_filar(innfil, token, svar):
     try:
         requesturl = f"https://api-gateway.instructure.com/dap/object/url"
         payload = f"{svar['objects']}"
         payload = payload.replace('\'', '\"')
         headers = {'x-instauth': token, 'Content-Type': 'text/plain'}
-        respons = requests.request("POST", requesturl, headers=headers, data=payload)
-        respons.raise_for_status()
-        fil = respons.json()
-        url = fil['urls'][innfil]['url']
+        oppføring = CD2_urlar.get(innfil)
+        if oppføring is None or oppføring['utløper'] - 60 < time.time():
+            respons = requests.request("POST", requesturl, headers=headers, data=payload)
+            respons.raise_for_status()
+            for objekt_id, ny in respons.json()['urls'].items():
+                CD2_urlar[objekt_id] = {'url': ny['url'], 'utløper': akv_CD2_url_utløper(ny['url'])}
+            oppføring = CD2_urlar[innfil]
+        url = oppføring['url']
         data = requests.request("GET", url)
         buffer = io.BytesIO(data.content)
         with gzip.GzipFile(fileobj=buffer, mode='rb') as utpakka_fil:
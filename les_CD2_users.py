@@ -1,105 +1,25 @@
 import requests
 import pandas as pd
-import gzip
-from datetime import datetime, timedelta, date
+from datetime import timedelta, date
+import importlib.util
+from pathlib import Path
 import time
 import os
-import io
 import pyodbc
 
-CD2_base_url = os.environ['CD2_base_url']
-CD2_client_id = os.environ['CD2_client_id']
-CD2_client_secret = os.environ['CD2_client_secret']
 conn_str = os.environ["Connection_SQL"]
 
 idag = date.today().isoformat()
 igår = (date.today() - timedelta(days=1)).isoformat()
 
-def akv_hent_CD2_access_token():
-    try:
-        respons = requests.request(
-            "POST",
-            f"{CD2_base_url}/ids/auth/login",
-            data={'grant_type': 'client_credentials'},
-            auth=(CD2_client_id, CD2_client_secret)
-        )
-        respons.raise_for_status()
-        return respons.json()['access_token']
-    except requests.exceptions.RequestException as exc:
-        raise exc
-
-def akv_finn_sist_oppdatert(tabell):
+def last_arbeidskopi():
     """
-    Return the latest update time for the given table from the akv_sist_oppdatert table.
-    If no date is given, return yesterday.
+    Importer __init__arbeidskopi.py som modul (filnamnet kan ikkje importerast direkte).
     """
-    with pyodbc.connect(conn_str) as connection:
-        cursor = connection.cursor()
-        try:
-            query = """
-            SELECT [sist_oppdatert] FROM [dbo].[akv_sist_oppdatert]
-            WHERE [tabell] = ?
-            """
-            cursor.execute(query, (tabell,))
-            row = cursor.fetchone()
-            if row:
-                return row[0].isoformat() + "Z"
-        except pyodbc.Error as exc:
-            return (date.today() - timedelta(days=1)).isoformat() + "Z"
-
-
-def akv_hent_CD2_filar(innfil, token, svar):
-    try:
-        requesturl = f"{CD2_base_url}/dap/object/url"
-        payload = f"{svar['objects']}"
-        payload = payload.replace('\'', '\"')
-        headers = {'x-instauth': token, 'Content-Type': 'text/plain'}
-        respons = requests.request("POST", requesturl, headers=headers, data=payload)
-        respons.raise_for_status()
-        fil = respons.json()
-        url = fil['urls'][innfil]['url']
-        data = requests.request("GET", url)
-        buffer = io.BytesIO(data.content)
-        with gzip.GzipFile(fileobj=buffer, mode='rb') as utpakka_fil:
-            utpakka_data = utpakka_fil.read().decode()
-        return utpakka_data
-    except requests.exceptions.RequestException as exc:
-        raise exc
-
-def akv_les_CD2_tabell(tabell):
-    CD2_access_token = akv_hent_CD2_access_token()
-    headers = {'x-instauth': CD2_access_token, 'Content-Type': 'text/plain'}
-    sist_oppdatert = akv_finn_sist_oppdatert(tabell)
-    sist_oppdatert = "2024-10-30T00:00:00Z"
-    payload = '{"format": "csv", "since": \"%s\"}' % (sist_oppdatert)
-    requesturl = f"{CD2_base_url}/dap/query/canvas/table/{tabell}/data"
-    print(f"Sender søk til {requesturl}")
-    try:
-        r = requests.request("POST", requesturl, headers=headers, data=payload)
-        r.raise_for_status()
-        respons = r.json()
-        id = respons['id']
-        vent = True
-        while vent:
-            requesturl2 = f"{CD2_base_url}/dap//job/{id}"
-            r2 = requests.request("GET", requesturl2, headers=headers)
-            time.sleep(5)
-            respons2 = r2.json()
-            print(respons2)
-            if respons2['status'] == "complete":
-                vent = False
-                filar = respons2['objects']
-        dr_liste = []
-        print(filar)
-        for fil in filar:
-            data = io.StringIO(akv_hent_CD2_filar(fil['id'], CD2_access_token, respons2))
-            df = pd.read_csv(data, sep=",")
-            dr_liste.append(df)
-        alledata = pd.concat(df for df in dr_liste if not df.empty)
-        return alledata, respons2['until']
-    except requests.exceptions.RequestException as exc:
-        # raise exc
-        return None
+    spec = importlib.util.spec_from_file_location("arbeidskopi", Path(__file__).with_name("__init__arbeidskopi.py"))
+    modul = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(modul)
+    return modul
 
 
 def akv_lagre_sist_oppdatert(tabell, sist_oppdatert):
@@ -124,9 +44,13 @@ def akv_lagre_sist_oppdatert(tabell, sist_oppdatert):
 
 start_CD2_users = time.perf_counter()
 tabell = "users"
-alledata, sist_oppdatert = akv_les_CD2_tabell(tabell)
-alledata.to_csv(f"users_{sist_oppdatert}.csv", index=False)
-temp = alledata[alledata['value.created_at'] >= igår]
+# users-tabellen blir halden oppdatert i det lokale CD2-lageret til arbeidskopien (sjå
+# akv_synk_CD2_lager): første gong med eit fullt øyeblinksbilete, seinare berre med
+# endringane. Dei nye brukarane blir så funne i den lokale tilstanden.
+arbeidskopi = last_arbeidskopi()
+_, _, sist_oppdatert = arbeidskopi.akv_synk_CD2_lager(tabell, full=arbeidskopi.akv_CD2_lager_status(tabell) is None)
+alledata = arbeidskopi.akv_les_CD2_lager(tabell)
+temp = alledata[pd.to_datetime(alledata['value.created_at'], utc=True) >= pd.Timestamp(igår, tz='UTC')]
 nye_brukarar = temp[~temp.apply(lambda row: row.astype(str).str.contains('student', case=False).any(), axis=1)]
 
 # Finn sis_user_id for kvar av dei nye brukarane
@@ -0,0 +1,30 @@
+import importlib.util
+import os
+
+import pytest
+
+MODUL = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "__init__arbeidskopi.py")
+
+
+@pytest.fixture
+def modul(tmp_path, monkeypatch):
+    """
+    Last __init__arbeidskopi.py på nytt med SQLite-lageret i tmp_path, slik at
+    kvar test får sin eigen database og sin eigen tilkoplingspool.
+    """
+    for pakke in ("pyodbc", "requests", "azure.functions", "pyarrow"):
+        pytest.importorskip(pakke)
+    monkeypatch.setenv("CD2_client_id", "test")
+    monkeypatch.setenv("CD2_client_secret", "test")
+    monkeypatch.setenv("Connection_SQL", "test")
+    monkeypatch.setenv("SQL_lager", "sqlite")
+    monkeypatch.setenv("SQL_lager_katalog", str(tmp_path / "SQL_lager"))
+    monkeypatch.chdir(tmp_path)
+    spec = importlib.util.spec_from_file_location("akv_arbeidskopi", MODUL)
+    m = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(m)
+    yield m
+    with m.akv_sql_pool_lås:
+        for cnxn, _ in m.akv_sql_pool:
+            cnxn.close()
+        m.akv_sql_pool.clear()
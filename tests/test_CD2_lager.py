@@ -0,0 +1,38 @@
+import pandas as pd
+import pytest
+
+
+def endringar(*rader):
+    return pd.DataFrame([{'key.id': key_id, 'value.name': namn} for key_id, namn in rader])
+
+
+def test_avbroten_utskifting_held_på_den_gamle_tilstanden(modul, monkeypatch):
+    modul.akv_oppdater_CD2_lager("users", endringar((1, 'a'), (2, 'b')), "2026-10-17T00:00:00Z")
+
+    def krasj(*args, **kwargs):
+        raise OSError("disken er full")
+
+    with monkeypatch.context() as m:
+        m.setattr(pd.DataFrame, "to_parquet", krasj)
+        with pytest.raises(OSError):
+            modul.akv_oppdater_CD2_lager("users", endringar((3, 'c')), "2026-10-18T00:00:00Z", erstatt=True)
+
+    assert modul.akv_CD2_lager_status("users") == {'until': "2026-10-17T00:00:00Z"}
+    assert sorted(modul.akv_les_CD2_lager("users")['key.id']) == [1, 2]
+
+
+def test_utskifting_byter_tabell_og_status_samstundes(modul):
+    modul.akv_oppdater_CD2_lager("users", endringar((1, 'a'), (2, 'b')), "2026-10-17T00:00:00Z")
+    modul.akv_oppdater_CD2_lager("users", endringar((3, 'c')), "2026-10-18T00:00:00Z", erstatt=True)
+
+    assert modul.akv_CD2_lager_status("users") == {'until': "2026-10-18T00:00:00Z"}
+    assert list(modul.akv_les_CD2_lager("users")['key.id']) == [3]
+
+
+def test_utskifting_avbroten_mellom_omdøypingane_blir_fullført(modul, tmp_path):
+    modul.akv_oppdater_CD2_lager("users", endringar((3, 'c')), "2026-10-18T00:00:00Z")
+    katalog = tmp_path / "CD2_lager" / "users"
+    katalog.rename(tmp_path / "CD2_lager" / "users.ny")
+
+    assert modul.akv_CD2_lager_status("users") == {'until': "2026-10-18T00:00:00Z"}
+    assert list(modul.akv_les_CD2_lager("users")['key.id']) == [3]
@@ -0,0 +1,27 @@
+class Svar:
+    status_code = 200
+
+    def __init__(self, innhald):
+        self.innhald = innhald
+        self.content = b""
+        self.headers = {}
+
+    def json(self):
+        return self.innhald
+
+
+def test_kort_levetid_gir_gjenbruk_og_fornying_etter_halve_levetida(modul):
+    kall = []
+
+    def transport(metode, url, sesjon=None, **kwargs):
+        kall.append(url)
+        return Svar({'access_token': f"token-{len(kall)}", 'expires_in': 60})
+
+    modul.akv_http_transport = transport
+    try:
+        assert modul.akv_hent_CD2_access_token() == "token-1"
+        assert modul.akv_hent_CD2_access_token() == "token-1"
+        assert len(kall) == 1
+        assert modul.akv_CD2_token['fornying'].interval == 30
+    finally:
+        modul.akv_stopp_CD2_fornying()
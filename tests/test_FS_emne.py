@@ -0,0 +1,33 @@
+def emnenode(kode, navn, organisasjonsenhet=True):
+    node = {
+        'kode': kode,
+        'versjonskode': "1",
+        'navnAlleSprak': {'nb': navn, 'nn': navn, 'en': navn},
+        'fagkoblinger': {'viktigsteFag': {'navnAlleSprak': {'nob': "Matematikk"}}},
+        'organisasjonsenhet': {'administrativtAnsvarlig': {'fakultet': {'fakultetsnummer': "1"}, 'instituttnummer': "2",
+                                                           'navnAlleSprak': {'nb': "Institutt"}}},
+        'emnetype': "EMNE",
+        'vekting': {'emnevekting': {'verdi': 10, 'vektingstype': {'kode': "SP"}}},
+        'beskrivelser': [],
+        'personroller': [],
+    }
+    if not organisasjonsenhet:
+        node['organisasjonsenhet'] = None
+    return node
+
+
+def test_emne_som_manglar_felt_blir_hoppa_over(modul, monkeypatch):
+    def sider(query, variable, sti, antal_per_side, spør=None, start=None):
+        yield [emnenode("MAT100", "Matematikk"), emnenode("FYS100", "Fysikk 2", organisasjonsenhet=False)]
+
+    monkeypatch.setattr(modul, "akv_graphql_sider", sider)
+    rad = ("FYS100", "1", "FYS100_1", "Fysikk", "Fysikk", "Fysikk", "Fysikk", "1", "2", "Institutt", "EMNE", 10, "SP",
+           "", "", "", "", "", "")
+    with modul.akv_sql_tilkopling() as cnxn:
+        modul.akv_bulk_merge(cnxn, "stg.FS_Emner", [rad])
+
+    modul.timer_FS_emne()
+
+    with modul.akv_sql_tilkopling() as cnxn:
+        emne = dict(cnxn.cursor().execute("SELECT [unik_kode], [emnenavn_nob] FROM [stg].[FS_Emner]").fetchall())
+    assert emne == {"MAT100_1": "Matematikk", "FYS100_1": "Fysikk"}
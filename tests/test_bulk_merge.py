@@ -0,0 +1,21 @@
+import itertools
+
+TABELL = "FS_ProgramStudieretter"
+
+
+def last_opp(modul, batchar):
+    with modul.akv_sql_tilkopling() as cnxn:
+        modul.akv_bulk_merge_straum(cnxn, TABELL, iter(batchar), nummererte=True)
+        return cnxn.cursor().execute("SELECT * FROM [FS_ProgramStudieretter] ORDER BY [plnr]").fetchall()
+
+
+def test_nummererte_batchar_gir_same_resultat_uansett_rekkjefølgje(modul):
+    # Person 1 har studieretter i to program, som kjem i kvar sin del
+    batchar = [
+        ((0 << 32) + 0, [(1, 'A', '', '2024', 'HØST'), (2, 'A', '', '2024', 'HØST')]),
+        ((0 << 32) + 1, [(3, 'A', '', '2023', 'HØST')]),
+        ((1 << 32) + 0, [(1, 'B', '', '2025', 'VÅR')]),
+    ]
+    resultat = {tuple(last_opp(modul, list(rekkjefølgje))) for rekkjefølgje in itertools.permutations(batchar)}
+    assert len(resultat) == 1
+    assert dict((rad[0], rad[1]) for rad in resultat.pop()) == {1: 'B', 2: 'A', 3: 'A'}
@@ -0,0 +1,29 @@
+TABELL = "stg.FS_Emner"
+
+
+def emne(unik_kode, emnenavn):
+    kolonnar = [None] * 19
+    kolonnar[0:4] = [unik_kode.split("_")[0], "1", unik_kode, emnenavn]
+    return tuple(kolonnar)
+
+
+def last_opp(modul, rader):
+    with modul.akv_sql_tilkopling() as cnxn:
+        return modul.akv_bulk_merge(cnxn, TABELL, rader)
+
+
+def test_FS_emne_hoppar_over_uendra_rader_på_køyredagen(modul, monkeypatch):
+    # timer_FS_emne køyrer berre den første i månaden; endringssjekken skal likevel verke då
+    monkeypatch.setattr(modul, "dag", 1)
+    rader = [emne("MAT100_1", "Matematikk"), emne("FYS100_1", "Fysikk")]
+    assert last_opp(modul, rader) == 2
+    assert last_opp(modul, rader) == 0
+    rader[1] = emne("FYS100_1", "Fysikk 1")
+    assert last_opp(modul, rader) == 1
+
+
+def test_alle_rader_blir_sende_kvar_full_kvar_te_køyring(modul):
+    full_kvar = modul.akv_tabellar[TABELL]['full_kvar']
+    rader = [emne("MAT100_1", "Matematikk"), emne("FYS100_1", "Fysikk")]
+    sende = [last_opp(modul, rader) for _ in range(full_kvar + 1)]
+    assert sende == [2] + [0] * (full_kvar - 1) + [2]
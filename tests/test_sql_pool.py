@@ -0,0 +1,20 @@
+def test_to_spørjingar_etter_kvarandre_på_same_tilkopling(modul):
+    modul.akv_lagre_sist_oppdatert("users", "2026-10-18T10:00:00")
+    assert len(modul.akv_sql_pool) == 1
+
+    # Begge spørjingane går på den same lånte tilkoplinga og den same cursoren
+    assert modul.akv_finn_sist_oppdatert("users") == "2026-10-18T10:00:00Z"
+    assert modul.akv_finn_sist_oppdatert("users") == "2026-10-18T10:00:00Z"
+    assert len(modul.akv_sql_pool) == 1
+
+    modul.akv_lagre_sist_oppdatert("users", "2026-10-19T10:00:00")
+    assert modul.akv_finn_sist_oppdatert("users") == "2026-10-19T10:00:00Z"
+    assert len(modul.akv_sql_pool) == 1
+
+
+def test_resultatet_er_lese_ut_før_tilkoplinga_går_tilbake(modul):
+    modul.akv_lagre_sist_oppdatert("users", "2026-10-18T10:00:00")
+    modul.akv_finn_sist_oppdatert("users")
+    cnxn, _ = modul.akv_sql_pool[-1]
+    for cursor in modul.akv_sql_cursorar[id(cnxn)].values():
+        assert cursor.fetchall() == []
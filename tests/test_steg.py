@@ -0,0 +1,15 @@
+def test_steg_med_stopp_ved_feil_blir_hoppa_over_når_det_dei_treng_feilar(modul):
+    køyrde = []
+
+    def feilar():
+        køyrde.append('a')
+        raise RuntimeError("a feila")
+
+    steg = [
+        {'namn': 'a', 'funksjon': feilar, 'kjelde': 'FS', 'treng': []},
+        {'namn': 'b', 'funksjon': lambda: køyrde.append('b'), 'kjelde': 'FS', 'treng': ['a'], 'stopp_ved_feil': True},
+        {'namn': 'c', 'funksjon': lambda: køyrde.append('c'), 'kjelde': 'FS', 'treng': ['a']},
+        {'namn': 'd', 'funksjon': lambda: køyrde.append('d'), 'kjelde': 'FS', 'treng': ['b'], 'stopp_ved_feil': True},
+    ]
+    modul.akv_køyr_steg(steg)
+    assert sorted(køyrde) == ['a', 'c']